@@ -14,6 +14,10 @@
 # limitations under the License.
 
 import os
+import errno
+import shutil
+import hmac
+import hashlib
 import tempfile
 import logging
 import StringIO
@@ -21,19 +25,16 @@ import yaml
 import random
 import crypt
 
-from hyperkit.hypervisor.command import Command
+from hyperkit.iso9660 import ISO9660
+from hyperkit import trace
 
 logger = logging.getLogger(__name__)
 
+# the C emitter is much faster, and produces the same output
+Dumper = getattr(yaml, "CDumper", yaml.Dumper)
 
-class GenIsoImage(Command):
-    command_name = "genisoimage"
-    subcommands = {
-        "generate": ["-output", "{pathname}",
-                     "-volid", "cidata",
-                     "-joliet", "-rock"],
-    }
-    log_execution = True
+# password hashes, by password and salt, as hashing is deliberately slow
+hashes = {}
 
 
 class CloudConfig:
@@ -49,8 +50,9 @@ class CloudConfig:
         "write_files",
     ]
 
-    def __init__(self, spec):
+    def __init__(self, spec, secret=None):
         self.spec = spec
+        self.secret = secret
 
     def get_config(self):
         config = {}
@@ -106,22 +108,36 @@ class CloudConfig:
         config['users'][0]['ssh-authorized-keys'] = [key]
 
     def encrypt(self, passwd):
-        """ Return the password hash for the specified password """
+        """ Return the password hash for the specified password. With a
+        secret the salt is derived from it and the user, so the same spec
+        renders the same config on this host, and the hash is only
+        calculated once. """
         salt = self.generate_salt()
-        return crypt.crypt(passwd, "$5${0}$".format(salt))
+        key = (passwd, salt)
+        if key not in hashes:
+            hashes[key] = crypt.crypt(passwd, "$5${0}$".format(salt))
+        return hashes[key]
 
     def generate_salt(self, length=16):
         salt_set = ('abcdefghijklmnopqrstuvwxyz'
                     'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
                     '0123456789./')
-        return ''.join([random.choice(salt_set) for i in range(length)])
+        if self.secret is None:
+            rand = random.SystemRandom()
+            return ''.join([rand.choice(salt_set) for i in range(length)])
+        digest = hmac.new(self.secret, str(self.username), hashlib.sha256).digest()
+        return ''.join([salt_set[ord(c) % len(salt_set)] for c in digest[:length]])
+
+    def write(self, f):
+        """ Write the config to the stream f. """
+        f.write("#cloud-config\n")
+        yaml.dump(self.get_config(), f, Dumper=Dumper)
 
     def open(self):
-        config = self.get_config()
         f = StringIO.StringIO()
-        print >> f, "#cloud-config"
-        print >> f, yaml.dump(config)
-        return StringIO.StringIO(f.getvalue())
+        self.write(f)
+        f.seek(0)
+        return f
 
 
 class MetaData:
@@ -138,13 +154,115 @@ class MetaData:
             "instance-id": self.instance_id,
         }
 
+    def write(self, f):
+        yaml.dump(self.as_dict(), f, Dumper=Dumper)
+
     def open(self):
-        return StringIO.StringIO(yaml.dump(self.as_dict()))
+        f = StringIO.StringIO()
+        self.write(f)
+        f.seek(0)
+        return f
+
+
+class SeedCache(object):
+
+    """ A content addressed cache of seed images, keyed on the digest of
+    the files on them. Machines created with identical files share one
+    image, hard linked into their directories. """
+
+    suffix = ".iso"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def pathname(self, digest):
+        return os.path.join(self.directory, digest + self.suffix)
+
+    def get(self, digest, build):
+        """ Return the pathname of the image with digest, and whether it was
+        already cached. If it wasn't build is called for its contents. """
+        pathname = self.pathname(digest)
+        if os.path.exists(pathname):
+            logger.debug("Using cached seed {0}".format(digest))
+            return pathname, True
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        save(pathname, build())
+        return pathname, False
+
+    def prune(self):
+        """ Remove the images no machine is linked to any more, returning
+        how many were removed. """
+        if not os.path.exists(self.directory):
+            return 0
+        removed = 0
+        for name in os.listdir(self.directory):
+            pathname = os.path.join(self.directory, name)
+            if name.endswith(self.suffix) and os.stat(pathname).st_nlink == 1:
+                os.unlink(pathname)
+                removed += 1
+        return removed
+
+
+def load_secret(pathname, length=32):
+    """ Return the random secret kept in pathname, creating it the first
+    time. Salts are derived from it, so it is readable only by its owner. """
+    if not os.path.exists(pathname):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(pathname), suffix=".tmp")
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                f.write(os.urandom(length))
+            finally:
+                f.close()
+            # linking fails rather than replacing the secret of another process
+            try:
+                os.link(tmp, pathname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            os.unlink(tmp)
+    return open(pathname, "rb").read()
+
+
+def save(pathname, data):
+    """ Atomically replace pathname with data. """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(pathname), suffix=".tmp")
+    f = os.fdopen(fd, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, pathname)
+
+
+def link(source, pathname):
+    """ Atomically replace pathname with a hard link to source, or a copy
+    of it if it can't be linked, such as across file systems. """
+    tmp = pathname + ".link"
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, pathname)
 
 
 class Seed:
 
+    """ The NoCloud seed image for a machine, an ISO9660 image with volume
+    id cidata holding the cloud config and meta data. The image is built
+    in memory, with no temporary files or processes. """
+
     seed_file_name = "seed.iso"
+    volume_id = "cidata"
 
     def __init__(self, directory, cloud_config, meta_data, *files):
         self.cloud_config = cloud_config
@@ -152,7 +270,6 @@ class Seed:
         self.directory = directory
         self.files = [self.cloud_config, self.meta_data]
         self.files.extend(files)
-        self.tmpdir = tempfile.mkdtemp()
 
     @property
     def pathname(self):
@@ -163,29 +280,34 @@ class Seed:
         for f in self.files:
             yield f.filename
 
-    def _save(self):
-        """ Overwrite the seed ISO file. Will clobber it potentially."""
-        genisoimage = GenIsoImage()
-        genisoimage("generate", *self.filenames, pathname=self.pathname, cwd=self.tmpdir)
-
-    def open(self, filename):
-        path = os.path.join(self.tmpdir, filename)
-        return open(path, "w")
-
-    def _output(self, cloudfile):
-        fout = self.open(cloudfile.filename)
-        fin = cloudfile.open()
-        fout.write(fin.read())
-
-    def write(self):
-        for f in self.files:
-            self._output(f)
-        self._save()
-        self._cleanup()
-
-    def _cleanup(self):
-        for f in self.filenames:
-            os.unlink(os.path.join(self.tmpdir, f))
-        os.rmdir(self.tmpdir)
-
-__all__ = [MetaData, CloudConfig, Seed]
+    def payloads(self):
+        """ The name and rendered contents of each file on the seed. """
+        return [(f.filename, f.open().read()) for f in self.files]
+
+    def digest(self, payloads):
+        h = hashlib.sha256()
+        for filename, data in payloads:
+            h.update("{0}\0{1}\0".format(filename, len(data)))
+            h.update(data)
+        return h.hexdigest()
+
+    def image(self, payloads):
+        iso = ISO9660(self.volume_id)
+        for filename, data in payloads:
+            iso.add(filename, data)
+        return iso.getvalue()
+
+    def write(self, cache=None):
+        """ Write the seed image. If a SeedCache is given an identical image
+        is linked from it if there is one, or added to it if not. """
+        with trace.span("seed", pathname=self.pathname) as info:
+            payloads = self.payloads()
+            if cache is None:
+                save(self.pathname, self.image(payloads))
+                info["cached"] = False
+            else:
+                cached, info["cached"] = cache.get(self.digest(payloads), lambda: self.image(payloads))
+                link(cached, self.pathname)
+            info["bytes"] = os.path.getsize(self.pathname)
+
+__all__ = [MetaData, CloudConfig, SeedCache, Seed, load_secret]
@@ -15,12 +15,21 @@
 
 import os
 import sys
+import json
+import time
+import fnmatch
 import argparse
 import logging
 
 from hyperkit.spec import MachineSpec, PasswordAuth, SSHAuth, Hardware, CanonicalImage, LiteralImage
 from hyperkit.hypervisor import VirtualBox, VMWare
+from hyperkit.hypervisor.machine import wait_all, parallel
+from hyperkit.hypervisor.command import registry, Command, CommandTimeout
+from hyperkit.hypervisor.vmrun import VMRun
+from hyperkit.hypervisor.vboxsession import VBoxSession
 from hyperkit.error import MachineDoesNotExist
+from hyperkit.store import ImageStore, parse_size, format_size
+from hyperkit import trace
 
 try:
     from hyperkit.test.system import test_parser
@@ -138,28 +147,95 @@ def create(args):
     logging.info("    base image: %s" % spec.image)
     logging.info("    hardware: %s" % spec.hardware)
 
-    vm = hypervisor.create(spec, args.force_cache)
-    logging.info("You can start this machine with: hyperkit -H %s start %s" % (hypervisor.hypervisor_id, vm.instance_id, ))
+    if args.count > 1:
+        create_many(args, hypervisor, spec)
+        return
+    result = hypervisor.create_result(spec, args.force_cache, args.linked)
+    logging.info("Created %s in %.1fs" % (result.instance_id, result.elapsed))
+    for phase in result.phases:
+        logging.info("    %s" % phase)
+    logging.info("You can start this machine with: hyperkit -H %s start %s" % (hypervisor.hypervisor_id, result.instance_id, ))
+
+
+def create_many(args, hypervisor, spec):
+    started = time.time()
+    results = hypervisor.create_many(spec, args.count, args.force_cache, args.linked, args.workers)
+    for r in results:
+        if r.ok:
+            logging.info("%s created in %.1fs" % (r.instance_id, r.elapsed))
+            for phase in r.phases:
+                logging.debug("    %s" % phase)
+        else:
+            logging.error("%s failed after %.1fs: %s" % (r.instance_id, r.elapsed, r.error))
+            if os.path.exists(os.path.join(hypervisor.directory, r.instance_id)):
+                logging.error("    remove it with: hyperkit -H %s cleanup %s" % (hypervisor.hypervisor_id, r.instance_id))
+    failed = len([r for r in results if not r.ok])
+    logging.info("Created %d of %d machines in %.1fs" % (len(results) - failed, len(results), time.time() - started))
+    if failed:
+        raise SystemExit(1)
+
+
+def run_all(args, hypervisor, func, message):
+    """ Call func with each of the machines named, several at once,
+    logging any that fail. Returns the machines it succeeded for, and the
+    number it failed for. """
+    vms = hypervisor.find(args.names)
+    names = ", ".join("'%s'" % vm.instance_id for vm in vms)
+    logging.info("Attempting to %s %s machine%s %s" % (message, hypervisor, "s" if len(vms) > 1 else "", names))
+    succeeded = []
+    for vm, (result, error) in zip(vms, parallel(func, vms, args.workers)):
+        if error is None:
+            succeeded.append(vm)
+        else:
+            logging.error("Could not %s %s: %s" % (message, vm.instance_id, error))
+    return succeeded, len(vms) - len(succeeded)
+
+
+def bulk_query(hypervisor, vms):
+    """ Return a function that asks the hypervisor for the ip addresses of
+    several machines at once, for wait_all, or None if that would not save
+    anything over asking, or waiting on, each machine. """
+    if not hypervisor.query_ips or len(vms) < 2:
+        return None
+
+    def query(pending):
+        states = hypervisor.query([vm.instance_id for vm in pending])
+        return dict((vm, states.get(vm.instance_id, {}).get("ip")) for vm in pending)
+    return query
+
+
+def wait_for(hypervisor, vms, timeout=0):
+    """ Wait for all the machines to start, printing the ip address of
+    each as soon as it is running. Returns the number that timed out. """
+    failed = 0
+    for vm, ip in wait_all(vms, timeout, bulk_query(hypervisor, vms)):
+        if ip is None:
+            logging.error("Timed out waiting for %s" % vm.instance_id)
+            failed += 1
+        elif len(vms) > 1:
+            print vm.instance_id, ip
+        else:
+            logging.info("Machine is running")
+            print ip
+    return failed
 
 
 def start(args):
     hypervisor = make_hypervisor(args)
-    logging.info("Attempting to start %s machine '%s'" % (hypervisor, args.name))
-    vm = hypervisor.load(args.name)
-    vm.start(gui=args.gui)
+    vms, failed = run_all(args, hypervisor, lambda vm: vm.start(gui=args.gui), "start")
     logging.info("Machine starting.")
     if args.wait:
         logging.info("Waiting for startup to complete...")
-        vm.wait(0)
-        logging.info("Machine is running")
+        failed += wait_for(hypervisor, vms)
+    if failed:
+        raise SystemExit(1)
 
 
 def stop(args):
-    hypervisor = make_hypervisor(args)
-    logging.info("Attempting to stop %s machine '%s'" % (hypervisor, args.name))
-    vm = hypervisor.load(args.name)
-    vm.stop(force=args.force)
+    vms, failed = run_all(args, make_hypervisor(args), lambda vm: vm.stop(force=args.force), "stop")
     logging.info("Machine stopping")
+    if failed:
+        raise SystemExit(1)
 
 
 def destroy(args):
@@ -221,16 +297,56 @@ def cleanup(args):
 
 def ip(args):
     hypervisor = make_hypervisor(args)
-    vm = hypervisor.load(args.name)
-    print vm.get_ip()
+    vms = hypervisor.find(args.names)
+    query = bulk_query(hypervisor, vms)
+    if query is not None:
+        ips = query(vms)
+        results = [(ips[vm], None) for vm in vms]
+    else:
+        results = parallel(lambda vm: vm.get_ip(), vms, args.workers)
+    failed = 0
+    for vm, (address, error) in zip(vms, results):
+        if error is not None:
+            logging.error("Could not get the ip address of %s: %s" % (vm.instance_id, error))
+            failed += 1
+        elif len(vms) == 1:
+            print address
+        else:
+            print vm.instance_id, address
+    if failed:
+        raise SystemExit(1)
+
+
+def list_(args):
+    hypervisor = make_hypervisor(args)
+    entries = hypervisor.list(args.refresh)
+    if args.names:
+        entries = [e for e in entries if any(fnmatch.fnmatch(e["name"], p) for p in args.names)]
+    if args.json:
+        print json.dumps(entries, indent=2, sort_keys=True)
+        return
+    rows = [("NAME", "STATE", "IP", "DISTRO", "RELEASE", "ARCH", "DISK", "CREATED")]
+    for e in entries:
+        rows.append((
+            e["name"],
+            e["state"],
+            e["ip"] or "-",
+            e["distro"] or "-",
+            e["release"] or "-",
+            e["arch"] or "-",
+            format_size(e["disk_size"]) if e["disk_size"] is not None else "-",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(e["created"])),
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
 
 
 def wait(args):
     hypervisor = make_hypervisor(args)
-    vm = hypervisor.load(args.name)
-    vm.wait(0)
-    logging.info("Machine is running")
-    print vm.get_ip()
+    vms = hypervisor.find(args.names)
+    if wait_for(hypervisor, vms, args.timeout):
+        raise SystemExit(1)
 
 
 def path(args):
@@ -249,6 +365,64 @@ def net_show(args):
     logging.info(str(network))
 
 
+def images(args):
+    args.sub_func(args)
+
+
+def make_image_store(args):
+    return ImageStore(make_hypervisor(args).image_dir)
+
+
+def images_list(args):
+    store = make_image_store(args)
+    for digest, entry in sorted(store.entries.items(), key=lambda x: x[1]["last_used"], reverse=True):
+        flags = []
+        if entry["pinned"]:
+            flags.append("pinned")
+        references = len(store.references(digest))
+        if references:
+            flags.append("%d instance%s" % (references, "s" if references != 1 else ""))
+        names = ", ".join(os.path.basename(n) for n in entry["names"])
+        print "%s %8s %s %s %s" % (digest[:12], format_size(store.entry_size(entry)),
+                                   time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"])),
+                                   names, " ".join(flags))
+    limit = "no limit" if store.max_size is None else "limit %s" % format_size(store.max_size)
+    print "Total %s, %s" % (format_size(store.total_size()), limit)
+
+
+def images_prune(args):
+    store = make_image_store(args)
+    max_size = parse_size(args.max_size) if args.max_size is not None else None
+    max_age = args.max_age * 86400 if args.max_age is not None else None
+    evicted = store.prune(max_size=max_size, max_age=max_age, policy=args.policy)
+    logging.info("Evicted %d image%s" % (len(evicted), "s" if len(evicted) != 1 else ""))
+    seeds = make_hypervisor(args).seed_cache.prune()
+    logging.info("Removed %d unused seed%s" % (seeds, "s" if seeds != 1 else ""))
+
+
+def pin_image(args, pinned):
+    try:
+        return make_image_store(args).pin(args.image, pinned)
+    except KeyError as e:
+        logging.error(e.args[0])
+        raise SystemExit(1)
+
+
+def images_pin(args):
+    logging.info("Pinned image %s" % pin_image(args, True))
+
+
+def images_unpin(args):
+    logging.info("Unpinned image %s" % pin_image(args, False))
+
+
+def images_limit(args):
+    store = make_image_store(args)
+    with store.transaction():
+        store.max_size = parse_size(args.size) if args.size != "none" else None
+    store.prune()
+
+
 def main():
 
     default_username = os.environ.get('LOGNAME', os.environ.get('USER', 'hyperkit'))
@@ -259,6 +433,12 @@ def main():
     parser.add_argument("-d", "--debug", default=False, action="store_true", help="produce lots of output")
     parser.add_argument("-H", "--hypervisor", help="The name of the hypervisor layer to use", choices=["vmware", "vbox"], default=())
     parser.add_argument("-D", "--directory", default=None, help="The directory the VM resides in, if different from the hypervisor default")
+    parser.add_argument("--command-path", action="append", default=[], metavar="NAME=PATH", help="use the binary at PATH for the command NAME, such as VBoxManage=/opt/vbox/VBoxManage")
+    parser.add_argument("--vmrun-hosttype", choices=VMRun.default_hosttypes, default=None, help="the VMware product vmrun drives, if it should not be detected")
+    parser.add_argument("--command-timeout", type=float, default=None, help="kill any hypervisor command still running after this many seconds; with --vbox-api only starting, stopping and deleting machines time out")
+    parser.add_argument("--vbox-api", default=False, action="store_true", help="drive VirtualBox through its API, if vboxapi is installed, rather than running VBoxManage")
+    parser.add_argument("--trace", default=None, metavar="FILE", help="record the time taken by each hypervisor command and phase of creation to FILE")
+    parser.add_argument("--trace-format", choices=["jsonl", "chrome"], default="jsonl", help="write the trace as JSON lines, or as a chrome://tracing file")
     sub = parser.add_subparsers()
 
     create_parser = sub.add_parser("create", help="Create a new virtual machine")
@@ -275,16 +455,21 @@ def main():
     create_parser.add_argument("--image", help="A file path or url to an image to use instead of the distro's default")
     create_parser.add_argument("--options", help="hypervisor specific options to pass to the new VM")
     create_parser.add_argument("--force-cache", default=False, action="store_true", help="do not try to download a new distro image")
+    create_parser.add_argument("--linked", default=False, action="store_true", help="create the disk as changes on top of a shared base image, rather than a full copy")
+    create_parser.add_argument("--count", type=int, default=1, help="create this many machines, named after the first with a numeric suffix")
+    create_parser.add_argument("--workers", type=int, default=4, help="the number of machines to build at once when creating several")
     create_parser.set_defaults(func=create)
 
     start_parser = sub.add_parser("start", help="Start a named virtual machine")
-    start_parser.add_argument("name", help="The name of the virtual machine as passed to create")
+    start_parser.add_argument("names", nargs="+", help="The names of the virtual machines as passed to create, or glob patterns such as 'test-*'")
+    start_parser.add_argument("--workers", type=int, default=8, help="the number of machines to start at once")
     start_parser.add_argument("--wait", action="store_true", default=False, help="Wait for the machine to start before returning")
     start_parser.add_argument("--gui", action="store_true", default=False, help="Activate the GUI")
     start_parser.set_defaults(func=start)
 
     stop_parser = sub.add_parser("stop", help="Stop a named virtual machine")
-    stop_parser.add_argument("name", help="The name of the virtual machine as passed to create")
+    stop_parser.add_argument("names", nargs="+", help="The names of the virtual machines as passed to create, or glob patterns such as 'test-*'")
+    stop_parser.add_argument("--workers", type=int, default=8, help="the number of machines to stop at once")
     stop_parser.add_argument("--force", action="store_true", default=False, help="Force a power off")
     stop_parser.set_defaults(func=stop)
 
@@ -298,11 +483,19 @@ def main():
     cleanup_parser.set_defaults(func=cleanup)
 
     ip_parser = sub.add_parser("ip", help="Print the IP address of the virtual machine, if available")
-    ip_parser.add_argument("name", help="The name of the virtual machine as passed to create")
+    ip_parser.add_argument("names", nargs="+", help="The names of the virtual machines as passed to create, or glob patterns such as 'test-*'")
+    ip_parser.add_argument("--workers", type=int, default=8, help="the number of machines to query at once")
     ip_parser.set_defaults(func=ip)
 
+    list_parser = sub.add_parser("list", help="List the virtual machines, with their last known state and ip address")
+    list_parser.add_argument("names", nargs="*", help="Only list the machines matching these names or glob patterns")
+    list_parser.add_argument("--refresh", action="store_true", default=False, help="ask the hypervisor for the current state of the machines, where it can report on them all at once")
+    list_parser.add_argument("--json", action="store_true", default=False, help="print the inventory entries as JSON")
+    list_parser.set_defaults(func=list_)
+
     wait_parser = sub.add_parser("wait", help="Wait until the virtual machine starts")
-    wait_parser.add_argument("name", help="The name of the virtual machine as passed to create")
+    wait_parser.add_argument("names", nargs="+", help="The names of the virtual machines as passed to create, or glob patterns such as 'test-*'")
+    wait_parser.add_argument("--timeout", type=int, default=0, help="give up waiting after this many seconds, by default wait forever")
     wait_parser.set_defaults(func=wait)
 
     path_parser = sub.add_parser("path", help="Print the path to the VM")
@@ -316,6 +509,31 @@ def main():
     net_show_parser = netsub.add_parser("show", help="Show the network configurations that will be used for virtual machines")
     net_show_parser.set_defaults(sub_func=net_show)
 
+    images_parser = sub.add_parser("images", help="Manage the store of downloaded images")
+    images_parser.set_defaults(func=images)
+    imagessub = images_parser.add_subparsers()
+
+    images_list_parser = imagessub.add_parser("list", help="List the stored images")
+    images_list_parser.set_defaults(sub_func=images_list)
+
+    images_prune_parser = imagessub.add_parser("prune", help="Evict images not pinned or used by an existing virtual machine, and unused seed images")
+    images_prune_parser.add_argument("--max-size", default=None, help="Evict images until the store is no larger than this, for example 20G")
+    images_prune_parser.add_argument("--max-age", type=int, default=None, help="Evict images older than this many days")
+    images_prune_parser.add_argument("--policy", choices=["lru", "age"], default="lru", help="Measure age from when an image was last used (lru) or added (age)")
+    images_prune_parser.set_defaults(sub_func=images_prune)
+
+    images_pin_parser = imagessub.add_parser("pin", help="Never evict an image")
+    images_pin_parser.add_argument("image", help="The digest, or name, of the image")
+    images_pin_parser.set_defaults(sub_func=images_pin)
+
+    images_unpin_parser = imagessub.add_parser("unpin", help="Allow an image to be evicted")
+    images_unpin_parser.add_argument("image", help="The digest, or name, of the image")
+    images_unpin_parser.set_defaults(sub_func=images_unpin)
+
+    images_limit_parser = imagessub.add_parser("limit", help="Set the maximum size of the store, enforced on every create")
+    images_limit_parser.add_argument("size", help="The maximum size, for example 20G, or none")
+    images_limit_parser.set_defaults(sub_func=images_limit)
+
     test_parser(sub)
 
     args = parser.parse_args()
@@ -324,7 +542,29 @@ def main():
         logger.setLevel(logging.DEBUG)
     if args.quiet:
         logger.setLevel(logging.ERROR)
+    VMRun.override = args.vmrun_hosttype
+    VBoxSession.enabled = args.vbox_api
+    Command.timeout = args.command_timeout
+    for option in args.command_path:
+        name, sep, pathname = option.partition("=")
+        if not sep:
+            parser.error("--command-path must be of the form NAME=PATH")
+        try:
+            registry.pin(name, os.path.expanduser(pathname))
+        except OSError as e:
+            parser.error(str(e))
+    sink = None
+    if args.trace is not None:
+        sink = trace.TraceFile(args.trace, args.trace_format)
+        trace.add_sink(sink)
     try:
         args.func(args)
     except MachineDoesNotExist:
         logging.error("Specified virtual machine does not exist")
+    except CommandTimeout as e:
+        logging.error(str(e))
+        raise SystemExit(1)
+    finally:
+        if sink is not None:
+            trace.remove_sink(sink)
+            sink.close()
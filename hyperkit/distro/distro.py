@@ -19,6 +19,9 @@ import urllib2
 import logging
 
 from hyperkit.spec import image
+from hyperkit.hashing import file_digest, hash_name
+from hyperkit.sidecar import Sidecar
+from hyperkit.download import SegmentedDownload
 from hyperkit.error import FetchFailedException
 
 logger = logging.getLogger(__name__)
@@ -61,19 +64,12 @@ class DistroImage(image.BaseDistroImage):
         file, return the hash of the virtual machine image """
 
     def fetch(self):
-        """ Fetch the remote image to the local pathname. """
-        remote_url = self.remote_image_url()
-        logger.info("Retrieving {0} to {1}".format(remote_url, self.pathname))
-        try:
-            response = urllib2.urlopen(remote_url)
-        except urllib2.HTTPError:
-            raise FetchFailedException("Unable to fetch {0}".format(remote_url))
-        local = open(self.pathname, "w")
-        while True:
-            data = response.read(self.blocksize)
-            if not data:
-                break
-            local.write(data)
+        """ Fetch the remote image to the local pathname. If there is no
+        remote hash to check the local image against, the image is only
+        fetched if the server reports it has changed. """
+        download = SegmentedDownload(self.remote_image_url(), self.pathname, [self.hash_function])
+        download.blocksize = self.blocksize
+        download.fetch(conditional=self.remote_hash is None)
 
     def decode_hashes(self, data):
         """ Parse the hash file data provided and return a dictionary of hash values keyed on filenames.
@@ -101,11 +97,18 @@ class DistroImage(image.BaseDistroImage):
         return self.decode_hashes(response.read())
 
     def get_local_sum(self):
-        """ Calculate the sum for the local downloaded image. """
-        h = self.hash_function()
+        """ Calculate the sum for the local downloaded image. The sum is
+        stored in a sidecar file, and only recalculated if the image has
+        changed since. """
         if os.path.exists(self.pathname):
-            h.update(open(self.pathname).read())
-            return h.hexdigest()
+            sidecar = Sidecar(self.pathname)
+            digests = sidecar.setdefault("digests", {})
+            name = hash_name(self.hash_function)
+            if name not in digests:
+                logger.debug("Calculating {0} sum of {1}".format(name, self.pathname))
+                digests[name] = file_digest(self.pathname, self.hash_function)
+                sidecar.save()
+            return digests[name]
 
     def update_hashes(self):
         """ Fetch the remote and local hashes. The remote hash is presumed
@@ -132,10 +135,10 @@ class DistroImage(image.BaseDistroImage):
         self.update_hashes()
         if self.requires_update():
             self.fetch()
-        self.update_hashes()
-        if self.requires_update():
-            logger.error("Local image sum {0} does not match remote {1} after fetch.".format(self.local_hash, self.remote_hash))
-            raise FetchFailedException("Local image missing or wrong after fetch")
+            self.update_hashes()
+            if self.requires_update():
+                logger.error("Local image sum {0} does not match remote {1} after fetch.".format(self.local_hash, self.remote_hash))
+                raise FetchFailedException("Local image missing or wrong after fetch")
 
 
 class StandardDistroImage(DistroImage):
@@ -0,0 +1,337 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import Queue
+import urllib2
+import logging
+import threading
+
+from hyperkit.hashing import MultiHasher, hash_name
+from hyperkit.sidecar import Sidecar
+from hyperkit.error import FetchFailedException
+
+logger = logging.getLogger(__name__)
+
+
+class HeadRequest(urllib2.Request):
+
+    def get_method(self):
+        return "HEAD"
+
+
+class Download(object):
+
+    """ Fetches a remote resource to a local pathname.
+
+    The validators (ETag and Last-Modified) sent by the server are stored in
+    the sidecar of the local file, and are used to make the request
+    conditional next time, so an unchanged resource is not transferred
+    again. Data is written to a partial file alongside the destination,
+    which is renamed into place once complete. If a transfer is interrupted
+    the partial file is kept, and the next fetch resumes it with a Range
+    request, provided the server still has the same version.
+
+    The time the local file was last confirmed current is stored in the
+    sidecar as checked. """
+
+    # size of blocks fetched from remote resources
+    blocksize = 81920
+
+    part_suffix = ".part"
+
+    def __init__(self, url, pathname, hash_functions=()):
+        self.url = url
+        self.pathname = pathname
+        self.hash_functions = hash_functions
+
+    @property
+    def part_pathname(self):
+        return self.pathname + self.part_suffix
+
+    def validators(self, sidecar):
+        """ Return the validators stored in the sidecar as a dictionary of
+        request headers. """
+        headers = {}
+        if sidecar.get("etag"):
+            headers["If-None-Match"] = sidecar["etag"]
+        if sidecar.get("last_modified"):
+            headers["If-Modified-Since"] = sidecar["last_modified"]
+        return headers
+
+    def build_request(self, conditional):
+        request = urllib2.Request(self.url)
+        if conditional:
+            for k, v in self.validators(Sidecar(self.pathname)).items():
+                request.add_header(k, v)
+        offset = self.resume_offset()
+        if offset:
+            part = Sidecar(self.part_pathname)
+            request.add_header("Range", "bytes={0}-".format(offset))
+            request.add_header("If-Range", part.get("etag") or part["last_modified"])
+        return request, offset
+
+    def resume_offset(self):
+        """ Return the number of bytes already fetched in a resumable
+        partial file, or 0 if the transfer must start from the beginning. """
+        part = Sidecar(self.part_pathname)
+        if not (part.get("etag") or part.get("last_modified")):
+            return 0
+        return os.path.getsize(self.part_pathname)
+
+    def discard_part(self):
+        Sidecar(self.part_pathname).discard()
+        if os.path.exists(self.part_pathname):
+            os.unlink(self.part_pathname)
+
+    def open(self, conditional):
+        request, offset = self.build_request(conditional)
+        try:
+            return urllib2.urlopen(request), offset
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return None, 0
+            if e.code == 416 and offset:
+                logger.debug("Unable to resume {0}, starting again".format(self.url))
+                self.discard_part()
+                return self.open(conditional)
+            raise FetchFailedException("Unable to fetch {0}".format(self.url))
+        except urllib2.URLError as e:
+            raise FetchFailedException("Unable to fetch {0}: {1}".format(self.url, e.reason))
+
+    def fetch(self, conditional=True):
+        """ Fetch the resource, returning True if the local file was
+        replaced or False if the server reports it has not changed. If
+        conditional is False the resource is fetched even if the stored
+        validators show the local file is current. """
+        response, offset = self.open(conditional)
+        if response is None:
+            logger.info("{0} has not changed".format(self.url))
+            self.not_modified()
+            return False
+        if response.getcode() != 206:
+            offset = 0
+        hasher = MultiHasher(*self.hash_functions)
+        if offset:
+            logger.info("Resuming {0} at byte {1}".format(self.url, offset))
+            local = open(self.part_pathname, "r+b")
+            hasher.update_from_file(local)
+        else:
+            logger.info("Retrieving {0} to {1}".format(self.url, self.pathname))
+            local = open(self.part_pathname, "wb")
+        headers = response.info()
+        validators = {
+            "etag": headers.getheader("ETag"),
+            "last_modified": headers.getheader("Last-Modified"),
+        }
+        expected = headers.getheader("Content-Length")
+        received = 0
+        try:
+            while True:
+                data = response.read(self.blocksize)
+                if not data:
+                    break
+                local.write(data)
+                hasher.update(data)
+                received += len(data)
+        finally:
+            local.close()
+            part = Sidecar(self.part_pathname)
+            part.update(validators)
+            part.save()
+        if expected is not None and received != int(expected):
+            raise FetchFailedException("Transfer of {0} interrupted after {1} of {2} bytes".format(self.url, received, expected))
+        self.complete(validators, hasher)
+        return True
+
+    def complete(self, validators, hasher):
+        """ Move the completed partial file into place, and record the
+        validators and sums for the new file. """
+        os.rename(self.part_pathname, self.pathname)
+        Sidecar(self.part_pathname).discard()
+        sidecar = Sidecar(self.pathname)
+        sidecar.update(validators)
+        names = [hash_name(f) for f in self.hash_functions]
+        sidecar["digests"] = dict(zip(names, hasher.hexdigests()))
+        sidecar["checked"] = time.time()
+        sidecar.save()
+
+    def not_modified(self):
+        """ Record that the server confirmed the local file is current. """
+        sidecar = Sidecar(self.pathname)
+        sidecar["checked"] = time.time()
+        sidecar.save()
+
+
+class SegmentedDownload(Download):
+
+    """ Fetches a large resource over several connections at once, each
+    fetching a range of bytes into its place in a preallocated partial file.
+    The sums are calculated as each run of segments from the start of the
+    file lands, so they are ready as soon as the last segment is.
+
+    Servers that do not advertise support for range requests, and resources
+    too small to be worth splitting, are fetched with a single stream. """
+
+    # number of simultaneous connections to the server
+    connections = 4
+
+    # size of the byte ranges fetched by each request
+    segment_size = 16 * 1024 * 1024
+
+    def probe(self, conditional):
+        """ Return the headers for the resource, or None if the server
+        reports it has not changed. """
+        request = HeadRequest(self.url)
+        if conditional:
+            for k, v in self.validators(Sidecar(self.pathname)).items():
+                request.add_header(k, v)
+        try:
+            return urllib2.urlopen(request).info()
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise FetchFailedException("Unable to fetch {0}".format(self.url))
+        except urllib2.URLError as e:
+            raise FetchFailedException("Unable to fetch {0}: {1}".format(self.url, e.reason))
+
+    def segments(self, size):
+        return [(start, min(start + self.segment_size, size)) for start in range(0, size, self.segment_size)]
+
+    def fetch(self, conditional=True):
+        headers = self.probe(conditional)
+        if headers is None:
+            logger.info("{0} has not changed".format(self.url))
+            self.not_modified()
+            return False
+        size = headers.getheader("Content-Length")
+        if headers.getheader("Accept-Ranges") != "bytes" or size is None or int(size) < 2 * self.segment_size:
+            return super(SegmentedDownload, self).fetch(conditional)
+        validators = {
+            "etag": headers.getheader("ETag"),
+            "last_modified": headers.getheader("Last-Modified"),
+        }
+        logger.info("Retrieving {0} to {1} over {2} connections".format(self.url, self.pathname, self.connections))
+        self.discard_part()
+        try:
+            hasher = self.fetch_segments(int(size), validators)
+        except BaseException:
+            # a partly fetched segmented file has holes, so cannot be resumed
+            self.discard_part()
+            raise
+        self.complete(validators, hasher)
+        return True
+
+    def if_range(self, validators):
+        """ Return a validator that will make the server refuse a range
+        request if the resource changes mid-transfer. Weak ETags are not
+        allowed in If-Range. """
+        etag = validators["etag"]
+        if etag and not etag.startswith("W/"):
+            return etag
+        return validators["last_modified"]
+
+    def fetch_segment(self, start, end, if_range):
+        """ Fetch the bytes from start up to end into the partial file. """
+        request = urllib2.Request(self.url)
+        request.add_header("Range", "bytes={0}-{1}".format(start, end - 1))
+        if if_range:
+            request.add_header("If-Range", if_range)
+        response = urllib2.urlopen(request)
+        if response.getcode() != 206:
+            raise FetchFailedException("{0} changed during transfer".format(self.url))
+        local = open(self.part_pathname, "r+b")
+        try:
+            local.seek(start)
+            remaining = end - start
+            while remaining:
+                data = response.read(min(self.blocksize, remaining))
+                if not data:
+                    raise FetchFailedException("Transfer of {0} interrupted at byte {1}".format(self.url, end - remaining))
+                local.write(data)
+                remaining -= len(data)
+        finally:
+            local.close()
+
+    def fetch_segments(self, size, validators):
+        """ Fetch every segment of the resource into a partial file of the
+        given size, and return a hasher fed with its contents. """
+        local = open(self.part_pathname, "wb")
+        local.truncate(size)
+        local.close()
+
+        segments = self.segments(size)
+        if_range = self.if_range(validators)
+        pending = Queue.Queue()
+        for i in range(len(segments)):
+            pending.put(i)
+        landed = set()
+        failures = []
+        condition = threading.Condition()
+
+        def worker():
+            while not failures:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.fetch_segment(segments[i][0], segments[i][1], if_range)
+                except Exception as e:
+                    # anything a worker does not record would leave the
+                    # reader waiting forever for its segment
+                    with condition:
+                        failures.append(e)
+                        condition.notify()
+                    return
+                with condition:
+                    landed.add(i)
+                    condition.notify()
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.connections, len(segments)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        hasher = MultiHasher(*self.hash_functions)
+        # unbuffered, so no stale read-ahead of segments yet to land is kept
+        reader = open(self.part_pathname, "rb", 0)
+        try:
+            for i, (start, end) in enumerate(segments):
+                with condition:
+                    while i not in landed and not failures:
+                        condition.wait(1)
+                if failures:
+                    break
+                reader.seek(start)
+                remaining = end - start
+                while remaining:
+                    data = reader.read(min(hasher.blocksize, remaining))
+                    hasher.update(data)
+                    remaining -= len(data)
+        finally:
+            reader.close()
+            for t in threads:
+                t.join()
+
+        if failures:
+            e = failures[0]
+            if isinstance(e, FetchFailedException):
+                raise e
+            raise FetchFailedException("Unable to fetch {0}: {1}".format(self.url, e))
+        return hasher
+
+__all__ = [Download, SegmentedDownload]
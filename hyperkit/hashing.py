@@ -0,0 +1,78 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from hyperkit import trace
+
+
+class MultiHasher(object):
+
+    """ Feeds the same stream of data to several hash functions at once, so
+    a file only has to be read a single time however many sums are wanted.
+    Files are read in fixed size blocks, so memory use stays flat regardless
+    of the size of the image. """
+
+    # size of blocks read from local files
+    blocksize = 1024 * 1024
+
+    def __init__(self, *hash_functions):
+        self.hashes = [f() for f in hash_functions]
+
+    def update(self, data):
+        for h in self.hashes:
+            h.update(data)
+
+    def update_from_file(self, f):
+        """ Read the open file f to the end, feeding every block read to
+        the hashes. Returns the number of bytes read. """
+        total = 0
+        while True:
+            data = f.read(self.blocksize)
+            if not data:
+                break
+            self.update(data)
+            total += len(data)
+        return total
+
+    def hash_file(self, pathname):
+        f = open(pathname, "rb")
+        try:
+            return self.update_from_file(f)
+        finally:
+            f.close()
+
+    def hexdigests(self):
+        return [h.hexdigest() for h in self.hashes]
+
+
+def hash_name(hash_function):
+    """ Return the canonical name of the hash function, such as sha256,
+    for use as a key when storing sums. """
+    return hash_function().name.lower()
+
+
+def file_digests(pathname, *hash_functions):
+    """ Return the hex digests of the file at pathname for each of the hash
+    functions, in order, reading the file only once. """
+    hasher = MultiHasher(*hash_functions)
+    with trace.span("hash", pathname=pathname) as info:
+        info["bytes"] = hasher.hash_file(pathname)
+    return hasher.hexdigests()
+
+
+def file_digest(pathname, hash_function):
+    """ Return the hex digest of the file at pathname. """
+    return file_digests(pathname, hash_function)[0]
+
+__all__ = [MultiHasher, hash_name, file_digests, file_digest]
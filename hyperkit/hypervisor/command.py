@@ -14,17 +14,133 @@
 # limitations under the License.
 
 import os
+import re
+import sys
+import time
+import errno
+import signal
 import logging
 import itertools
+import threading
+import contextlib
 import subprocess
 
+from hyperkit import trace
+
 logger = logging.getLogger(__name__)
 
 
 class CommandException(Exception):
+
+    def __init__(self, message, stderr=""):
+        super(CommandException, self).__init__(message)
+        self.stderr = stderr
+
+
+class CommandTimeout(CommandException):
     pass
 
 
+def stat_key(pathname):
+    try:
+        st = os.stat(pathname)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+class Registry(object):
+
+    """ Records, for the whole process, where the binary for each command
+    was found, so the search of the known locations and $PATH is done once
+    rather than for every invocation. A resolved binary is only looked for
+    again if $PATH changes, or if running it fails and the file has changed
+    since it was found. Binaries can also be pinned to explicit paths. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget every resolved and pinned binary. """
+        with self.lock:
+            self.pinned = {}
+            self.resolved = {}
+
+    def pin(self, command_name, pathname):
+        """ Use the binary at pathname for the named command. """
+        if not (os.path.isfile(pathname) and os.access(pathname, os.X_OK)):
+            raise OSError("%r is not an executable file" % pathname)
+        with self.lock:
+            self.pinned[command_name] = pathname
+
+    def key(self, command):
+        return (command.command_name, tuple(command.known_locations), os.environ.get("PATH", ""))
+
+    def lookup(self, command):
+        """ Return the pathname of the binary for command. """
+        with self.lock:
+            if command.command_name in self.pinned:
+                return self.pinned[command.command_name]
+            key = self.key(command)
+            if key not in self.resolved:
+                pathname = command.find()
+                self.resolved[key] = (pathname, stat_key(pathname))
+            return self.resolved[key][0]
+
+    def forget(self, command):
+        """ Called when running the binary for command failed. Forgets it if
+        the file has changed since it was found, returning True if so. """
+        with self.lock:
+            key = self.key(command)
+            if key in self.resolved:
+                pathname, stat = self.resolved[key]
+                if stat_key(pathname) != stat:
+                    logger.debug("{0} has changed, looking for {1} again".format(pathname, command.command_name))
+                    del self.resolved[key]
+                    return True
+            return False
+
+
+registry = Registry()
+
+
+class Execution(object):
+
+    """ A call made in a background thread, such as a command submitted
+    with Command.submit. """
+
+    def __init__(self, func, *args, **kwargs):
+        self.output = None
+        self.exc_info = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(func, args, kwargs))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, func, args, kwargs):
+        try:
+            self.output = func(*args, **kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def result(self, timeout=None):
+        """ Wait for the call to finish, for at most timeout seconds, and
+        return its output, or raise the exception it raised. """
+        if not self.done.wait(timeout):
+            raise CommandTimeout("Still running after {0} seconds".format(timeout))
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.output
+
+
+# limits the processes running at once for each binary
+semaphores = {}
+semaphores_lock = threading.Lock()
+
+
 class Command(object):
 
     known_locations = ()
@@ -34,8 +150,32 @@ class Command(object):
     log_stdout = True
     log_stderr = True
 
+    # the most processes of this command to run at once, or None for no limit
+    concurrency = None
+
+    # seconds each subcommand may run before it is killed, for subcommands
+    # not in timeouts, or None to wait forever. A call can pass its own
+    # command_timeout instead.
+    timeout = None
+    timeouts = {}
+
+    # how long a killed command has to exit before it is killed outright
+    kill_grace = 5
+
+    # patterns matching the error output of failures that are worth
+    # retrying, such as contention for a lock, the subcommands they may be
+    # retried for, or None for all, and how often to retry them
+    transient_errors = ()
+    transient_subcommands = None
+    retries = 3
+    retry_delay = 1
+
     @property
     def pathname(self):
+        return registry.lookup(self)
+
+    def find(self):
+        """ Search the known locations and $PATH for the binary. """
         candidates = itertools.chain(self.known_locations, os.environ['PATH'].split(":"))
         for loc in candidates:
             pathname = os.path.join(loc, self.command_name)
@@ -53,28 +193,127 @@ class Command(object):
     def parse(self, stdout, stderr):
         return stdout.strip()
 
-    def execute(self, command, cwd):
+    def stream(self, f, name, log, lines):
+        """ Read the output f line by line as the command writes it, logging
+        each line straight away. """
+        for line in iter(f.readline, ""):
+            lines.append(line)
+            if log:
+                logger.debug("{0}: {1}".format(name, line.rstrip("\n")))
+        f.close()
+
+    def kill(self, p):
+        """ Terminate the process group of p, which includes any processes
+        the command started, then kill it if it is still running after the
+        grace period. """
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+            deadline = time.time() + self.kill_grace
+            while p.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if p.poll() is None:
+                os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            # it has already exited
+            pass
+
+    def execute(self, command, cwd, timeout=None, subcommand=None):
+        name = self.command_name if subcommand is None else "{0} {1}".format(self.command_name, subcommand)
+        with trace.span(name, "command", argv=command) as info:
+            return self.traced_execute(command, cwd, timeout, info)
+
+    def traced_execute(self, command, cwd, timeout, info):
+        # in a process group of its own, so it can be killed with everything
+        # it starts
         p = subprocess.Popen(args=command,
                              stdin=None,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE,
-                             cwd=cwd)
+                             cwd=cwd,
+                             preexec_fn=os.setsid)
         if self.log_execution:
-            logger.debug("Executing: {0}".format(" ".join(command)))
-        stdout, stderr = p.communicate()
-        if (self.log_stdout and stdout) or (self.log_stderr and stderr):
-            logger.debug("Output from {0}".format(" ".join(command)))
-        if self.log_stdout and stdout:
-            for line in stdout.splitlines():
-                logger.debug("STDOUT: {0}".format(line))
-        if self.log_stderr and stderr:
-            for line in stderr.splitlines():
-                logger.debug("STDERR: {0}".format(line))
+            logger.debug("Executing [{0}]: {1}".format(p.pid, " ".join(command)))
+        timer = None
+        timed_out = threading.Event()
+        if timeout is not None:
+            def expire():
+                timed_out.set()
+                self.kill(p)
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+        prefix = "{0}[{1}]".format(self.command_name, p.pid)
+        stdout, stderr = [], []
+        try:
+            reader = threading.Thread(target=self.stream, args=(p.stderr, prefix + " STDERR", self.log_stderr, stderr))
+            reader.start()
+            self.stream(p.stdout, prefix + " STDOUT", self.log_stdout, stdout)
+            reader.join()
+            p.wait()
+        except BaseException:
+            # such as KeyboardInterrupt, which the process group won't get
+            self.kill(p)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        stdout, stderr = "".join(stdout), "".join(stderr)
+        info.update(pid=p.pid, exit_code=p.returncode, stdout_bytes=len(stdout), stderr_bytes=len(stderr))
+        if timed_out.is_set() and p.returncode != 0:
+            raise CommandTimeout("Command {0} killed after {1} seconds".format(" ".join(command), timeout), stderr)
         if p.returncode != 0:
-            raise CommandException("Command execution of {0} failed with error code {1} and error output: {2}".format(" ".join(command), p.returncode, stderr))
+            raise CommandException("Command execution of {0} failed with error code {1} and error output: {2}".format(" ".join(command), p.returncode, stderr), stderr)
         return self.parse(stdout, stderr)
 
+    def is_transient(self, subcommand, error):
+        if self.transient_subcommands is not None and subcommand not in self.transient_subcommands:
+            return False
+        return any(re.search(pattern, error.stderr) for pattern in self.transient_errors)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ Wait until another process of this command may run. """
+        if self.concurrency is None:
+            yield
+            return
+        with semaphores_lock:
+            if self.command_name not in semaphores:
+                semaphores[self.command_name] = threading.Semaphore(self.concurrency)
+            semaphore = semaphores[self.command_name]
+        with semaphore:
+            yield
+
     def __call__(self, subcommand, *args, **kwargs):
         cwd = kwargs.pop("cwd", None)
-        command = self.compose(subcommand, *args, **kwargs)
-        return self.execute(command, cwd=cwd)
+        timeout = kwargs.pop("command_timeout", self.timeouts.get(subcommand, self.timeout))
+        attempt = 0
+        while True:
+            try:
+                return self.run(subcommand, args, kwargs, cwd, timeout)
+            except CommandTimeout:
+                raise
+            except CommandException as e:
+                if attempt >= self.retries or not self.is_transient(subcommand, e):
+                    raise
+                attempt += 1
+                logger.debug("{0} {1} failed transiently, retrying".format(self.command_name, subcommand))
+                time.sleep(self.retry_delay * attempt)
+
+    def run(self, subcommand, args, kwargs, cwd, timeout):
+        with self.slot():
+            command = self.compose(subcommand, *args, **kwargs)
+            try:
+                return self.execute(command, cwd, timeout, subcommand)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.EACCES, errno.ENOEXEC) or not registry.forget(self):
+                    raise
+                command = self.compose(subcommand, *args, **kwargs)
+                return self.execute(command, cwd, timeout, subcommand)
+
+    def submit(self, subcommand, *args, **kwargs):
+        """ Run the command in the background, returning an Execution whose
+        result() is the output. Any number of commands can be submitted at
+        once, but only concurrency processes of each run at a time. """
+        return Execution(self, subcommand, *args, **kwargs)
+
+__all__ = [CommandException, CommandTimeout, Registry, registry, Execution, Command]
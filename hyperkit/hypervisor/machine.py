@@ -14,11 +14,24 @@
 # limitations under the License.
 
 import abc
+import errno
 import time
 import os
+import copy
+import Queue
+import fnmatch
+import threading
+import shutil
+import logging
 import datetime
 
 from ..error import MachineDoesNotExist
+from ..store import ImageStore
+from ..cloudinit import SeedCache, load_secret
+from ..inventory import Inventory
+from .. import trace
+
+logger = logging.getLogger(__name__)
 
 
 class State:
@@ -27,6 +40,25 @@ class State:
     RUNNING = 2
 
 
+class lazy(object):
+
+    """ An attribute computed by the decorated method the first time it is
+    used, and then kept, so instances are cheap to create when the costly
+    parts of them, such as command backends and parsed configuration, are
+    never needed. The attribute can also be assigned to. """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+
 class MachineInstance(object):
 
     """ This is a local virtual machine, probably created originally by a MachineBuilder. """
@@ -36,6 +68,13 @@ class MachineInstance(object):
     system = None
     timeout = 30
 
+    # True if block() can wait for the guest to report its ip address
+    # without polling
+    blocking_wait = False
+
+    # the inventory to record changes of state in, if any
+    inventory = None
+
     def __init__(self, directory, instance_id):
         self.instance_dir = os.path.join(directory, instance_id)
         self.instance_id = instance_id
@@ -59,35 +98,201 @@ class MachineInstance(object):
     def get_ip(self):
         """ Return the ip address of the machine, or None if it is not yet running """
 
+    def block(self, timeout):
+        """ Block for at most timeout seconds until the guest's ip address
+        may have changed, returning True if notified of a change. Only
+        called if blocking_wait is True. """
+        raise NotImplementedError
+
     def path(self):
         return self.instance_dir
 
+    def record(self, **fields):
+        """ Record the state or ip address of the machine in the inventory.
+        The inventory is only an index, so failing to update it is not an
+        error. """
+        if self.inventory is None:
+            return
+        try:
+            self.inventory.update(self.instance_dir, **fields)
+        except (IOError, OSError):
+            logger.debug("Cannot update the inventory", exc_info=True)
+
     def start(self, gui=False):
         self._start(gui)
         self.state = State.STARTING
+        self.record(state="starting")
 
     def stop(self, force=False):
         self._stop(force=force)
         self.state = State.DEAD
+        self.record(state="stopped", ip=None)
 
     def destroy(self):
         self._destroy()
         self.state = State.DEAD
+        if self.inventory is not None:
+            self.inventory.remove(self.instance_dir)
+
+    def running(self, ip):
+        """ Called when the machine is found to be running. """
+        self.state = State.RUNNING
+        self.record(state="running", ip=ip)
 
     def wait(self, timeout=None):
         """ Call with a timeout of 0 to wait forever. """
-        if timeout is None:
-            timeout = self.timeout
+        for instance, ip in wait_all([self], timeout):
+            return ip is not None
+
+
+def backoff(initial=0.5, factor=1.5, maximum=10):
+    """ Generate the delays between polls. They start short, so a machine
+    that is ready quickly is noticed quickly, and grow to a maximum, so a
+    machine that is slow to start isn't polled hundreds of times. """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+def watch(instance, deadline, events, longest=30):
+    """ Wait for an instance that supports blocking waits to start, putting
+    the instance and its ip address, or None if the deadline passes first,
+    on the events queue. """
+    delays = backoff()
+    while True:
+        ip = instance.get_ip()
+        if ip:
+            break
+        remaining = longest if deadline is None else min(deadline - time.time(), longest)
+        if remaining <= 0:
+            break
         started = time.time()
+        if not instance.block(remaining) and time.time() - started < remaining:
+            # the wait failed, perhaps as the machine is not running yet
+            time.sleep(next(delays))
+    events.put((instance, ip))
+
+
+def wait_all(instances, timeout=None, query=None):
+    """ Wait for several instances to start. Instances that support
+    blocking waits are each watched by a thread, and the rest are checked
+    by a single poller, once a round with a growing delay between rounds.
+    Yields each instance with its ip address as soon as it is running, or
+    with None once its timeout has passed. A timeout of 0 waits forever,
+    and None uses the timeout of each instance.
+
+    If query is given every instance is polled with it instead. It is
+    called once a round with the instances still pending, and returns a
+    dict of their ip addresses, so a hypervisor that can report on many
+    machines at once is asked once a round rather than once a machine. """
+    started = time.time()
+    deadlines = {}
+    for instance in instances:
+        limit = instance.timeout if timeout is None else timeout
+        deadlines[instance] = started + limit if limit != 0 else None
+    events = Queue.Queue()
+    watched = [i for i in instances if i.blocking_wait and query is None]
+    for instance in watched:
+        t = threading.Thread(target=watch, args=(instance, deadlines[instance], events))
+        t.daemon = True
+        t.start()
+    pending = [i for i in instances if i not in watched]
+    delays = backoff()
+    while pending or watched:
+        ips = query(pending) if query is not None and pending else None
+        for instance in list(pending):
+            ip = ips.get(instance) if ips is not None else instance.get_ip()
+            deadline = deadlines[instance]
+            if ip:
+                instance.running(ip)
+                pending.remove(instance)
+                yield instance, ip
+            elif deadline is not None and time.time() > deadline:
+                pending.remove(instance)
+                yield instance, None
+        if not pending and not watched:
+            break
+        delay = next(delays)
+        soonest = [deadlines[i] for i in pending if deadlines[i] is not None]
+        if soonest:
+            # don't overshoot the deadline by much
+            delay = max(min(delay, min(soonest) - time.time() + 0.01), 0)
+        if watched:
+            try:
+                # with a timeout, so the wait can be interrupted
+                instance, ip = events.get(timeout=delay if pending else 60)
+            except Queue.Empty:
+                continue
+            watched.remove(instance)
+            if ip:
+                instance.running(ip)
+            yield instance, ip
+        else:
+            time.sleep(delay)
+
+
+def parallel(func, items, workers=4):
+    """ Call func with each of the items, from a pool of threads.
+    Returns a list of (result, exception) pairs in the order of the items,
+    so one failure does not stop the others. """
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    def worker():
         while True:
-            if self.get_ip():
-                self.state = State.RUNNING
-                return True
-            else:
-                time.sleep(1)
-            if timeout != 0:
-                if time.time() - started > timeout:
-                    return False
+            try:
+                i, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (func(item), None)
+            except Exception as e:
+                logger.debug("Failed on %s" % (item, ), exc_info=True)
+                results[i] = (None, e)
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def file_size(pathname):
+    """ The size of the file at pathname, or None if there isn't one. """
+    try:
+        return os.path.getsize(pathname)
+    except OSError:
+        return None
+
+
+class BuildResult(object):
+
+    """ The outcome of building an instance, with how long each phase of
+    building it took. """
+
+    def __init__(self, instance_id, spec):
+        self.instance_id = instance_id
+        self.spec = spec
+        self.instance = None
+        self.error = None
+        self.elapsed = None
+        self.phases = []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            "instance_id": self.instance_id,
+            "error": None if self.error is None else str(self.error),
+            "elapsed": self.elapsed,
+            "phases": [p.as_dict() for p in self.phases],
+        }
 
 
 class Hypervisor(object):
@@ -104,6 +309,16 @@ class Hypervisor(object):
     # the class that represents an instance
     instance = None
 
+    # the name of the hypervisor, as given to --hypervisor
+    hypervisor_id = None
+
+    # True if query reports the ip addresses of machines as well as whether
+    # they are running, more cheaply than asking each machine
+    query_ips = False
+
+    # the format of the disks of instances
+    disk_format = None
+
     # the directory that contains images
     image_dir = os.path.expanduser("~/.hyperkit")
 
@@ -114,10 +329,124 @@ class Hypervisor(object):
     def set_image_dir(self, image_dir):
         self.image_dir = os.path.expanduser(image_dir)
 
-    @abc.abstractmethod
-    def create(self, spec, force_cache=False, image_dir="~/.hyperkit"):
+    @lazy
+    def inventory(self):
+        """ The index of the machines, shared by both hypervisors. """
+        return Inventory(self.image_dir)
+
+    def record_created(self, instance_id, spec):
+        try:
+            self.inventory.created(os.path.join(self.directory, instance_id), self.hypervisor_id, spec)
+        except (IOError, OSError):
+            logger.debug("Cannot update the inventory", exc_info=True)
+
+    @property
+    def seed_cache(self):
+        """ The cache of seed images, shared by machines with the same cloud
+        config and meta data. """
+        return SeedCache(os.path.join(self.image_dir, "seeds"))
+
+    @property
+    def secret(self):
+        """ The random secret of this host, from which password salts are
+        derived so seeds render the same for the same spec. """
+        if not os.path.exists(self.image_dir):
+            try:
+                os.makedirs(self.image_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return load_secret(os.path.join(self.image_dir, "secret"))
+
+    def create(self, spec, force_cache=False, linked=False):
         """ Builds the instance based on the spec, loading images from
-        image_dir. Return the instance, for example with self.load(name) """
+        image_dir. If linked is True the disk of the instance is linked to a
+        shared base image rather than a full copy of it. Return the
+        instance. """
+        return self.create_result(spec, force_cache, linked).instance
+
+    def create_result(self, spec, force_cache=False, linked=False):
+        """ Create an instance as create does, but return a BuildResult
+        with the instance and the time taken by each phase: fetch, hash,
+        convert, copy, seed, register and attach. Phases nest, so the
+        fetch includes hashing the image. """
+        instance_id = self.make_instance_dir(spec)
+        result = BuildResult(instance_id, spec)
+        started = time.time()
+        with trace.collect() as collector:
+            with trace.span("create", "machine", instance=instance_id):
+                source = self.fetch_image(spec, [os.path.join(self.directory, instance_id)], force_cache)
+                self.build(spec, instance_id, source, linked)
+        result.elapsed = time.time() - started
+        result.phases = trace.phases(collector.spans)
+        result.instance = self.load(instance_id)
+        self.record_created(instance_id, spec)
+        return result
+
+    def create_many(self, spec, count, force_cache=False, linked=False, workers=4):
+        """ Build count instances based on the spec, named after it with a
+        numeric suffix. The image is fetched and converted once, then the
+        instances are built in parallel by a pool of workers. A failure to
+        build one instance does not stop the others. Returns a BuildResult
+        for each instance. If the image can't be fetched or prepared every
+        instance fails, and their directories are removed. """
+        results = []
+        for i in range(1, count + 1):
+            member = copy.copy(spec)
+            member.name = "{0}-{1}".format(spec.name, i)
+            results.append(BuildResult(self.make_instance_dir(member), member))
+        # the phases shared by the batch are counted in every result
+        started = time.time()
+        with trace.collect() as shared:
+            try:
+                source = self.fetch_image(spec, [os.path.join(self.directory, r.instance_id) for r in results], force_cache)
+                self.prepare(source, linked)
+            except Exception as e:
+                logger.exception("Failed to prepare the image for %s" % spec.name)
+                for r in results:
+                    try:
+                        os.rmdir(os.path.join(self.directory, r.instance_id))
+                    except OSError:
+                        logger.debug("Cannot remove %s" % r.instance_id, exc_info=True)
+                    r.error = e
+                    r.elapsed = time.time() - started
+                    r.phases = trace.phases(shared.spans)
+                return results
+
+        def build(r):
+            started = time.time()
+            with trace.collect() as collector:
+                try:
+                    with trace.span("create", "machine", instance=r.instance_id):
+                        self.build(r.spec, r.instance_id, source, linked)
+                    r.instance = self.load(r.instance_id)
+                    self.record_created(r.instance_id, r.spec)
+                except Exception as e:
+                    logger.exception("Failed to build %s" % r.instance_id)
+                    r.error = e
+            r.elapsed = time.time() - started
+            r.phases = trace.phases(shared.spans + collector.spans)
+
+        parallel(build, results, workers)
+        return results
+
+    def make_instance_dir(self, spec):
+        """ Create the directory for a new instance, returning its id. """
+        instance_id = self.get_instance_id(spec)
+        instance_dir = os.path.join(self.directory, instance_id)
+        logger.info("Creating directory %s" % (instance_dir, ))
+        os.mkdir(instance_dir)
+        return instance_id
+
+    def prepare(self, source, linked=False):
+        """ Called before a batch of instances is built from the source
+        image, to do once the work they would otherwise all repeat. """
+        self.base_disk(source, self.disk_format)
+
+    @abc.abstractmethod
+    def build(self, spec, instance_id, source, linked=False):
+        """ Build the instance in its newly created directory from the
+        pathname of the source image. """
 
     @abc.abstractmethod
     def __str__(self):
@@ -127,16 +456,112 @@ class Hypervisor(object):
     def present(self):
         """ Return True if the hypervisor is present on this host """
 
+    def fetch_image(self, spec, instance_dirs, force_cache=False):
+        """ Fetch the image for the spec, returning its pathname. Images in
+        the image directory are added to the image store, referenced by the
+        new instances, and the store pruned to its maximum size. """
+        with trace.span("fetch", image=str(spec.image)) as info:
+            pathname = spec.image.fetch(self.image_dir, force_cache)
+            info["bytes"] = file_size(pathname)
+        store = ImageStore(self.image_dir)
+        if store.contains_path(pathname):
+            store.add(pathname, instance_dirs)
+            store.prune()
+        return pathname
+
+    def base_disk(self, source, format):
+        """ Return the pathname of the copy of the source image converted
+        to format, converting it if the image store has no such copy yet.
+        Returns None for images outside the image store. """
+        store = ImageStore(self.image_dir)
+        if not store.contains_path(source):
+            return None
+        digest = store.add(source)
+
+        def convert(pathname):
+            self.convert_disk(source, pathname, format)
+        return store.converted(digest, format, convert)
+
+    def convert_disk(self, source, destination, format):
+        with trace.span("convert", format=format, bytes=file_size(source)):
+            self.qemu_img("convert", source=source, destination=destination, format=format)
+
+    def copy_disk(self, source, destination):
+        with trace.span("copy", bytes=file_size(source)):
+            shutil.copyfile(source, destination)
+        self.disk_copied(destination)
+
+    def create_disk(self, source, destination, format, linked=False):
+        """ Create the disk of a new instance at destination from the source
+        image, in the specified format, and return the pathname of the disk
+        to attach. Images in the image store are only converted to each
+        format once, and the converted copy is then copied for each
+        instance. If linked is True, the instance instead gets a disk that
+        records only its changes on top of the shared converted copy. """
+        base = self.base_disk(source, format)
+        if base is None:
+            if linked:
+                logger.info("Cannot link to an image outside the image store, converting it")
+            self.convert_disk(source, destination, format)
+            return destination
+        if linked:
+            return self.link_disk(base, destination)
+        self.copy_disk(base, destination)
+        return destination
+
+    def link_disk(self, base, destination):
+        """ Create a disk at destination that records only the changes made
+        on top of base, which must never change, and return the pathname of
+        the disk to attach. By default the base is just copied. """
+        self.copy_disk(base, destination)
+        return destination
+
+    def disk_copied(self, pathname):
+        """ Called after a converted disk is copied for a new instance, for
+        any changes the hypervisor needs to tell the copies apart. """
+
     def load(self, name):
         if os.path.exists(os.path.join(self.directory, name)):
             try:
                 machine = self.instance(self.directory, name)
             except OSError:
                 raise MachineDoesNotExist("Machine does not exist")
+            machine.inventory = self.inventory
             return machine
         else:
             raise MachineDoesNotExist("Machine does not exist")
 
+    def find(self, patterns):
+        """ Load the instances named, where names may be glob patterns
+        matching several instances. Each instance is returned once, in the
+        order named. """
+        names = []
+        for pattern in patterns:
+            if any(c in pattern for c in "*?["):
+                matches = fnmatch.filter(sorted(os.listdir(self.directory)), pattern)
+                if not matches:
+                    raise MachineDoesNotExist("No machines match %s" % pattern)
+            else:
+                matches = [pattern]
+            names.extend(m for m in matches if m not in names)
+        return [self.load(name) for name in names]
+
+    def query(self, instance_ids):
+        """ Return the state and ip address the hypervisor reports for each
+        of the machines, as a dict of fields keyed on instance id. This is
+        for listing, so hypervisors should only implement it if they can
+        report on every machine at once. By default nothing is known. """
+        return {}
+
+    def list(self, refresh=False):
+        """ Return the inventory entries of the machines, reconciled with
+        the instance directory, and with the hypervisor if refresh is
+        True. """
+        states = None
+        if refresh and os.path.isdir(self.directory):
+            states = self.query(sorted(os.listdir(self.directory)))
+        return self.inventory.reconcile(self.directory, self.hypervisor_id, states)
+
     def get_instance_id(self, spec):
         today = datetime.datetime.now()
         instance_id = spec.name
@@ -150,8 +575,13 @@ class Hypervisor(object):
         return instance_id
 
     def instances(self):
-        """ Return a generator of instance objects. """
-        for d in os.listdir(self.directory):
-            yield self.instance(self.directory, d)
-
-__all__ = [State, MachineInstance, Hypervisor]
+        """ Return a generator of instance objects, in name order. Instances
+        do no more than check their directory exists until they are used, so
+        this is quick even for many instances. """
+        for d in sorted(os.listdir(self.directory)):
+            if os.path.isdir(os.path.join(self.directory, d)):
+                machine = self.instance(self.directory, d)
+                machine.inventory = self.inventory
+                yield machine
+
+__all__ = [State, lazy, MachineInstance, backoff, wait_all, parallel, BuildResult, Hypervisor]
@@ -4,6 +4,9 @@ from . import command
 
 class QEmuImg(command.Command):
     command_name = "qemu-img"
+    # conversions are limited by the disk, so few run at once
+    concurrency = 2
     subcommands = {
         "convert": ["convert", "-O", "{format}", "{source}", "{destination}"],
+        "create_backed": ["create", "-f", "{format}", "-b", "{backing}", "-F", "{format}", "{destination}"],
     }
@@ -14,19 +14,39 @@
 # limitations under the License.
 
 import os
+import re
 import logging
 import shutil
+import threading
 import ipaddress
 
 from hyperkit.cloudinit import CloudConfig, Seed, MetaData
-from .machine import MachineInstance, Hypervisor
-from .vboxmanage import VBoxManage
+from hyperkit import trace
+from .machine import MachineInstance, Hypervisor, lazy
+from .vboxsession import VBoxSession, connect
+from .vboxmanage import ModifyVM
 from .command import CommandException
 from .qemu_img import QEmuImg
 
 logger = logging.getLogger(__name__)
 
 
+def parse_runningvms(output):
+    """ The names of the machines in the output of list runningvms. """
+    return [m.group(1) for m in re.finditer(r'^"(.*)" \{[0-9a-fA-F-]+\}\s*$', output, re.M)]
+
+
+def parse_guestproperties(output):
+    """ The guest properties in the output of guestproperty enumerate, in
+    either the format of VirtualBox 7 or of earlier versions. """
+    properties = {}
+    for line in output.splitlines():
+        m = re.match(r"^Name: (.*?), value: (.*?), timestamp: ", line) or re.match(r"^(/\S+) = '(.*)'", line)
+        if m is not None:
+            properties[m.group(1)] = m.group(2)
+    return properties
+
+
 class VBoxMachineInstance(MachineInstance):
 
     name = "vbox"
@@ -34,11 +54,19 @@ class VBoxMachineInstance(MachineInstance):
     # takes a long time to start the tools
     timeout = 300
 
+    # the guest property holding the address of the host-only interface
+    ip_property = "/VirtualBox/GuestInfo/Net/1/V4/IP"
+
+    blocking_wait = True
+
     def __init__(self, directory, instance_id):
         super(VBoxMachineInstance, self).__init__(directory, instance_id)
         self.directory = directory
         self.instance_id = instance_id
-        self.vboxmanage = VBoxManage()
+
+    @lazy
+    def vboxmanage(self):
+        return connect()
 
     @property
     def id(self):
@@ -60,10 +88,19 @@ class VBoxMachineInstance(MachineInstance):
         shutil.rmtree(os.path.join(self.directory, self.instance_id))
 
     def get_ip(self):
-        s = self.vboxmanage("guestproperty", name=self.instance_id, property="/VirtualBox/GuestInfo/Net/1/V4/IP")
+        s = self.vboxmanage("guestproperty", name=self.instance_id, property=self.ip_property)
         if s.startswith("Value: "):
             return s.split(" ", 1)[1]
 
+    def block(self, timeout):
+        try:
+            self.vboxmanage("guestproperty_wait", name=self.instance_id, property=self.ip_property,
+                            timeout=str(int(timeout * 1000)), command_timeout=timeout + 30)
+        except CommandException:
+            # timed out, or the machine is not running
+            return False
+        return True
+
 
 class VBoxCloudConfig(CloudConfig):
 
@@ -121,15 +158,16 @@ class HostOnlyNetwork(object):
         n = ipaddress.ip_network(u"%s/%s" % (self.ip_address, self.netmask), strict=False)
         return "VirtualBox host-only network %s %s" % (self.name, n)
 
-    def configurevm(self, name):
-        v = VBoxManage()
+    def configurevm(self, modify):
+        """ Connect the machine to the network, adding the changes to the
+        modify builder. """
         logger.info("Using network %s" % self.name)
-        v("configure_nic", name=name)
-        v("configure_hostonly", name=name, adapter=self.name)
+        modify("configure_nic")
+        modify("configure_hostonly", adapter=self.name)
 
     @classmethod
     def find_networks(self):
-        v = VBoxManage()
+        v = connect()
         output = v("list_hostonlyifs")
         d = {}
         for line in output.splitlines():
@@ -153,16 +191,30 @@ class HostOnlyNetwork(object):
 
 class NewHostOnlyNetwork(object):
 
-    def configurevm(self, name):
+    """ A host-only network created for the first machine configured with
+    it, and shared by any others. """
+
+    def __init__(self):
+        self.adapter = None
+        self.lock = threading.Lock()
+
+    def create(self):
         logger.info("Creating new host-only network")
-        v = VBoxManage()
+        v = connect()
         output = v("create_hostonly")
         for line in output.splitlines():
             if line.startswith("Interface"):
                 adapter = line.split()[1].strip("'")
                 logger.info("Network %s created" % adapter)
-                v("configure_nic", name=name)
-                v("configure_hostonly", name=name, adapter=adapter)
+                return adapter
+
+    def configurevm(self, modify):
+        with self.lock:
+            if self.adapter is None:
+                self.adapter = self.create()
+        if self.adapter is not None:
+            modify("configure_nic")
+            modify("configure_hostonly", adapter=self.adapter)
 
     def __str__(self):
         return "A new VirtualBox host-only network"
@@ -173,6 +225,10 @@ class VirtualBox(Hypervisor):
     hypervisor_id = "vbox"
     directory = os.path.expanduser("~/VirtualBox VMs")
     instance = VBoxMachineInstance
+    disk_format = "vdi"
+
+    # the network machines are connected to, once decided
+    network = None
 
     configs = {
         "ubuntu": VBoxUbuntuCloudConfig,
@@ -187,7 +243,7 @@ class VirtualBox(Hypervisor):
 
     def __init__(self, directory=None):
         super(VirtualBox, self).__init__(directory)
-        self.vboxmanage = VBoxManage()
+        self.vboxmanage = connect()
         self.qemu_img = QEmuImg()
 
     def __str__(self):
@@ -197,8 +253,16 @@ class VirtualBox(Hypervisor):
     def present(self):
         return self.vboxmanage.pathname is not None
 
+    @property
+    def query_ips(self):
+        """ Through VBoxManage a query runs a process for every running
+        machine, no cheaper than asking each of them, and waiting on their
+        guest properties blocks rather than polls. Only the API makes it a
+        saving. """
+        return isinstance(self.vboxmanage, VBoxSession)
+
     def cleanup(self, name):
-        v = VBoxManage()
+        v = connect()
         path = os.path.join(self.directory, name)
         if os.path.exists(path):
             logger.info("Shutting down virtual machine")
@@ -214,57 +278,95 @@ class VirtualBox(Hypervisor):
             logger.info("Deleting remaining files")
             shutil.rmtree(path)
 
+    def link_disk(self, base, destination):
+        # attaching the base as multiattach makes VirtualBox create a
+        # differencing disk for the machine
+        return base
+
+    def disk_copied(self, pathname):
+        # VirtualBox refuses to register two disks with the same uuid
+        self.vboxmanage("sethduuid", disk=pathname)
+
     def guess_network(self):
         """ Return a Network object that represents networking configuration for the hypervisor """
         # decide what sort of network we are going to use
         # return the actual type
         # right now we just use the first host only network and that's it
-        host_only = list(HostOnlyNetwork.find_networks())
-        if host_only:
-            return host_only[0]
-        else:
-            return NewHostOnlyNetwork()
-
-    def create(self, spec, force_cache):
-        """ Create a new virtual machine in the specified directory from the base image. """
-
-        instance_id = self.get_instance_id(spec)
+        if self.network is None:
+            host_only = list(HostOnlyNetwork.find_networks())
+            if host_only:
+                self.network = host_only[0]
+            else:
+                self.network = NewHostOnlyNetwork()
+        return self.network
+
+    def query(self, instance_ids):
+        """ Find the running machines with one list runningvms, then read the
+        guest properties of each of those that were asked about, in
+        parallel. Stopped machines cost nothing, and with the API backend
+        no processes are run at all. """
+        running = set(parse_runningvms(self.vboxmanage("list_runningvms")))
+        states = {}
+        executions = []
+        for instance_id in instance_ids:
+            if instance_id in running:
+                executions.append((instance_id, self.vboxmanage.submit("guestproperty_enumerate", name=instance_id)))
+            else:
+                states[instance_id] = {"state": "stopped", "ip": None}
+        for instance_id, execution in executions:
+            try:
+                properties = parse_guestproperties(execution.result())
+            except CommandException:
+                # it may have stopped since
+                properties = {}
+            states[instance_id] = {"state": "running", "ip": properties.get(VBoxMachineInstance.ip_property)}
+        return states
+
+    def prepare(self, source, linked=False):
+        super(VirtualBox, self).prepare(source, linked)
+        # settle on a network before the instances are built in parallel
+        self.guess_network()
+
+    def build(self, spec, instance_id, source, linked=False):
+        """ Build a new virtual machine in the instance directory from the source image. """
         instance_dir = os.path.join(self.directory, instance_id)
-        # create the directory to hold all the bits
-        logger.info("Creating directory %s" % (instance_dir, ))
-        os.mkdir(instance_dir)
 
         logger.info("Creating virtual machine")
-        self.vboxmanage("createvm", name=instance_id, directory=self.directory, ostype=self.ostype[spec.image.distro])
-        self.vboxmanage("configurevm", name=instance_id, memsize=spec.hardware.memory)
-        network = self.guess_network()
-        network.configurevm(instance_id)
+        with trace.span("register", instance=instance_id):
+            self.vboxmanage("createvm", name=instance_id, directory=self.directory, ostype=self.ostype[spec.image.distro])
+            modify = ModifyVM(self.vboxmanage, instance_id)
+            modify("configurevm", memsize=spec.hardware.memory)
+            network = self.guess_network()
+            network.configurevm(modify)
+            modify.commit()
 
         logger.info("Creating disk image from %s" % (spec.image, ))
         # create the disk image and attach it
         disk = os.path.join(instance_dir, instance_id + "_disk1.vdi")
-        self.qemu_img("convert", source=spec.image.fetch(self.image_dir, force_cache), destination=disk, format="vdi")
-        self.vboxmanage("create_sata", name=instance_id)
-        self.vboxmanage("attach_disk", name=instance_id, disk=disk)
+        disk = self.create_disk(source, disk, self.disk_format, linked)
+        mtype = "multiattach" if linked else "normal"
+        with trace.span("attach", instance=instance_id, device="disk"):
+            self.vboxmanage("create_sata", name=instance_id)
+            self.vboxmanage("attach_disk", name=instance_id, disk=disk, mtype=mtype)
 
         # create the seed ISO
         logger.info("Creating cloudinit seed")
         config_class = self.configs[spec.image.distro]
-        cloud_config = config_class(spec)
+        cloud_config = config_class(spec, secret=self.secret)
         meta_data = MetaData(spec.name)
         seed = Seed(instance_dir, cloud_config=cloud_config, meta_data=meta_data)
-        seed.write()
+        seed.write(self.seed_cache)
 
         logger.info("Attaching devices")
-        # connect the seed ISO and the tools ISO
-        self.vboxmanage("create_ide", name=instance_id)
-        self.vboxmanage("attach_ide", name=instance_id, port="0", device="0", filename=seed.pathname)
-        self.vboxmanage("attach_ide", name=instance_id, port="0", device="1", filename="/usr/share/virtualbox/VBoxGuestAdditions.iso")
-        logger.info("Machine created")
-
-        logger.info("Mounting host drive")
-        hostpath = os.path.expanduser("~")
-        self.vboxmanage("mount", name=instance_id, hostpath=hostpath)
-        return self.load(instance_id)
+        with trace.span("attach", instance=instance_id, device="ide"):
+            # connect the seed ISO and the tools ISO
+            self.vboxmanage("create_ide", name=instance_id)
+            self.vboxmanage("attach_ide", name=instance_id, port="0", device="0", filename=seed.pathname)
+            self.vboxmanage("attach_ide", name=instance_id, port="0", device="1", filename="/usr/share/virtualbox/VBoxGuestAdditions.iso")
+            logger.info("Machine created")
+
+            logger.info("Mounting host drive")
+            hostpath = os.path.expanduser("~")
+            self.vboxmanage("mount", name=instance_id, hostpath=hostpath)
 
 __all__ = [VirtualBox]
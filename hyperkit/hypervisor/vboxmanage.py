@@ -4,6 +4,34 @@ from . import command
 
 class VBoxManage(command.Command):
     command_name = "VBoxManage"
+    concurrency = 8
+    timeouts = {
+        "startvm": 120,
+        "controlvm": 120,
+        "unregistervm": 120,
+        "guestproperty": 30,
+        "guestproperty_enumerate": 30,
+        "list_hostonlyifs": 30,
+        "list_runningvms": 30,
+    }
+    # another VBoxManage, or the VM process, holding the machine's lock.
+    # Only changes to the settings of a machine are retried, as the same
+    # errors from startvm or unregistervm mean it is running or in use.
+    transient_errors = [
+        r"is already locked",
+        r"VBOX_E_INVALID_OBJECT_STATE",
+    ]
+    transient_subcommands = set([
+        "create_sata",
+        "create_ide",
+        "attach_disk",
+        "attach_ide",
+        "modifyvm",
+        "configurevm",
+        "configure_nic",
+        "configure_hostonly",
+        "mount",
+    ])
     subcommands = {
         "createvm": ["createvm",
                      "--name", "{name}",
@@ -24,6 +52,7 @@ class VBoxManage(command.Command):
                         "--storagectl", '"SATA Controller"',
                         "--port", "0", "--device", "0",
                         "--type", "hdd",
+                        "--mtype", "{mtype}",
                         "--medium", "{disk}"],
 
         "attach_ide": ["storageattach", "{name}",
@@ -32,6 +61,8 @@ class VBoxManage(command.Command):
                        "--type", "dvddrive",
                        "--medium", "{filename}"],
 
+        "modifyvm": ["modifyvm", "{name}"],
+
         "configurevm": ["modifyvm", "{name}",
                         "--ioapic", "on",
                         "--boot1", "disk", "--boot2", "none",
@@ -45,6 +76,8 @@ class VBoxManage(command.Command):
         "configure_hostonly": ["modifyvm", "{name}",
                                "--hostonlyadapter2", "{adapter}"],
 
+        "sethduuid": ["internalcommands", "sethduuid", "{disk}"],
+
         "create_hostonly": ["hostonlyif", "create"],
 
         "startvm": ["startvm",
@@ -57,6 +90,13 @@ class VBoxManage(command.Command):
 
         "guestproperty": ["guestproperty", "get", "{name}", "{property}"],
 
+        "guestproperty_wait": ["guestproperty", "wait", "{name}", "{property}",
+                               "--timeout", "{timeout}"],
+
+        "guestproperty_enumerate": ["guestproperty", "enumerate", "{name}"],
+
+        "list_runningvms": ["list", "runningvms"],
+
         "list_hostonlyifs": ["list", "hostonlyifs"],
 
         "mount": ["sharedfolder", "add", "{name}",
@@ -65,3 +105,36 @@ class VBoxManage(command.Command):
                   "--automount"],
 
     }
+
+    def modifyvm(self, name, changes):
+        """ Make the changes, a list of modifyvm subcommands and their
+        arguments, to the named machine with a single modifyvm. """
+        flags = []
+        for subcommand, kwargs in changes:
+            args = [a.format(name=name, **kwargs) for a in self.subcommands[subcommand]]
+            if args[:2] != ["modifyvm", name]:
+                raise ValueError("{0} is not a modifyvm subcommand".format(subcommand))
+            flags.extend(args[2:])
+        return self("modifyvm", *flags, name=name)
+
+
+class ModifyVM(object):
+
+    """ Collects the changes made by modifyvm subcommands to a machine, so
+    they can all be made at once when the machine has been configured,
+    rather than each starting VBoxManage. """
+
+    def __init__(self, vboxmanage, name):
+        self.vboxmanage = vboxmanage
+        self.name = name
+        self.changes = []
+
+    def __call__(self, subcommand, **kwargs):
+        self.changes.append((subcommand, kwargs))
+
+    def commit(self):
+        if self.changes:
+            self.vboxmanage.modifyvm(self.name, self.changes)
+            self.changes = []
+
+__all__ = [VBoxManage, ModifyVM]
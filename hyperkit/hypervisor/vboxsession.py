@@ -0,0 +1,290 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+import threading
+import contextlib
+
+from .vboxmanage import VBoxManage
+from .command import CommandException, CommandTimeout, Execution
+
+try:
+    import vboxapi
+except ImportError:
+    vboxapi = None
+
+logger = logging.getLogger(__name__)
+
+
+def controller_name(subcommand):
+    """ The name VBoxManage gives the storage controller it creates, so
+    machines set up by either backend are the same. """
+    args = VBoxManage.subcommands[subcommand]
+    return args[args.index("--name") + 1]
+
+
+class VBoxSession(object):
+
+    """ Runs the VBoxManage command set over a single long lived connection
+    to VirtualBox through its API, rather than starting a VBoxManage
+    process, which has to connect to VBoxSVC, for every command. Commands
+    are called just as with VBoxManage, and return the same output.
+    Commands with no implementation here are run with VBoxManage. """
+
+    # set to use the API when vboxapi is installed
+    enabled = False
+
+    # the session shared by the whole process, once connected
+    shared = None
+    connect_lock = threading.Lock()
+
+    # milliseconds to wait for a progress at a time, between checks of the
+    # timeout of the call
+    poll_interval = 500
+
+    sata_controller = controller_name("create_sata")
+    ide_controller = controller_name("create_ide")
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.vbox = manager.getVirtualBox()
+        self.const = manager.constants
+        self.cli = VBoxManage()
+        # calls are serialised, as the API objects are not thread safe, but
+        # not the wait for the operations they start to complete
+        self.lock = threading.RLock()
+        self.calls = threading.local()
+
+    @classmethod
+    def connect(cls):
+        """ Return the shared session, connecting if need be, or None if the
+        API is not enabled or cannot be used. """
+        if not cls.enabled or vboxapi is None:
+            return None
+        with cls.connect_lock:
+            if cls.shared is None:
+                try:
+                    cls.shared = cls(vboxapi.VirtualBoxManager(None, None))
+                except Exception:
+                    logger.warning("Cannot connect to the VirtualBox API, using VBoxManage instead", exc_info=True)
+                    cls.enabled = False
+                    return None
+            return cls.shared
+
+    @property
+    def pathname(self):
+        return self.cli.pathname
+
+    def __call__(self, subcommand, *args, **kwargs):
+        method = getattr(self, "api_" + subcommand, None)
+        if method is None or args or "cwd" in kwargs:
+            return self.cli(subcommand, *args, **kwargs)
+        timeout = kwargs.pop("command_timeout", VBoxManage.timeouts.get(subcommand, VBoxManage.timeout))
+        logger.debug("Calling VirtualBox API for {0} {1}".format(subcommand, kwargs))
+        self.calls.subcommand = subcommand
+        self.calls.deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            try:
+                return method(**kwargs)
+            except CommandException:
+                raise
+            except Exception as e:
+                if not self.manager.errIsOurXcptKind(e):
+                    raise
+                raise CommandException("VirtualBox API call for {0} failed: {1}".format(subcommand, self.manager.xcptGetMessage(e)))
+
+    def submit(self, subcommand, *args, **kwargs):
+        return Execution(self, subcommand, *args, **kwargs)
+
+    def modifyvm(self, name, changes):
+        for subcommand, kwargs in changes:
+            self(subcommand, name=name, **kwargs)
+        return ""
+
+    def session(self):
+        return self.manager.getSessionObject(self.vbox)
+
+    @contextlib.contextmanager
+    def locked(self, name, lock_type):
+        """ Lock the named machine, yielding the session. """
+        session = self.session()
+        self.vbox.findMachine(name).lockMachine(session, lock_type)
+        try:
+            yield session
+        finally:
+            session.unlockMachine()
+
+    @contextlib.contextmanager
+    def mutable(self, name):
+        """ Yield the named machine for changes, which are saved after. """
+        with self.locked(name, self.const.LockType_Write) as session:
+            yield session.machine
+            session.machine.saveSettings()
+
+    @contextlib.contextmanager
+    def released(self):
+        """ Let other threads make calls during the block, which must not
+        use the API objects other than the progress it waits for. """
+        self.lock.release()
+        try:
+            yield
+        finally:
+            self.lock.acquire()
+
+    def wait(self, progress):
+        """ Wait for the progress of an operation to complete, without
+        holding up other calls, until the timeout of the call passes. """
+        deadline = self.calls.deadline
+        with self.released():
+            while not progress.completed:
+                if deadline is not None and time.time() > deadline:
+                    if progress.cancelable:
+                        progress.cancel()
+                    raise CommandTimeout("VirtualBox API call for {0} did not complete in time".format(self.calls.subcommand))
+                progress.waitForCompletion(self.poll_interval)
+        if progress.resultCode != 0:
+            raise CommandException(progress.errorInfo.text)
+
+    def api_createvm(self, name, directory, ostype):
+        settings = self.vbox.composeMachineFilename(name, "", "", directory)
+        machine = self.vbox.createMachine(settings, name, [], ostype, "")
+        machine.saveSettings()
+        self.vbox.registerMachine(machine)
+        return ""
+
+    def api_configurevm(self, name, memsize):
+        c = self.const
+        with self.mutable(name) as m:
+            m.BIOSSettings.IOAPICEnabled = True
+            m.setBootOrder(1, c.DeviceType_HardDisk)
+            m.setBootOrder(2, c.DeviceType_Null)
+            m.memorySize = int(memsize)
+            m.VRAMSize = 12
+            port = m.getSerialPort(0)
+            port.enabled = True
+            port.IOBase = 0x3f8
+            port.IRQ = 4
+            port.hostMode = c.PortMode_Disconnected
+        return ""
+
+    def api_configure_nic(self, name):
+        with self.mutable(name) as m:
+            adapter = m.getNetworkAdapter(1)
+            adapter.enabled = True
+            adapter.attachmentType = self.const.NetworkAttachmentType_HostOnly
+        return ""
+
+    def api_configure_hostonly(self, name, adapter):
+        with self.mutable(name) as m:
+            m.getNetworkAdapter(1).hostOnlyInterface = adapter
+        return ""
+
+    def api_create_sata(self, name):
+        with self.mutable(name) as m:
+            controller = m.addStorageController(self.sata_controller, self.const.StorageBus_SATA)
+            controller.controllerType = self.const.StorageControllerType_IntelAhci
+        return ""
+
+    def api_create_ide(self, name):
+        with self.mutable(name) as m:
+            m.addStorageController(self.ide_controller, self.const.StorageBus_IDE)
+        return ""
+
+    def api_attach_disk(self, name, disk, mtype):
+        c = self.const
+        medium = self.vbox.openMedium(disk, c.DeviceType_HardDisk, c.AccessMode_ReadWrite, False)
+        if mtype == "multiattach" and medium.type != c.MediumType_MultiAttach:
+            medium.type = c.MediumType_MultiAttach
+        with self.mutable(name) as m:
+            m.attachDevice(self.sata_controller, 0, 0, c.DeviceType_HardDisk, medium)
+        return ""
+
+    def api_attach_ide(self, name, port, device, filename):
+        c = self.const
+        medium = self.vbox.openMedium(filename, c.DeviceType_DVD, c.AccessMode_ReadOnly, False)
+        with self.mutable(name) as m:
+            m.attachDevice(self.ide_controller, int(port), int(device), c.DeviceType_DVD, medium)
+        return ""
+
+    def api_mount(self, name, hostpath):
+        with self.mutable(name) as m:
+            m.createSharedFolder("hyperkit", hostpath, True, True)
+        return ""
+
+    def api_startvm(self, type, name):
+        session = self.session()
+        progress = self.vbox.findMachine(name).launchVMProcess(session, type, "")
+        try:
+            self.wait(progress)
+        finally:
+            session.unlockMachine()
+        return ""
+
+    def api_controlvm(self, name, button):
+        with self.locked(name, self.const.LockType_Shared) as session:
+            if button == "poweroff":
+                self.wait(session.console.powerDown())
+            elif button == "acpipowerbutton":
+                session.console.powerButton()
+            else:
+                raise CommandException("Unsupported controlvm action {0}".format(button))
+        return ""
+
+    def api_unregistervm(self, name):
+        machine = self.vbox.findMachine(name)
+        media = machine.unregister(self.const.CleanupMode_DetachAllReturnHardDisksOnly)
+        # IMachine.delete was renamed in VirtualBox 5
+        delete = getattr(machine, "deleteConfig", None) or getattr(machine, "delete")
+        self.wait(delete(media))
+        return ""
+
+    def api_guestproperty(self, name, property):
+        value = self.vbox.findMachine(name).getGuestPropertyValue(property)
+        if value:
+            return "Value: {0}".format(value)
+        return "No value set!"
+
+    def api_guestproperty_enumerate(self, name):
+        names, values, timestamps, flags = self.vbox.findMachine(name).enumerateGuestProperties("")
+        return "\n".join("Name: {0}, value: {1}, timestamp: {2}, flags: {3}".format(*p)
+                         for p in zip(names, values, timestamps, flags))
+
+    def api_list_runningvms(self):
+        running = self.const.MachineState_Running
+        return "\n".join('"{0}" {{{1}}}'.format(m.name, m.id) for m in self.vbox.machines if m.state == running)
+
+    def api_list_hostonlyifs(self):
+        c = self.const
+        blocks = []
+        for i in self.vbox.host.findHostNetworkInterfacesOfType(c.HostNetworkInterfaceType_HostOnly):
+            blocks.append("\n".join([
+                "Name:            {0}".format(i.name),
+                "GUID:            {0}".format(i.id),
+                "DHCP:            {0}".format("Enabled" if i.DHCPEnabled else "Disabled"),
+                "IPAddress:       {0}".format(i.IPAddress),
+                "NetworkMask:     {0}".format(i.networkMask),
+                "HardwareAddress: {0}".format(i.hardwareAddress),
+                "Status:          {0}".format("Up" if i.status == c.HostNetworkInterfaceStatus_Up else "Down"),
+            ]))
+        return "\n\n".join(blocks)
+
+
+def connect():
+    """ Return the backend to run VBoxManage commands with: the shared API
+    session if it is enabled and available, otherwise VBoxManage. """
+    return VBoxSession.connect() or VBoxManage()
+
+__all__ = [VBoxSession, connect]
@@ -1,31 +1,91 @@
 
 import os
+import json
+import logging
+import threading
 import subprocess
 
 from . import command
 
+logger = logging.getLogger(__name__)
+
 
 class VMRun(command.Command):
 
     command_name = "vmrun"
+    concurrency = 4
+    timeouts = {
+        "start": 300,
+        "stop": 300,
+        "readVariable": 30,
+    }
     subcommands = {
         "start": ["start", "{name}", "{type}"],
         "stop": ["stop", "{name}", "{type}"],
         "delete": ["deleteVM", "{name}"],
         "readVariable": ["readVariable", "{name}", "guestVar", "{variable}"],
+        "list": ["list"],
     }
 
+    default_hosttypes = [
+        'ws',
+        'fusion',
+        'player',
+    ]
+
+    # if set, the host type used without detecting it
+    override = None
+
+    # host types already detected by this process, keyed on the binary
+    detected = {}
+    lock = threading.Lock()
+
+    # remembers detected host types between runs
+    cache_pathname = os.path.expanduser("~/.hyperkit/vmrun.json")
+
     @property
     def hosttype(self):
-        default_hosttypes = [
-            'ws',
-            'fusion',
-            'player',
-        ]
+        """ The host type vmrun must be told it is driving. Detecting it
+        means trying vmrun with each host type, so it is only done once per
+        process, and the result is kept in a cache keyed on the path and
+        modification time of the vmrun binary. """
+        if self.override is not None:
+            return self.override
+        pathname = self.pathname
+        with self.lock:
+            if pathname not in self.detected:
+                self.detected[pathname] = self.cached_hosttype(pathname)
+            return self.detected[pathname]
+
+    def cached_hosttype(self, pathname):
+        mtime = os.path.getmtime(pathname)
+        try:
+            cache = json.load(open(self.cache_pathname))
+        except (IOError, ValueError):
+            cache = {}
+        entry = cache.get(pathname)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry["hosttype"]
+        hosttype = self.detect_hosttype(pathname)
+        cache[pathname] = {"mtime": mtime, "hosttype": hosttype}
+        try:
+            directory = os.path.dirname(self.cache_pathname)
+            if not os.path.exists(directory):
+                os.mkdir(directory)
+            tmp = self.cache_pathname + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.rename(tmp, self.cache_pathname)
+        except (IOError, OSError):
+            logger.debug("Cannot write {0}".format(self.cache_pathname), exc_info=True)
+        return hosttype
+
+    def detect_hosttype(self, pathname):
         devnull = open(os.devnull, "w")
-        for hosttype in default_hosttypes:
-            command = [self.pathname, "-T", hosttype, "list"]
+        for hosttype in self.default_hosttypes:
+            command = [pathname, "-T", hosttype, "list"]
             if subprocess.call(command, stdout=devnull, stderr=devnull) == 0:
+                logger.debug("{0} has host type {1}".format(pathname, hosttype))
                 return hosttype
         raise OSError("Cannot find host type")
 
@@ -14,26 +14,73 @@
 # limitations under the License.
 
 import os
+import re
 import logging
 import random
-import collections
+import tempfile
 
 from hyperkit.cloudinit import CloudConfig, Seed, MetaData
-from .machine import MachineInstance, Hypervisor
+from hyperkit import trace
+from .machine import MachineInstance, Hypervisor, lazy
 from .vmrun import VMRun
 from .qemu_img import QEmuImg
 
 logger = logging.getLogger(__name__)
 
 
-class VMX(collections.defaultdict):
+class VMXSection(object):
 
-    """ A VMWare VMX configuration. """
+    """ The settings of a VMX file that share a prefix, such as those of a
+    device, so that vmx["ethernet0"]["present"] is ethernet0.present. """
+
+    def __init__(self, vmx, prefix):
+        self.vmx = vmx
+        self.prefix = prefix
+
+    def key(self, name):
+        return "{0}.{1}".format(self.prefix, name)
+
+    def __getitem__(self, name):
+        return self.vmx.values[self.key(name)][0]
+
+    def __setitem__(self, name, value):
+        self.vmx[self.key(name)] = value
+
+    def __delitem__(self, name):
+        del self.vmx[self.key(name)]
+
+    def __contains__(self, name):
+        return self.key(name) in self.vmx.values
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        start = len(self.prefix) + 1
+        return [k[start:] for k in self.vmx.keys() if k.startswith(self.prefix + ".")]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
+class VMX(object):
+
+    """ A VMWare VMX configuration.
+
+    The file is kept as a list of its lines, so that comments, blank lines
+    and the order of the settings survive being read and written again.
+    Settings are addressed by their full key, such as
+    vmx["sched.mem.pshare.enable"], or through the section for a prefix,
+    such as vmx["ethernet0"]["present"]. Values that are not changed are
+    written back exactly as they were read. """
 
     def __init__(self, directory, prefix):
-        collections.defaultdict.__init__(self, lambda: {})
         self.directory = directory
         self.prefix = prefix
+        # each line is either a key, or the text of a comment or blank line
+        self.lines = []
+        # the value of each key, and its text as read or None if changed
+        self.values = {}
         if os.path.exists(self.pathname):
             self.read()
         else:
@@ -43,8 +90,38 @@ class VMX(collections.defaultdict):
     def pathname(self):
         return os.path.join(self.directory, self.prefix + ".vmx")
 
+    def keys(self):
+        return [l for l in self.lines if l in self.values]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key][0]
+        return VMXSection(self, key)
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict):
+            # replaces every setting in the section
+            section = VMXSection(self, key)
+            for name in section.keys():
+                if name not in value:
+                    del section[name]
+            for name in sorted(value):
+                section[name] = value[name]
+            return
+        if key not in self.values:
+            self.lines.append(key)
+        self.values[key] = (value, None)
+
+    def __delitem__(self, key):
+        del self.values[key]
+        self.lines.remove(key)
+
     def vanilla(self):
         """ Create a vanilla VMX File """
+        self['.encoding'] = "UTF-8"
         self['config']['version'] = 8
         self['virtualhw']['version'] = 7
         self.configure_core()
@@ -92,37 +169,60 @@ class VMX(collections.defaultdict):
             pass
         return value
 
+    def unquote(self, text):
+        """ The string a value in the file stands for. Values are quoted,
+        with quotes and other special characters escaped as |XX. """
+        if len(text) >= 2 and text[0] == text[-1] == '"':
+            text = text[1:-1]
+        return re.sub(r"\|([0-9A-Fa-f]{2})", lambda m: chr(int(m.group(1), 16)), text)
+
+    def parse(self, lines):
+        self.lines = []
+        self.values = {}
+        for line in lines:
+            line = line.rstrip("\r\n")
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#") or "=" not in stripped:
+                self.lines.append(line)
+                continue
+            name, text = [x.strip() for x in stripped.split("=", 1)]
+            if name not in self.values:
+                self.lines.append(name)
+            self.values[name] = (self.parse_value(self.unquote(text)), text)
+
     def read(self):
         """ Read a VMX File from disk """
-        for l in open(self.pathname):
-            l = l.strip()
-            if l and not l.startswith("#"):
-                name, value = [x.strip() for x in l.strip().split("=", 1)]
-                value = self.parse_value(value)
-                parts = name.split(".", 1)
-                if len(parts) == 1:
-                    self[name] = value
-                elif len(parts) == 2:
-                    component, prop = parts
-                    self[component][prop] = value
+        self.parse(open(self.pathname))
 
     def fmt(self, value):
         if isinstance(value, bool):
             value = str(value).upper()
         else:
             value = str(value)
+        value = re.sub(r'["|#]', lambda m: "|{0:02X}".format(ord(m.group(0))), value)
         return '"{0}"'.format(value)
 
-    def write(self):
-        """ Write the VMX File on disk """
-        f = open(self.pathname, "w")
-        print >> f, ".encoding = UTF8"
-        for name, value in sorted(self.items()):
-            if isinstance(value, dict):
-                for k, v in sorted(value.items()):
-                    print >> f, "{0}.{1} = {2}".format(name, k, self.fmt(v))
+    def serialise(self):
+        """ Return the text of the file. """
+        lines = []
+        for line in self.lines:
+            if line in self.values:
+                value, text = self.values[line]
+                lines.append("{0} = {1}".format(line, self.fmt(value) if text is None else text))
             else:
-                print >> f, "{0} = {1}".format(name, self.fmt(value))
+                lines.append(line)
+        return "".join(l + "\n" for l in lines)
+
+    def write(self):
+        """ Write the VMX File on disk, replacing it atomically. """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=self.prefix, suffix=".vmx.tmp")
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(self.serialise())
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.pathname)
 
     def connect_iso(self, filename, device="ide0:0", present=True):
         self[device] = {
@@ -172,28 +272,39 @@ class VMWareMachineInstance(MachineInstance):
 
     def __init__(self, directory, instance_id):
         super(VMWareMachineInstance, self).__init__(directory, instance_id)
-        self.vmx = VMX(self.instance_dir, self.instance_id)
-        self.vmrun = VMRun()
+
+    @lazy
+    def vmrun(self):
+        return VMRun()
+
+    @lazy
+    def vmx(self):
+        """ The configuration of the machine, only read if it is needed. """
+        return VMX(self.instance_dir, self.instance_id)
+
+    @property
+    def vmx_pathname(self):
+        return os.path.join(self.instance_dir, self.instance_id + ".vmx")
 
     def _start(self, gui=False):
         s_type = {
             True: "gui",
             False: "nogui",
         }[gui]
-        self.vmrun("start", name=self.vmx.pathname, type=s_type)
+        self.vmrun("start", name=self.vmx_pathname, type=s_type)
 
     def _stop(self, force=False):
         s_type = {
             True: "hard",
             False: "soft",
         }[force]
-        self.vmrun("stop", name=self.vmx.pathname, type=s_type)
+        self.vmrun("stop", name=self.vmx_pathname, type=s_type)
 
     def _destroy(self):
-        self.vmrun("stop", name=self.vmx.pathname)
+        self.vmrun("stop", name=self.vmx_pathname)
 
     def get_ip(self):
-        return self.vmrun("readVariable", name=self.vmx.pathname, variable="ip").strip()
+        return self.vmrun("readVariable", name=self.vmx_pathname, variable="ip").strip()
 
 
 class VMWareCloudConfig(CloudConfig):
@@ -227,6 +338,7 @@ class VMWare(Hypervisor):
     hypervisor_id = "vmware"
     directory = os.path.expanduser("~/vmware")
     instance = VMWareMachineInstance
+    disk_format = "vmdk"
 
     configs = {
         "ubuntu": VMWareUbuntuCloudConfig,
@@ -245,15 +357,23 @@ class VMWare(Hypervisor):
     def __str__(self):
         return "VMWare"
 
-    def create(self, spec, image_dir="~/.hyperkit"):
+    def link_disk(self, base, destination):
+        self.qemu_img("create_backed", format="vmdk", backing=base, destination=destination)
+        return destination
 
-        image_dir = os.path.expanduser(image_dir)
-        instance_id = self.get_instance_id(spec)
-        instance_dir = os.path.join(self.directory, instance_id)
+    def query(self, instance_ids):
+        """ vmrun list prints the vmx file of every running machine, so
+        one run tells which of the machines are running. """
+        running = set(os.path.realpath(l.strip()) for l in self.vmrun("list").splitlines()[1:])
+        states = {}
+        for instance_id in instance_ids:
+            vmx = os.path.realpath(os.path.join(self.directory, instance_id, instance_id + ".vmx"))
+            states[instance_id] = {"state": "running" if vmx in running else "stopped"}
+        return states
+
+    def build(self, spec, instance_id, source, linked=False):
 
-        # create the directory to hold all the bits
-        logger.info("Creating directory %s" % (instance_dir, ))
-        os.mkdir(instance_dir)
+        instance_dir = os.path.join(self.directory, instance_id)
 
         # create a vanilla vmx file
         logger.info("Creating VMX file")
@@ -263,24 +383,24 @@ class VMWare(Hypervisor):
         # create the disk image and attach it
         disk = os.path.join(instance_dir, instance_id + "_disk1.vmdk")
         logger.info("Creating disk image from %s" % (spec.image, ))
-        self.qemu_img("convert", source=spec.image.fetch(image_dir), destination=disk, format="vmdk")
+        disk = self.create_disk(source, disk, self.disk_format, linked)
 
         vmx.connect_disk(disk)
 
         # create the seed ISO
         logger.info("Creating CloudInfo Seed")
         config_class = self.configs[spec.image.distro]
-        cloud_config = config_class(spec)
+        cloud_config = config_class(spec, secret=self.secret)
         meta_data = MetaData(spec.name)
         seed = Seed(instance_dir, cloud_config=cloud_config, meta_data=meta_data)
-        seed.write()
+        seed.write(self.seed_cache)
 
         # connect the seed ISO and the tools ISO
         logger.info("Connecting devices")
-        vmx.connect_iso(seed.pathname)
-        vmx.connect_iso("/usr/lib/vmware/isoimages/linux.iso", "ide0:1", "TRUE")
-        vmx.write()
+        with trace.span("register", instance=instance_id):
+            vmx.connect_iso(seed.pathname)
+            vmx.connect_iso("/usr/lib/vmware/isoimages/linux.iso", "ide0:1", "TRUE")
+            vmx.write()
         logger.info("Machine created")
-        return self.load(instance_id)
 
 __all__ = [VMWare]
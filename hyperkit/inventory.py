@@ -0,0 +1,181 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import copy
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+
+def disk_size(directory):
+    """ The total size of the files in directory. """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class Inventory(object):
+
+    """ An index of the machines hyperkit manages, so they can be listed
+    without loading each one or asking the hypervisor about it.
+
+    Each entry, keyed on the absolute path of the instance directory,
+    records the name and hypervisor of the machine, the distro, release
+    and architecture it was created from, when it was created, its disk
+    size and when that was measured, and its last known state and ip
+    address. Entries are updated as machines are created, started, stopped
+    and destroyed, and reconciled with the instance directories when
+    listed. """
+
+    index_name = "inventory.json"
+
+    # serialises changes to the index between threads of this process
+    lock = threading.RLock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.load()
+
+    @property
+    def pathname(self):
+        return os.path.join(self.directory, self.index_name)
+
+    def key(self, instance_dir):
+        return os.path.abspath(instance_dir)
+
+    def load(self):
+        try:
+            data = json.load(open(self.pathname))
+        except (IOError, ValueError):
+            data = {}
+        self.entries = data.get("machines", {})
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump({"machines": self.entries}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.pathname)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Reload the index and save it again if the block changed it,
+        locked so that no other thread or process can change it in
+        between. """
+        with self.lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            f = open(os.path.join(self.directory, "inventory.lock"), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self.load()
+                loaded = copy.deepcopy(self.entries)
+                yield
+                if self.entries != loaded:
+                    self.save()
+            finally:
+                f.close()
+
+    def new_entry(self, instance_dir, hypervisor):
+        return {
+            "name": os.path.basename(instance_dir),
+            "hypervisor": hypervisor,
+            "distro": None,
+            "release": None,
+            "arch": None,
+            "created": os.path.getctime(instance_dir),
+            "disk_size": None,
+            "measured": None,
+            "state": "unknown",
+            "ip": None,
+            "updated": time.time(),
+        }
+
+    def measure(self, entry, instance_dir):
+        entry["disk_size"] = disk_size(instance_dir)
+        entry["measured"] = time.time()
+
+    def created(self, instance_dir, hypervisor, spec):
+        """ Record a newly created machine. """
+        with self.transaction():
+            entry = self.entries[self.key(instance_dir)] = self.new_entry(instance_dir, hypervisor)
+            for attr in "distro", "release", "arch":
+                value = getattr(spec.image, attr, None)
+                entry[attr] = None if value is None else str(value)
+            entry["created"] = time.time()
+            entry["state"] = "stopped"
+            self.measure(entry, instance_dir)
+
+    def update(self, instance_dir, **fields):
+        """ Record the state or ip address of a machine, if it is in the
+        inventory. """
+        with self.transaction():
+            entry = self.entries.get(self.key(instance_dir))
+            if entry is None:
+                return
+            entry.update(fields)
+            entry["updated"] = time.time()
+
+    def remove(self, instance_dir):
+        with self.transaction():
+            self.entries.pop(self.key(instance_dir), None)
+
+    def reconcile(self, directory, hypervisor, states=None):
+        """ Bring the entries for the machines in directory up to date with
+        it, adding machines created without hyperkit, dropping those that
+        were removed and measuring disk sizes. Measuring costs a stat of
+        each file, so it is only repeated for directories changed since
+        they were last measured. The index is only saved if that changed
+        anything. Returns them sorted by name. states may map machine
+        names to fields the hypervisor reported for them. """
+        directory = self.key(directory)
+        with self.transaction():
+            names = set()
+            if os.path.isdir(directory):
+                names = set(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+            for instance_dir, entry in self.entries.items():
+                if os.path.dirname(instance_dir) == directory and entry["name"] not in names:
+                    logger.debug("{0} no longer exists".format(instance_dir))
+                    del self.entries[instance_dir]
+            listed = []
+            for name in names:
+                instance_dir = os.path.join(directory, name)
+                entry = self.entries.get(instance_dir)
+                if entry is None:
+                    entry = self.entries[instance_dir] = self.new_entry(instance_dir, hypervisor)
+                if entry.get("measured") is None or os.path.getmtime(instance_dir) > entry["measured"]:
+                    self.measure(entry, instance_dir)
+                fields = states.get(name, {}) if states is not None else {}
+                if any(entry.get(k) != v for k, v in fields.items()):
+                    entry.update(fields)
+                    entry["updated"] = time.time()
+                listed.append(entry)
+        return sorted(listed, key=lambda e: e["name"])
+
+__all__ = [Inventory, disk_size]
@@ -0,0 +1,261 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Writes the small ISO9660 images used as cloud-init seeds, with a single
+flat directory of files, named for Rock Ridge and Joliet readers as well
+as with ISO9660 8.3 names. """
+
+import re
+import time
+import struct
+
+SECTOR = 2048
+
+# The Rock Ridge extension reference, which is too long for the root
+# directory record and so goes in a continuation area
+RRIP_ID = "RRIP_1991A"
+RRIP_DESCRIPTOR = "THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE SYSTEM SEMANTICS"
+RRIP_SOURCE = "PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT INFORMATION."
+
+# UCS-2 level 3
+JOLIET_ESCAPE = "%/E"
+
+FILE_MODE = 0100444
+DIRECTORY_MODE = 040555
+
+
+def both16(n):
+    return struct.pack("<H", n) + struct.pack(">H", n)
+
+
+def both32(n):
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+
+def sectors(size):
+    return (size + SECTOR - 1) // SECTOR
+
+
+def pad(data, length, fill=" "):
+    return data[:length] + fill * (length - len(data[:length]))
+
+
+def ucs2(text, length=None):
+    """ text in UCS-2, as Joliet names are, space padded to length. """
+    data = text.encode("utf-16-be")
+    if length is None:
+        return data
+    return (data + "\x00 " * length)[:length]
+
+
+def d_characters(text):
+    """ text in upper case, with anything ISO9660 names can't hold
+    replaced by underscores. """
+    return re.sub(r"[^A-Z0-9_]", "_", text.upper())
+
+
+def iso_name(filename):
+    """ The ISO9660 level 1 name for filename, an upper case 8.3 name. """
+    base, dot, ext = filename.rpartition(".")
+    if not dot:
+        base, ext = ext, ""
+    return "{0}.{1};1".format(d_characters(base)[:8], d_characters(ext)[:3])
+
+
+def directory_date(mtime):
+    t = time.gmtime(mtime)
+    return struct.pack("7B", t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+
+def volume_date(mtime):
+    return time.strftime("%Y%m%d%H%M%S00", time.gmtime(mtime)) + "\x00"
+
+
+def susp(signature, data):
+    """ A System Use Sharing Protocol entry. """
+    return signature + struct.pack("BB", len(data) + 4, 1) + data
+
+
+def posix_attributes(mode, links):
+    return susp("PX", both32(mode) + both32(links) + both32(0) + both32(0))
+
+
+class ISO9660(object):
+
+    """ An ISO9660 image of the files added to it, which are kept in memory.
+    The image has a primary volume with Rock Ridge names and a Joliet
+    supplementary volume, both describing the same file extents. Given the
+    same files and mtime the image is always byte for byte the same. """
+
+    def __init__(self, volume_id="CDROM", mtime=0):
+        self.volume_id = volume_id
+        self.mtime = mtime
+        self.files = []
+
+    def add(self, filename, data):
+        self.files.append((filename, data))
+
+    def record(self, identifier, extent, size, directory=False, system_use=""):
+        """ A directory record. """
+        identifier_pad = "" if len(identifier) % 2 else "\x00"
+        if len(system_use) % 2:
+            system_use += "\x00"
+        length = 33 + len(identifier) + len(identifier_pad) + len(system_use)
+        return "".join([
+            struct.pack("BB", length, 0),
+            both32(extent),
+            both32(size),
+            directory_date(self.mtime),
+            struct.pack("BBB", 2 if directory else 0, 0, 0),
+            both16(1),
+            struct.pack("B", len(identifier)),
+            identifier,
+            identifier_pad,
+            system_use,
+        ])
+
+    def pack(self, records):
+        """ Lay out directory records in sectors, which records may not
+        span. """
+        data = ""
+        for record in records:
+            used = len(data) % SECTOR
+            if used and used + len(record) > SECTOR:
+                data += "\x00" * (SECTOR - used)
+            data += record
+        return pad(data, sectors(len(data)) * SECTOR, "\x00")
+
+    def names(self):
+        """ The ISO9660 names of the files, made unique. """
+        names = []
+        for filename, data in self.files:
+            name = iso_name(filename)
+            counter = 0
+            while name in names:
+                counter += 1
+                base, ext = name.split(".", 1)
+                suffix = str(counter)
+                name = "{0}{1}.{2}".format(base[:8 - len(suffix)], suffix, ext)
+            names.append(name)
+        return names
+
+    def primary_directory(self, root, size, continuation, extents):
+        er = self.extension_reference()
+        sharing = susp("SP", "\xbe\xef\x00")
+        continued = susp("CE", both32(continuation) + both32(0) + both32(len(er)))
+        records = [
+            self.record("\x00", root, size, True, sharing + continued + posix_attributes(DIRECTORY_MODE, 2)),
+            self.record("\x01", root, size, True, posix_attributes(DIRECTORY_MODE, 2)),
+        ]
+        entries = sorted(zip(self.names(), self.files, extents))
+        for name, (filename, data), extent in entries:
+            records.append(self.record(name, extent, len(data), False,
+                                       posix_attributes(FILE_MODE, 1) + susp("NM", "\x00" + filename)))
+        return self.pack(records)
+
+    def joliet_directory(self, root, size, extents):
+        records = [
+            self.record("\x00", root, size, True),
+            self.record("\x01", root, size, True),
+        ]
+        entries = sorted((ucs2(filename + ";1"), extent, len(data)) for (filename, data), extent in zip(self.files, extents))
+        for name, extent, length in entries:
+            records.append(self.record(name, extent, length))
+        return self.pack(records)
+
+    def extension_reference(self):
+        lengths = struct.pack("BBBB", len(RRIP_ID), len(RRIP_DESCRIPTOR), len(RRIP_SOURCE), 1)
+        return susp("ER", lengths + RRIP_ID + RRIP_DESCRIPTOR + RRIP_SOURCE)
+
+    def path_table(self, root, big_endian=False):
+        order = ">" if big_endian else "<"
+        return struct.pack("BB", 1, 0) + struct.pack(order + "IH", root, 1) + "\x00\x00"
+
+    def volume_descriptor(self, joliet, volume_size, path_tables, root):
+        if joliet:
+            text = ucs2
+            escape = pad(JOLIET_ESCAPE, 32, "\x00")
+        else:
+            text = pad
+            escape = "\x00" * 32
+        l_table, m_table = path_tables
+        dates = volume_date(self.mtime)
+        descriptor = "".join([
+            struct.pack("B", 2 if joliet else 1),
+            "CD001\x01\x00",
+            text("", 32),
+            text(self.volume_id, 32),
+            "\x00" * 8,
+            both32(volume_size),
+            escape,
+            both16(1),
+            both16(1),
+            both16(SECTOR),
+            both32(10),
+            struct.pack("<I", l_table),
+            "\x00" * 4,
+            struct.pack(">I", m_table),
+            "\x00" * 4,
+            root,
+            text("", 128),
+            text("", 128),
+            text("", 128),
+            text("HYPERKIT", 128),
+            text("", 36) + " ",
+            text("", 36) + " ",
+            text("", 36) + " ",
+            dates,
+            dates,
+            "0" * 16 + "\x00",
+            dates,
+            "\x01\x00",
+        ])
+        return pad(descriptor, SECTOR, "\x00")
+
+    def getvalue(self):
+        """ Return the image. """
+        # system area, volume descriptors and path tables, then the
+        # directories and the continuation area, which readers expect to
+        # follow the directory, then the file data
+        primary = 23
+        primary_size = len(self.primary_directory(0, 0, 0, [0] * len(self.files)))
+        joliet = primary + sectors(primary_size)
+        joliet_size = len(self.joliet_directory(0, 0, [0] * len(self.files)))
+        continuation = joliet + sectors(joliet_size)
+        extents = []
+        next_extent = continuation + 1
+        for filename, data in self.files:
+            extents.append(next_extent)
+            next_extent += max(sectors(len(data)), 1)
+        volume_size = next_extent
+
+        parts = ["\x00" * SECTOR * 16]
+        parts.append(self.volume_descriptor(False, volume_size, (19, 20), self.record("\x00", primary, primary_size, True)))
+        parts.append(self.volume_descriptor(True, volume_size, (21, 22), self.record("\x00", joliet, joliet_size, True)))
+        parts.append(pad("\xffCD001\x01", SECTOR, "\x00"))
+        for root in (primary, joliet):
+            parts.append(pad(self.path_table(root), SECTOR, "\x00"))
+            parts.append(pad(self.path_table(root, True), SECTOR, "\x00"))
+        parts.append(self.primary_directory(primary, primary_size, continuation, extents))
+        parts.append(self.joliet_directory(joliet, joliet_size, extents))
+        parts.append(pad(self.extension_reference(), SECTOR, "\x00"))
+        for filename, data in self.files:
+            parts.append(pad(data, max(sectors(len(data)), 1) * SECTOR, "\x00"))
+        return "".join(parts)
+
+    def write(self, f):
+        f.write(self.getvalue())
+
+__all__ = [ISO9660]
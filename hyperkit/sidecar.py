@@ -0,0 +1,92 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import json
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class Sidecar(dict):
+
+    """ Metadata about a file, such as its checksums, stored as JSON in a
+    sidecar file alongside it. The metadata is keyed on the size, mtime and
+    inode of the file, and is discarded as soon as any of them change, so
+    it can never describe a file other than the one on disk. """
+
+    suffix = ".meta"
+
+    def __init__(self, pathname):
+        dict.__init__(self)
+        self.pathname = pathname
+        self.load()
+
+    @property
+    def sidecar_pathname(self):
+        return self.pathname + self.suffix
+
+    def stat_key(self):
+        """ Return the values that identify the current version of the file,
+        or None if it does not exist or is not a regular file. """
+        try:
+            st = os.stat(self.pathname)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def load(self):
+        self.clear()
+        key = self.stat_key()
+        if key is None:
+            return
+        try:
+            data = json.load(open(self.sidecar_pathname))
+        except (IOError, ValueError):
+            return
+        if data.get("stat") != key:
+            logger.debug("{0} has changed, ignoring stored metadata".format(self.pathname))
+            return
+        self.update(data.get("metadata", {}))
+
+    def save(self):
+        """ Write the metadata, recording the current version of the file.
+        The sidecar is replaced atomically so a reader never sees a partial
+        write. Failing to write is not an error, the metadata will just be
+        recalculated next time. """
+        key = self.stat_key()
+        if key is None:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.sidecar_pathname) or ".", suffix=".tmp")
+            f = os.fdopen(fd, "w")
+            try:
+                json.dump({"stat": key, "metadata": self}, f)
+            finally:
+                f.close()
+            os.rename(tmp, self.sidecar_pathname)
+        except (IOError, OSError) as e:
+            logger.debug("Unable to write {0}: {1}".format(self.sidecar_pathname, e))
+
+    def discard(self):
+        self.clear()
+        if os.path.exists(self.sidecar_pathname):
+            os.unlink(self.sidecar_pathname)
+
+__all__ = [Sidecar]
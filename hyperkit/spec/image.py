@@ -15,10 +15,17 @@
 
 import abc
 import os
+import time
+import urllib
 import hashlib
-import urllib2
+import logging
+import urlparse
 
 from hyperkit import error
+from hyperkit.sidecar import Sidecar
+from hyperkit.download import Download
+
+logger = logging.getLogger(__name__)
 
 
 class Image(object):
@@ -32,7 +39,12 @@ class Image(object):
 
 class LiteralImage(Image):
 
-    """ An image specified by URL """
+    """ An image specified by URL, or by the path of a local file. Remote
+    images are cached in the image directory. """
+
+    # seconds for which a cached copy of a remote image is used without
+    # checking with the server that it is current
+    max_age = 3600
 
     def __init__(self, distro, release, arch, url):
         self.distro = distro
@@ -43,22 +55,40 @@ class LiteralImage(Image):
     def __str__(self):
         return "%s-%s-%s at %s" % (self.distro, self.release, self.arch, self.url)
 
-    def fetch(self, imagedir):
+    def local_pathname(self):
+        """ Return the pathname of the image if it is a local file, or None
+        if it needs fetching. """
+        scheme, netloc, path = urlparse.urlsplit(self.url)[:3]
+        if scheme == "file":
+            return urllib.url2pathname(path)
+        if scheme == "":
+            return os.path.abspath(os.path.expanduser(self.url))
+        return None
+
+    def cached(self, pathname, force_cache):
+        """ Return True if the cached copy at pathname can be used without
+        checking with the server. """
+        checked = Sidecar(pathname).get("checked")
+        if checked is None:
+            return False
+        return force_cache or time.time() - checked < self.max_age
+
+    def fetch(self, imagedir, force_cache=False):
+        local = self.local_pathname()
+        if local is not None:
+            if not os.path.exists(local):
+                raise error.FetchFailedException("Image {0} does not exist".format(local))
+            logger.debug("Using local image {0}".format(local))
+            return local
         if not os.path.exists(imagedir):
             os.mkdir(imagedir)
         urihash = hashlib.sha256()
         urihash.update(self.url)
         pathname = os.path.join(imagedir, "user-{0}-{1}-{2}.{3}.qcow2".format(self.distro, self.release, self.arch, urihash.hexdigest()))
-        try:
-            response = urllib2.urlopen(self.url)
-        except urllib2.HTTPError:
-            raise error.FetchFailedException("Unable to fetch {0}".format(self.url))
-        local = open(pathname, "w")
-        while True:
-            data = response.read(20 * 1024 * 1024 * 1024)
-            if not data:
-                break
-            local.write(data)
+        if self.cached(pathname, force_cache):
+            logger.debug("Using cached copy of {0}".format(self.url))
+        else:
+            Download(self.url, pathname).fetch()
         return pathname
 
 
@@ -0,0 +1,314 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import errno
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+import contextlib
+
+from hyperkit.hashing import file_digest, hash_name
+from hyperkit.sidecar import Sidecar
+from hyperkit.error import ImageConversionError
+
+logger = logging.getLogger(__name__)
+
+
+class ImageStore(object):
+
+    """ A content addressed store for the images in the image directory.
+
+    Each distinct image is kept once, under its sha256 digest, in the store
+    directory. The names distro images and literal images are fetched to
+    are hard links to the stored copy, so identical images share their
+    disk space. The index records, for each digest, the size, the names
+    linked to it, when it was added and last used, whether it is pinned and
+    which instances were created from it.
+
+    Images that are pinned, or referenced by an instance that still exists,
+    are never evicted. Others are evicted by prune, oldest first, when they
+    exceed the maximum age or the store exceeds the maximum size. """
+
+    index_name = "index.json"
+    store_name = "store"
+    hash_function = hashlib.sha256
+
+    # serialises changes to the index between threads of this process
+    lock = threading.RLock()
+
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self.load()
+
+    @property
+    def index_pathname(self):
+        return os.path.join(self.image_dir, self.index_name)
+
+    @property
+    def store_dir(self):
+        return os.path.join(self.image_dir, self.store_name)
+
+    def load(self):
+        try:
+            data = json.load(open(self.index_pathname))
+        except (IOError, ValueError):
+            data = {}
+        self.entries = data.get("images", {})
+        self.max_size = data.get("max_size", None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Reload the index and save it again after the changes made in the
+        block, locked so that no other thread or process can change it in
+        between. """
+        with self.lock:
+            if not os.path.exists(self.image_dir):
+                os.mkdir(self.image_dir)
+            f = open(os.path.join(self.image_dir, "index.lock"), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self.load()
+                yield
+                self.save()
+            finally:
+                f.close()
+
+    def save(self):
+        if not os.path.exists(self.image_dir):
+            os.mkdir(self.image_dir)
+        tmp = self.index_pathname + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump({"images": self.entries, "max_size": self.max_size}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.index_pathname)
+
+    def pathname(self, digest):
+        return os.path.join(self.store_dir, digest)
+
+    def contains_path(self, pathname):
+        """ Return True if pathname is in the image directory, and so can be
+        managed by the store. Local images provided by the user are not. """
+        directory = os.path.realpath(self.image_dir)
+        return os.path.realpath(pathname).startswith(directory + os.sep)
+
+    def digest(self, pathname):
+        """ Return the digest of the image at pathname, using the sum in the
+        sidecar if there is one. """
+        sidecar = Sidecar(pathname)
+        digests = sidecar.setdefault("digests", {})
+        name = hash_name(self.hash_function)
+        if name not in digests:
+            digests[name] = file_digest(pathname, self.hash_function)
+            sidecar.save()
+        return digests[name]
+
+    def link(self, source, pathname):
+        """ Atomically replace pathname with a hard link to source, keeping
+        the sidecar metadata of pathname. """
+        metadata = dict(Sidecar(pathname))
+        tmp = pathname + ".link"
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        os.link(source, tmp)
+        os.rename(tmp, pathname)
+        sidecar = Sidecar(pathname)
+        sidecar.update(metadata)
+        sidecar.save()
+
+    def add(self, pathname, references=()):
+        """ Add the image at pathname to the store, returning its digest. If
+        the store already has an identical image, pathname becomes a link
+        to it. The instance directories in references are recorded as
+        created from it in the same transaction, so it can't be evicted
+        before they are. """
+        digest = self.digest(pathname)
+        stored = self.pathname(digest)
+        with self.transaction():
+            if not os.path.exists(self.store_dir):
+                os.mkdir(self.store_dir)
+            if not os.path.exists(stored):
+                os.link(pathname, stored)
+            elif not os.path.samefile(stored, pathname):
+                logger.debug("{0} is identical to stored image {1}".format(pathname, digest))
+                self.link(stored, pathname)
+            for other in self.entries.values():
+                if pathname in other["names"]:
+                    other["names"].remove(pathname)
+            now = time.time()
+            entry = self.entries.setdefault(digest, {
+                "size": os.path.getsize(stored),
+                "names": [],
+                "added": now,
+                "pinned": False,
+                "references": [],
+            })
+            entry["names"].append(pathname)
+            entry["last_used"] = now
+            for instance_dir in references:
+                if instance_dir not in entry["references"]:
+                    entry["references"].append(instance_dir)
+        return digest
+
+    def reference(self, digest, instance_dir):
+        """ Record that the instance in instance_dir was created from the
+        image. """
+        with self.transaction():
+            entry = self.entries[digest]
+            if instance_dir not in entry["references"]:
+                entry["references"].append(instance_dir)
+            entry["last_used"] = time.time()
+
+    def references(self, digest):
+        """ Return the instances created from the image that still exist. """
+        return [r for r in self.entries[digest]["references"] if os.path.exists(r)]
+
+    def converted_pathname(self, digest, format):
+        return os.path.join(self.store_dir, "{0}.{1}".format(digest, format))
+
+    @contextlib.contextmanager
+    def converting(self, digest, format):
+        """ Lock the converted copy of the image in format, so that no other
+        thread or process converts it at the same time, without locking
+        the rest of the store. """
+        if not os.path.exists(self.store_dir):
+            try:
+                os.makedirs(self.store_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        f = open(self.converted_pathname(digest, format) + ".lock", "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+        finally:
+            f.close()
+
+    def converted(self, digest, format, convert):
+        """ Return the pathname of a copy of the image converted to format.
+        If there is no such copy yet, convert is called with the pathname to
+        write it to. As converted copies are keyed on the digest of the
+        source, a changed image is never mistaken for the one converted.
+        Only that copy stays locked during conversion, so an image is never
+        converted twice at once, but the rest of the store can be used. """
+        pathname = self.converted_pathname(digest, format)
+        with self.converting(digest, format):
+            if not os.path.exists(pathname):
+                logger.info("Converting image {0} to {1}".format(digest, format))
+                tmp = pathname + ".tmp"
+                convert(tmp)
+                os.rename(tmp, pathname)
+            else:
+                logger.debug("Using {0} copy of image {1}".format(format, digest))
+        with self.transaction():
+            entry = self.entries.get(digest)
+            if entry is None:
+                # evicted while it was being converted
+                os.unlink(pathname)
+                raise ImageConversionError("Image {0} was evicted while it was being converted to {1}, retry".format(digest, format))
+            entry.setdefault("converted", {})[format] = os.path.getsize(pathname)
+            entry["last_used"] = time.time()
+        return pathname
+
+    def find(self, key):
+        """ Return the digest of the entry matching key, which may be a
+        digest, an unambiguous prefix of one, or the name of an image. """
+        if key in self.entries:
+            return key
+        matches = [d for d, e in self.entries.items()
+                   if d.startswith(key) or key in e["names"] or key in [os.path.basename(n) for n in e["names"]]]
+        if len(matches) != 1:
+            raise KeyError("{0} does not identify a single image".format(key))
+        return matches[0]
+
+    def pin(self, key, pinned=True):
+        with self.transaction():
+            digest = self.find(key)
+            self.entries[digest]["pinned"] = pinned
+        return digest
+
+    def entry_size(self, entry):
+        """ The size of the image and any converted copies of it. """
+        return entry["size"] + sum(entry.get("converted", {}).values())
+
+    def total_size(self):
+        return sum(self.entry_size(e) for e in self.entries.values())
+
+    def evictable(self):
+        """ Return the digests of the images that may be evicted. """
+        return [d for d, e in self.entries.items() if not e["pinned"] and not self.references(d)]
+
+    def evict(self, digest):
+        """ Remove the image and every name that still links to it. """
+        entry = self.entries.pop(digest)
+        stored = self.pathname(digest)
+        for name in entry["names"]:
+            if os.path.exists(name) and os.path.exists(stored) and os.path.samefile(name, stored):
+                Sidecar(name).discard()
+                os.unlink(name)
+        if os.path.exists(stored):
+            os.unlink(stored)
+        for format in entry.get("converted", {}):
+            converted = self.converted_pathname(digest, format)
+            if os.path.exists(converted):
+                os.unlink(converted)
+        logger.info("Evicted image {0} ({1})".format(digest, format_size(self.entry_size(entry))))
+
+    def prune(self, max_size=None, max_age=None, policy="lru"):
+        """ Evict images older than max_age seconds, then the oldest images
+        until the store is no larger than max_size bytes, which defaults to
+        the configured maximum. With the lru policy age is measured from
+        when the image was last used, with the age policy from when it was
+        added. Returns the digests evicted. """
+        key = {"lru": "last_used", "age": "added"}[policy]
+        evicted = []
+        with self.transaction():
+            if max_size is None:
+                max_size = self.max_size
+            candidates = sorted(self.evictable(), key=lambda d: self.entries[d][key])
+            now = time.time()
+            for digest in candidates:
+                too_old = max_age is not None and now - self.entries[digest][key] > max_age
+                too_big = max_size is not None and self.total_size() > max_size
+                if too_old or too_big:
+                    self.evict(digest)
+                    evicted.append(digest)
+        return evicted
+
+
+sizes = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """ Parse a size such as 500M or 20G into a number of bytes. """
+    m = re.match(r"^(\d+)([KMGT]?)B?$", value.strip().upper())
+    if m is None:
+        raise ValueError("Invalid size {0!r}".format(value))
+    return int(m.group(1)) * sizes[m.group(2)]
+
+
+def format_size(value):
+    for suffix in "TGMK":
+        if value >= sizes[suffix]:
+            return "{0:.1f}{1}".format(float(value) / sizes[suffix], suffix)
+    return "{0}B".format(value)
+
+__all__ = [ImageStore, parse_size, format_size]
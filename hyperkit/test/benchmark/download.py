@@ -0,0 +1,76 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+
+Benchmark for image downloads
+
+Serves a synthetic image from a local stand-in server, with the bandwidth
+of each connection limited as it would be by a distant mirror, and compares
+a single stream with segmented downloads over increasing numbers of
+connections. Run with:
+
+    python -m hyperkit.test.benchmark.download --size 64 --rate 8
+
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from hyperkit.download import Download, SegmentedDownload
+from hyperkit.test.server import ImageServer
+
+
+def timed_fetch(download):
+    started = time.time()
+    download.fetch(conditional=False)
+    return time.time() - started
+
+
+def run(size, rate, connections=(1, 2, 4, 8)):
+    image = os.urandom(size)
+    directory = tempfile.mkdtemp()
+    pathname = os.path.join(directory, "image.qcow2")
+    results = []
+    try:
+        with ImageServer({"/image.img": image}) as server:
+            server.rate = rate
+            url = server.url("/image.img")
+            results.append(("single stream", timed_fetch(Download(url, pathname, [hashlib.sha256]))))
+            for n in connections:
+                download = SegmentedDownload(url, pathname, [hashlib.sha256])
+                download.connections = n
+                download.segment_size = max(size / (n * 4), 1)
+                results.append(("%d connections" % n, timed_fetch(download)))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image downloads")
+    parser.add_argument("--size", type=int, default=64, help="size of the synthetic image in megabytes")
+    parser.add_argument("--rate", type=int, default=8, help="bandwidth of each connection in megabytes per second")
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    for name, elapsed in run(size, args.rate * 1024 * 1024):
+        print "%-16s %6.2fs %8.1f MB/s" % (name, elapsed, args.size / elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+Benchmark for streaming image hashing
+
+Creates a sparse synthetic image of the requested size and hashes it with
+sha256 and md5 in a single pass, reporting throughput and peak RSS. Run with:
+
+    python -m hyperkit.test.benchmark.hashing --size 4096
+
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import resource
+import tempfile
+
+from hyperkit.hashing import MultiHasher
+
+
+def peak_rss():
+    """ Peak resident set size of this process in megabytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # reported in bytes on OS X, kilobytes elsewhere
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+def make_image(directory, size):
+    fd, pathname = tempfile.mkstemp(suffix=".img", dir=directory)
+    os.ftruncate(fd, size)
+    os.close(fd)
+    return pathname
+
+
+def run(size, directory=None):
+    pathname = make_image(directory, size)
+    try:
+        before = peak_rss()
+        hasher = MultiHasher(hashlib.sha256, hashlib.md5)
+        started = time.time()
+        total = hasher.hash_file(pathname)
+        elapsed = time.time() - started
+        after = peak_rss()
+    finally:
+        os.unlink(pathname)
+    return {
+        "bytes": total,
+        "seconds": elapsed,
+        "mb_per_second": total / (1024.0 * 1024.0) / elapsed,
+        "peak_rss_before": before,
+        "peak_rss_after": after,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streaming image hashing")
+    parser.add_argument("--size", type=int, default=4096, help="size of the synthetic image in megabytes")
+    parser.add_argument("--directory", default=None, help="directory in which to create the synthetic image")
+    args = parser.parse_args()
+    r = run(args.size * 1024 * 1024, args.directory)
+    print "Hashed %d bytes (sha256+md5) in %0.2fs" % (r['bytes'], r['seconds'])
+    print "Throughput: %0.1f MB/s" % r['mb_per_second']
+    print "Peak RSS: %0.1f MB before, %0.1f MB after" % (r['peak_rss_before'], r['peak_rss_after'])
+
+if __name__ == "__main__":
+    main()
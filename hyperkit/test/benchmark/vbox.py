@@ -0,0 +1,117 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+
+Benchmark for the VirtualBox backends
+
+Creates and starts a machine with each backend against stand-ins for
+VirtualBox, that take the given time for each new connection to VBoxSVC
+and for each call. The VBoxManage stand-in is a script that connects for
+every command, and the API stand-in a mock that connects once. Run with:
+
+    python -m hyperkit.test.benchmark.vbox --connect 50 --call 5
+
+"""
+
+import os
+import time
+import stat
+import shutil
+import argparse
+import tempfile
+
+import mock
+
+from hyperkit.hypervisor import vbox, vboxsession
+from hyperkit.hypervisor.command import registry
+from hyperkit.hypervisor.vboxsession import VBoxSession
+
+
+def make_vboxmanage(directory, delay):
+    pathname = os.path.join(directory, "VBoxManage")
+    with open(pathname, "w") as f:
+        f.write("#!/bin/sh\nsleep %f\n" % delay)
+    os.chmod(pathname, stat.S_IRWXU)
+    return pathname
+
+
+def make_vboxapi(connect, call):
+    """ A stand-in for the vboxapi module. """
+
+    def manager(*args):
+        time.sleep(connect)
+        m = mock.MagicMock()
+        m.getVirtualBox().findMachine().launchVMProcess().resultCode = 0
+        return m
+
+    class SlowSession(VBoxSession):
+        def __call__(self, subcommand, *args, **kwargs):
+            if hasattr(self, "api_" + subcommand):
+                time.sleep(call)
+            return super(SlowSession, self).__call__(subcommand, *args, **kwargs)
+
+    return mock.MagicMock(VirtualBoxManager=manager), SlowSession
+
+
+def create_and_start(directory, name):
+    spec = mock.MagicMock()
+    spec.image.distro = "ubuntu"
+    hypervisor = vbox.VirtualBox(directory)
+    hypervisor.create_disk = lambda source, destination, format, linked: destination
+    os.mkdir(os.path.join(directory, name))
+    started = time.time()
+    hypervisor.build(spec, name, "/images/ubuntu.qcow2")
+    created = time.time()
+    vbox.VBoxMachineInstance(directory, name).start()
+    return created - started, time.time() - created
+
+
+def run(connect, call, machines=3):
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        registry.pin("VBoxManage", make_vboxmanage(directory, connect + call))
+        vboxapi, session_class = make_vboxapi(connect, call)
+        with mock.patch.object(vbox, "Seed"), \
+                mock.patch.object(vbox.VirtualBox, "configs", {"ubuntu": mock.MagicMock()}), \
+                mock.patch.object(vboxsession, "vboxapi", vboxapi), \
+                mock.patch.object(vboxsession, "VBoxSession", session_class):
+            for backend, enabled in (("vboxmanage", False), ("api", True)):
+                session_class.enabled = enabled
+                session_class.shared = None
+                vms = os.path.join(directory, "vms-" + backend)
+                os.mkdir(vms)
+                times = [create_and_start(vms, "vm%d" % i) for i in range(machines)]
+                results.append((backend, times))
+    finally:
+        registry.reset()
+        shutil.rmtree(directory)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VirtualBox backends")
+    parser.add_argument("--connect", type=int, default=50, help="milliseconds to connect to VBoxSVC")
+    parser.add_argument("--call", type=int, default=5, help="milliseconds for each call")
+    parser.add_argument("--machines", type=int, default=3, help="the number of machines to create with each backend")
+    args = parser.parse_args()
+    for backend, times in run(args.connect / 1000.0, args.call / 1000.0, args.machines):
+        create = sum(t[0] for t in times) / len(times)
+        start = sum(t[1] for t in times) / len(times)
+        print "%-12s create %6.3fs  start %6.3fs" % (backend, create, start)
+
+if __name__ == "__main__":
+    main()
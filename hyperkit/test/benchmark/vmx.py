@@ -0,0 +1,91 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+Benchmark for reading and writing VMX files
+
+Writes a synthetic VMX file with many network interfaces and disks, then
+times loading it, and saving it after a change, several times over. Run
+with:
+
+    python -m hyperkit.test.benchmark.vmx --devices 64 --repeat 100
+
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+
+from hyperkit.hypervisor.vmware import VMX
+
+
+def make_vmx(directory, devices):
+    vmx = VMX(directory, "bench")
+    vmx.lines.insert(1, "# synthetic configuration with {0} of each device".format(devices))
+    for i in range(devices):
+        vmx.connect_network("ethernet{0}".format(i))
+        vmx["ethernet{0}".format(i)]["pciSlotNumber"] = 32 + i
+        controller, unit = divmod(i, 15)
+        vmx.connect_disk("disk{0}.vmdk".format(i), "scsi{0}:{1}".format(controller, unit))
+        vmx["scsi{0}:{1}.sched.mem.pshare.enable".format(controller, unit)] = False
+    vmx.write()
+    return vmx
+
+
+def timed(func, repeat):
+    started = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - started) / repeat
+
+
+def run(devices, repeat):
+    directory = tempfile.mkdtemp()
+    try:
+        original = make_vmx(directory, devices)
+
+        def save():
+            vmx = VMX(directory, "bench")
+            vmx["memsize"] = 1024
+            vmx.write()
+
+        load = timed(lambda: VMX(directory, "bench"), repeat)
+        save = timed(save, repeat)
+        lines = len(original.lines)
+        round_trip = VMX(directory, "bench").serialise() == open(original.pathname).read()
+    finally:
+        shutil.rmtree(directory)
+    return {
+        "lines": lines,
+        "load": load,
+        "save": save,
+        "round_trip": round_trip,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading and writing VMX files")
+    parser.add_argument("--devices", type=int, default=64, help="the number of network interfaces and of disks")
+    parser.add_argument("--repeat", type=int, default=100, help="how many times to load and save the file")
+    args = parser.parse_args()
+    r = run(args.devices, args.repeat)
+    print "VMX file of %d lines" % r['lines']
+    print "Load: %0.2fms" % (r['load'] * 1000)
+    print "Load, change and save: %0.2fms" % (r['save'] * 1000)
+    print "Round trip exact: %s" % r['round_trip']
+
+if __name__ == "__main__":
+    main()
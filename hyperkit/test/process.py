@@ -0,0 +1,37 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from StringIO import StringIO
+
+
+class FakeProcess(object):
+
+    """ Stands in for a subprocess.Popen, with the output given. """
+
+    pid = 1234
+
+    def __init__(self, stdout="", stderr="", returncode=0):
+        self.stdout = StringIO(stdout)
+        self.stderr = StringIO(stderr)
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+
+def fake_popen(m_popen, stdout="", stderr="", returncode=0):
+    """ Make the mock of subprocess.Popen start a new FakeProcess, with the
+    output given, every time it is called. """
+    m_popen.side_effect = lambda *args, **kwargs: FakeProcess(stdout, stderr, returncode)
@@ -0,0 +1,133 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+A local HTTP server that stands in for distribution image servers in tests.
+It serves fixture images from memory, and supports the conditional and
+range requests the download engine relies on.
+
+"""
+
+import re
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+class ImageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        server = self.server
+        server.requests.append((self.command, self.path, dict(self.headers)))
+        if self.path not in server.images:
+            self.send_error(404)
+            return
+        data = server.images[self.path]
+        etag = '"{0}"'.format(server.etags[self.path])
+        if self.headers.getheader("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, len(data)
+        status = 200
+        range_header = self.headers.getheader("Range")
+        if_range = self.headers.getheader("If-Range")
+        if server.ranges and range_header and if_range in (None, etag, server.last_modified):
+            m = re.match(r"bytes=(\d+)-(\d*)$", range_header)
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)) + 1, len(data))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0}".format(len(data)))
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", server.last_modified)
+        self.send_header("Content-Length", str(end - start))
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end - 1, len(data)))
+        self.end_headers()
+        if send_body:
+            body = data[start:end]
+            if server.truncate is not None:
+                body = body[:server.truncate]
+            self.write_body(body)
+
+    def write_body(self, body):
+        """ Write the body, limited to the server rate if it has one. """
+        rate = self.server.rate
+        if rate is None:
+            self.wfile.write(body)
+            return
+        chunk = max(rate / 20, 1)
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            time.sleep(float(chunk) / rate)
+
+
+class ImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """ Serves the images provided, a dictionary of data keyed on path, on
+    an ephemeral port of localhost. Requests made are recorded in
+    requests. Set ranges to False to behave like a server that does not
+    support range requests, truncate to a number of bytes to simulate an
+    interrupted transfer, and rate to limit each connection to that many
+    bytes per second. """
+
+    daemon_threads = True
+    last_modified = "Thu, 01 Jan 2015 00:00:00 GMT"
+
+    def __init__(self, images, ranges=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), ImageRequestHandler)
+        self.images = {}
+        self.etags = {}
+        for path, data in images.items():
+            self.set_image(path, data)
+        self.ranges = ranges
+        self.truncate = None
+        self.rate = None
+        self.requests = []
+
+    def set_image(self, path, data):
+        self.images[path] = data
+        self.etags[path] = "{0:x}".format(hash(data) & 0xffffffff)
+
+    def url(self, path):
+        return "http://127.0.0.1:{0}{1}".format(self.server_address[1], path)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05, ))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
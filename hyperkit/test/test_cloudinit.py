@@ -1,7 +1,11 @@
 import unittest2
 import mock
+import os
 import crypt
 import yaml
+import shutil
+import tempfile
+import StringIO
 
 from hyperkit import cloudinit
 
@@ -13,7 +17,7 @@ class TestCloudConfig(unittest2.TestCase):
         self.spec.auth.username = "foo"
         self.spec.auth.password = "bar"
         self.spec.auth.public_key = None
-        self.c = cloudinit.CloudConfig(self.spec)
+        self.c = cloudinit.CloudConfig(self.spec, secret="secret")
 
     def test_get_config(self):
         config = self.c.get_config()
@@ -33,6 +37,36 @@ class TestCloudConfig(unittest2.TestCase):
     def test_generate_salt(self):
         salt = self.c.generate_salt()
         self.assertEqual(len(salt), 16)
+        self.assertEqual(salt, self.c.generate_salt())
+        self.assertNotEqual(salt, cloudinit.CloudConfig(self.spec, secret="other").generate_salt())
+        self.spec.auth.password = "baz"
+        self.assertEqual(salt, self.c.generate_salt())
+        self.spec.auth.username = "bar"
+        self.assertNotEqual(salt, self.c.generate_salt())
+
+    def test_generate_salt_random(self):
+        c = cloudinit.CloudConfig(self.spec)
+        salt = c.generate_salt()
+        self.assertEqual(len(salt), 16)
+        self.assertNotEqual(salt, c.generate_salt())
+
+    @mock.patch("crypt.crypt")
+    def test_encrypt_cached(self, m_crypt):
+        m_crypt.return_value = "hash"
+        cloudinit.hashes.clear()
+        self.addCleanup(cloudinit.hashes.clear)
+        other = cloudinit.CloudConfig(self.spec, secret="secret")
+        self.assertEqual(self.c.encrypt("bar"), other.encrypt("bar"))
+        self.assertEqual(m_crypt.call_count, 1)
+
+    def test_deterministic(self):
+        other = cloudinit.CloudConfig(self.spec, secret="secret")
+        self.assertEqual(self.c.open().read(), other.open().read())
+
+    def test_write(self):
+        f = StringIO.StringIO()
+        self.c.write(f)
+        self.assertEqual(f.getvalue(), "#cloud-config\n" + yaml.dump(self.c.get_config(), Dumper=yaml.Dumper))
 
     def test_open(self):
         stream = self.c.open()
@@ -64,42 +98,74 @@ class TestMetaData(unittest2.TestCase):
 
 class TestSeed(unittest2.TestCase):
 
-    @mock.patch("tempfile.mkdtemp")
-    def setUp(self, m_mkdtemp):
-        m_mkdtemp.return_value = "/tmpdir"
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.instance_dir = os.path.join(self.directory, "foo")
+        os.mkdir(self.instance_dir)
         self.cloud_config = mock.MagicMock()
         self.cloud_config.filename = "user-data"
-        self.meta_data = mock.MagicMock()
-        self.meta_data.filename = "meta-data"
-        self.seed = cloudinit.Seed("/does_not_exist", self.cloud_config, self.meta_data)
+        self.cloud_config.open.side_effect = lambda: StringIO.StringIO("#cloud-config\n")
+        self.meta_data = cloudinit.MetaData("foo")
+        self.seed = cloudinit.Seed(self.instance_dir, self.cloud_config, self.meta_data)
 
     def test_pathname(self):
-        self.assertEqual(self.seed.pathname, "/does_not_exist/seed.iso")
+        seed = cloudinit.Seed("/does_not_exist", self.cloud_config, self.meta_data)
+        self.assertEqual(seed.pathname, "/does_not_exist/seed.iso")
 
     def test_filenames(self):
         self.assertEqual(list(self.seed.filenames), ["user-data", "meta-data"])
 
     @mock.patch("subprocess.Popen")
-    @mock.patch("__builtin__.open")
-    @mock.patch("os.unlink")
-    @mock.patch("os.rmdir")
-    @mock.patch("os.path.isfile")
-    @mock.patch("os.access")
-    def test_write(self, m_access, m_isfile, m_rmdir, m_unlink, m_open, m_popen):
-        m_access.return_value = m_isfile.return_value = True
-        m_popen().communicate.return_value = ["", ""]
-        m_popen().returncode = 0
-        with mock.patch.dict("os.environ", {"PATH": "/usr/bin"}):
-            self.seed.write()
-        self.assertEqual(m_open.call_args_list, [mock.call("/tmpdir/user-data", "w"), mock.call("/tmpdir/meta-data", "w")])
-        self.assertEqual(m_unlink.call_args_list, [mock.call("/tmpdir/user-data"), mock.call("/tmpdir/meta-data")])
-        self.assertEqual(m_rmdir.call_args, mock.call("/tmpdir"))
-        self.assertEqual(m_popen.call_args, mock.call(
-            stdin=None,
-            args=['/usr/bin/genisoimage',
-                  '-output',
-                  '/does_not_exist/seed.iso',
-                  '-volid', 'cidata',
-                  '-joliet', '-rock',
-                  'user-data', 'meta-data'],
-            cwd='/tmpdir', stderr=-1, stdout=-1))
+    def test_write(self, m_popen):
+        self.seed.write()
+        self.assertFalse(m_popen.called)
+        data = open(self.seed.pathname, "rb").read()
+        self.assertEqual(data, self.seed.image(self.seed.payloads()))
+        self.assertEqual(data[32768 + 40:32768 + 46], "cidata")
+        self.assertIn("#cloud-config\n", data)
+
+    def test_write_cached(self):
+        cache = cloudinit.SeedCache(os.path.join(self.directory, "seeds"))
+        self.seed.write(cache)
+        other_dir = os.path.join(self.directory, "bar")
+        os.mkdir(other_dir)
+        other = cloudinit.Seed(other_dir, self.cloud_config, self.meta_data)
+        with mock.patch.object(other, "image") as m_image:
+            other.write(cache)
+            self.assertFalse(m_image.called)
+        self.assertTrue(os.path.samefile(self.seed.pathname, other.pathname))
+        self.assertEqual(len(os.listdir(cache.directory)), 1)
+
+    def test_digest(self):
+        payloads = self.seed.payloads()
+        self.assertEqual(self.seed.digest(payloads), self.seed.digest(self.seed.payloads()))
+        changed = [("user-data", "#cloud-config\n"), ("meta-data", "instance-id: bar\n")]
+        self.assertNotEqual(self.seed.digest(payloads), self.seed.digest(changed))
+
+    def test_prune(self):
+        cache = cloudinit.SeedCache(os.path.join(self.directory, "seeds"))
+        self.seed.write(cache)
+        self.assertEqual(cache.prune(), 0)
+        os.unlink(self.seed.pathname)
+        self.assertEqual(cache.prune(), 1)
+        self.assertEqual(os.listdir(cache.directory), [])
+
+
+class TestLoadSecret(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.pathname = os.path.join(self.directory, "secret")
+
+    def test_load_secret(self):
+        secret = cloudinit.load_secret(self.pathname)
+        self.assertEqual(len(secret), 32)
+        self.assertEqual(cloudinit.load_secret(self.pathname), secret)
+        self.assertEqual(os.stat(self.pathname).st_mode & 0777, 0600)
+        self.assertEqual(os.listdir(self.directory), ["secret"])
+
+    def test_load_secret_unique(self):
+        other = os.path.join(self.directory, "other")
+        self.assertNotEqual(cloudinit.load_secret(self.pathname), cloudinit.load_secret(other))
@@ -3,6 +3,9 @@ import mock
 import unittest2
 import hashlib
 import urllib2
+import tempfile
+import shutil
+import os
 
 from hyperkit.distro import distro
 from hyperkit.distro.ubuntu import UbuntuCloudImage
@@ -32,18 +35,18 @@ class TestDistroImage(unittest2.TestCase):
     def setUp(self):
         self.image = MockDistroImage("pathname", "release", "arch")
 
-    @mock.patch('urllib2.urlopen')
-    @mock.patch('__builtin__.open')
-    def test_fetch(self, m_open, m_urlopen):
-        m_urlopen().read.side_effect = ["foo", "bar", ""]
+    @mock.patch('hyperkit.distro.distro.SegmentedDownload')
+    def test_fetch(self, m_download):
+        self.image.fetch()
+        self.assertEqual(m_download.call_args, mock.call('remote_image_url', 'pathname', [hashlib.md5]))
+        self.assertEqual(m_download().blocksize, 81920)
+        self.assertEqual(m_download().fetch.call_args, mock.call(conditional=True))
+        self.image.remote_hash = "foo"
         self.image.fetch()
-        self.assertEqual(m_urlopen.call_args, mock.call('remote_image_url'))
-        self.assertEqual(m_open.call_args, mock.call('pathname', 'w'))
-        self.assertEqual(m_open().write.call_args_list, [mock.call('foo'), mock.call('bar')])
+        self.assertEqual(m_download().fetch.call_args, mock.call(conditional=False))
 
     @mock.patch('urllib2.urlopen')
-    @mock.patch('__builtin__.open')
-    def test_fetch_httperror(self, m_open, m_urlopen):
+    def test_fetch_httperror(self, m_urlopen):
         m_urlopen.side_effect = urllib2.HTTPError(*[None] * 5)
         self.assertRaises(error.FetchFailedException, self.image.fetch)
 
@@ -97,9 +100,31 @@ class TestDistroImage(unittest2.TestCase):
     @mock.patch('__builtin__.open')
     def test_get_local_sum(self, m_open, m_exists):
         m_exists.return_value = True
-        m_open().read.return_value = "foobar"
+        m_open().read.side_effect = ["foo", "bar", ""]
         self.assertEqual(self.image.get_local_sum(), "3858f62230ac3c915f300c664312c63f")
 
+    def test_get_local_sum_cached(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.image.pathname = os.path.join(directory, "image.qcow2")
+            open(self.image.pathname, "w").write("foobar")
+            self.assertEqual(self.image.get_local_sum(), "3858f62230ac3c915f300c664312c63f")
+            with mock.patch("hyperkit.distro.distro.file_digest") as m_digest:
+                self.assertEqual(self.image.get_local_sum(), "3858f62230ac3c915f300c664312c63f")
+                self.assertFalse(m_digest.called)
+            open(self.image.pathname, "w").write("foobarbaz")
+            self.assertEqual(self.image.get_local_sum(), "6df23dc03f9b54cc38a0fc1483df6e21")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_update_unchanged(self):
+        self.image.update_hashes = mock.MagicMock()
+        self.image.fetch = mock.MagicMock()
+        self.image.local_hash = self.image.remote_hash = "foo"
+        self.image.update()
+        self.assertEqual(self.image.update_hashes.call_count, 1)
+        self.assertFalse(self.image.fetch.called)
+
     def test_requires_update(self):
         self.image.local_hash = None
         self.assertEqual(self.image.requires_update(), True)
@@ -120,7 +145,7 @@ class TestDistroImage(unittest2.TestCase):
         """
         self.image.remote_hash = None
         m_exists.return_value = True
-        m_open().read.return_value = "foobar"
+        m_open().read.side_effect = ["foo", "bar", ""]
         self.image.update_hashes()
         self.assertEqual(self.image.remote_hash, "foo")
         self.assertEqual(self.image.local_hash, "3858f62230ac3c915f300c664312c63f")
@@ -202,7 +227,7 @@ class TestFedoraImage(unittest2.TestCase):
         m_urlopen().read.return_value = fedora_hashfile
         self.image.remote_hash = None
         m_exists.return_value = True
-        m_open().read.return_value = "foobar"
+        m_open().read.side_effect = ["foo", "bar", ""]
         self.image.update_hashes()
         self.assertEqual(self.image.remote_hash, "b4bce4a24caaa2e480eb1c79210509771f5ce47c903aaa28a41f416588d60d74")
         self.assertEqual(self.image.local_hash, "c3ab8ff13720e8ad9047dd39466b3c8974e592c2fa383d4a3960714caef0c4f2")
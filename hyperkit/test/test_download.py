@@ -0,0 +1,154 @@
+import unittest2
+import tempfile
+import hashlib
+import shutil
+import os
+import httplib
+import mock
+
+from hyperkit.download import Download, SegmentedDownload
+from hyperkit.sidecar import Sidecar
+from hyperkit.test.server import ImageServer
+from hyperkit import error
+
+image = "".join(chr(i % 251) for i in range(300000))
+
+
+class TestDownload(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pathname = os.path.join(self.directory, "image.qcow2")
+        self.server = ImageServer({"/image.img": image}).__enter__()
+        self.download = Download(self.server.url("/image.img"), self.pathname, [hashlib.md5])
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def test_fetch(self):
+        self.assertEqual(self.download.fetch(), True)
+        self.assertEqual(open(self.pathname).read(), image)
+        self.assertFalse(os.path.exists(self.download.part_pathname))
+        sidecar = Sidecar(self.pathname)
+        self.assertEqual(sidecar["digests"], {"md5": hashlib.md5(image).hexdigest()})
+        self.assertEqual(sidecar["etag"], '"{0}"'.format(self.server.etags["/image.img"]))
+        self.assertEqual(sidecar["last_modified"], self.server.last_modified)
+        self.assertTrue("checked" in sidecar)
+
+    def test_fetch_not_modified(self):
+        self.download.fetch()
+        sidecar = Sidecar(self.pathname)
+        sidecar["checked"] = 0
+        sidecar.save()
+        self.assertEqual(self.download.fetch(), False)
+        self.assertNotEqual(Sidecar(self.pathname)["checked"], 0)
+        method, path, headers = self.server.requests[-1]
+        self.assertEqual(headers["if-none-match"], '"{0}"'.format(self.server.etags["/image.img"]))
+        self.assertEqual(headers["if-modified-since"], self.server.last_modified)
+
+    def test_fetch_unconditional(self):
+        self.download.fetch()
+        self.assertEqual(self.download.fetch(conditional=False), True)
+        method, path, headers = self.server.requests[-1]
+        self.assertFalse("if-none-match" in headers)
+
+    def test_fetch_changed(self):
+        self.download.fetch()
+        self.server.set_image("/image.img", image[::-1])
+        self.assertEqual(self.download.fetch(), True)
+        self.assertEqual(open(self.pathname).read(), image[::-1])
+
+    def test_fetch_missing(self):
+        self.download.url = self.server.url("/missing.img")
+        self.assertRaises(error.FetchFailedException, self.download.fetch)
+        self.assertFalse(os.path.exists(self.pathname))
+
+    def test_resume(self):
+        self.server.truncate = 100000
+        self.assertRaises(error.FetchFailedException, self.download.fetch)
+        self.assertFalse(os.path.exists(self.pathname))
+        self.assertEqual(os.path.getsize(self.download.part_pathname), 100000)
+        self.server.truncate = None
+        self.assertEqual(self.download.fetch(), True)
+        method, path, headers = self.server.requests[-1]
+        self.assertEqual(headers["range"], "bytes=100000-")
+        self.assertEqual(open(self.pathname).read(), image)
+        self.assertEqual(Sidecar(self.pathname)["digests"], {"md5": hashlib.md5(image).hexdigest()})
+
+    def test_resume_changed(self):
+        self.server.truncate = 100000
+        self.assertRaises(error.FetchFailedException, self.download.fetch)
+        self.server.truncate = None
+        self.server.set_image("/image.img", image[::-1])
+        self.assertEqual(self.download.fetch(), True)
+        self.assertEqual(open(self.pathname).read(), image[::-1])
+
+    def test_resume_without_validators(self):
+        open(self.download.part_pathname, "w").write("junk")
+        self.assertEqual(self.download.fetch(), True)
+        method, path, headers = self.server.requests[-1]
+        self.assertFalse("range" in headers)
+        self.assertEqual(open(self.pathname).read(), image)
+
+
+class TestSegmentedDownload(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pathname = os.path.join(self.directory, "image.qcow2")
+        self.server = ImageServer({"/image.img": image}).__enter__()
+        self.download = SegmentedDownload(self.server.url("/image.img"), self.pathname, [hashlib.md5, hashlib.sha256])
+        self.download.segment_size = 40000
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def ranges(self):
+        return sorted(headers["range"] for method, path, headers in self.server.requests if "range" in headers)
+
+    def test_segments(self):
+        self.assertEqual(self.download.segments(100000), [(0, 40000), (40000, 80000), (80000, 100000)])
+
+    def test_fetch(self):
+        self.assertEqual(self.download.fetch(), True)
+        self.assertEqual(open(self.pathname).read(), image)
+        self.assertFalse(os.path.exists(self.download.part_pathname))
+        self.assertEqual(len(self.ranges()), 8)
+        self.assertEqual(self.ranges()[0], "bytes=0-39999")
+        self.assertEqual(Sidecar(self.pathname)["digests"], {
+            "md5": hashlib.md5(image).hexdigest(),
+            "sha256": hashlib.sha256(image).hexdigest(),
+        })
+
+    def test_fetch_not_modified(self):
+        self.download.fetch()
+        del self.server.requests[:]
+        self.assertEqual(self.download.fetch(), False)
+        self.assertEqual([r[0] for r in self.server.requests], ["HEAD"])
+
+    def test_fetch_without_ranges(self):
+        self.server.ranges = False
+        self.assertEqual(self.download.fetch(), True)
+        self.assertEqual(open(self.pathname).read(), image)
+        self.assertEqual(self.ranges(), [])
+        self.assertEqual([r[0] for r in self.server.requests], ["HEAD", "GET"])
+
+    def test_fetch_small(self):
+        self.download.segment_size = 200000
+        self.assertEqual(self.download.fetch(), True)
+        self.assertEqual(open(self.pathname).read(), image)
+        self.assertEqual(self.ranges(), [])
+
+    def test_fetch_interrupted(self):
+        self.server.truncate = 1000
+        self.assertRaises(error.FetchFailedException, self.download.fetch)
+        self.assertFalse(os.path.exists(self.pathname))
+        self.assertFalse(os.path.exists(self.download.part_pathname))
+
+    def test_fetch_segment_error(self):
+        with mock.patch.object(self.download, "fetch_segment") as fetch_segment:
+            fetch_segment.side_effect = httplib.BadStatusLine("")
+            self.assertRaises(error.FetchFailedException, self.download.fetch)
+        self.assertFalse(os.path.exists(self.pathname))
@@ -0,0 +1,42 @@
+import unittest2
+import mock
+import hashlib
+import tempfile
+import os
+
+from hyperkit import hashing
+
+
+class TestMultiHasher(unittest2.TestCase):
+
+    def test_update(self):
+        h = hashing.MultiHasher(hashlib.md5, hashlib.sha256)
+        h.update("foo")
+        h.update("bar")
+        self.assertEqual(h.hexdigests(), [
+            "3858f62230ac3c915f300c664312c63f",
+            "c3ab8ff13720e8ad9047dd39466b3c8974e592c2fa383d4a3960714caef0c4f2",
+        ])
+
+    def test_update_from_file(self):
+        h = hashing.MultiHasher(hashlib.md5)
+        h.blocksize = 3
+        f = mock.MagicMock()
+        f.read.side_effect = ["foo", "bar", ""]
+        self.assertEqual(h.update_from_file(f), 6)
+        self.assertEqual(f.read.call_args_list, [mock.call(3)] * 3)
+        self.assertEqual(h.hexdigests(), ["3858f62230ac3c915f300c664312c63f"])
+
+    def test_file_digests(self):
+        fd, pathname = tempfile.mkstemp()
+        try:
+            os.write(fd, "foobar" * 1000)
+            os.close(fd)
+            self.assertEqual(hashing.file_digests(pathname, hashlib.md5, hashlib.sha1), [
+                hashlib.md5("foobar" * 1000).hexdigest(),
+                hashlib.sha1("foobar" * 1000).hexdigest(),
+            ])
+            self.assertEqual(hashing.file_digest(pathname, hashlib.md5),
+                             hashlib.md5("foobar" * 1000).hexdigest())
+        finally:
+            os.unlink(pathname)
@@ -1,13 +1,18 @@
 
 import unittest2
 import mock
+import os
+import threading
+import time
 
 from hyperkit.hypervisor import command
+from hyperkit.test.process import FakeProcess, fake_popen
 
 
 class TestCommand(unittest2.TestCase):
 
     def setUp(self):
+        command.registry.reset()
         self.logger = mock.MagicMock()
         command.logger = self.logger
         self.command = command.Command()
@@ -56,32 +61,66 @@ class TestCommand(unittest2.TestCase):
         self.assertEquals(self.command.compose("foo", "quux", baz="zorg"), [
             "/fake_bin1/thing", "bar", "zorg", "quux"])
 
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    def test_pathname_cached(self, m_access, m_isfile):
+        m_isfile.return_value = m_access.return_value = True
+        self.assertEqual(self.command.pathname, "/fake_bin1/thing")
+        self.assertEqual(self.command.pathname, "/fake_bin1/thing")
+        self.assertEqual(m_isfile.call_count, 1)
+        # a different $PATH may find a different binary
+        with mock.patch.dict("os.environ", {'PATH': "/other_bin"}):
+            self.command.pathname
+        self.assertEqual(m_isfile.call_count, 2)
+
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    def test_pin(self, m_access, m_isfile):
+        m_isfile.return_value = m_access.return_value = True
+        command.registry.pin("thing", "/opt/thing")
+        self.assertEqual(self.command.pathname, "/opt/thing")
+        m_isfile.return_value = False
+        self.assertRaises(OSError, command.registry.pin, "thing", "/missing/thing")
+
+    @mock.patch("hyperkit.hypervisor.command.stat_key")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    @mock.patch("subprocess.Popen")
+    def test_call_moved_binary(self, m_popen, m_access, m_isfile, m_stat_key):
+        m_isfile.side_effect = lambda x: x == "/fake_bin1/thing"
+        m_access.return_value = True
+        m_stat_key.return_value = (1, 1, 1)
+        self.assertEqual(self.command.pathname, "/fake_bin1/thing")
+        # the binary moves, so running it fails
+        m_isfile.side_effect = lambda x: x == "/fake_bin2/thing"
+        m_stat_key.return_value = None
+        m_popen.side_effect = [OSError(2, "No such file or directory"), FakeProcess("blah")]
+        self.assertEqual(self.command("foo", baz="zorg"), "blah")
+        self.assertEqual(m_popen.call_args[1]["args"], ["/fake_bin2/thing", "bar", "zorg"])
+
     def test_parse(self):
         self.assertEqual(self.command.parse("foo ", "bar"), "foo")
 
     @mock.patch("subprocess.Popen")
     def test_execute(self, m_popen):
-        m_popen().communicate.return_value = ["blah ", "errol"]
-        m_popen().returncode = 0
+        fake_popen(m_popen, "blah \n", "errol\n")
         stdout = self.command.execute(["foo", "bar"], None)
         self.assertEqual(stdout, "blah")
         self.assertEqual(m_popen.call_args, mock.call(
             stdin=None,
             args=["foo", "bar"],
             cwd=None,
-            stderr=-1, stdout=-1))
-        self.assertEqual(self.logger.debug.call_args_list, [
-            mock.call('Output from foo bar'),
-            mock.call('STDOUT: blah '),
-            mock.call('STDERR: errol'),
+            stderr=-1, stdout=-1, preexec_fn=os.setsid))
+        self.assertEqual(sorted(self.logger.debug.call_args_list), [
+            mock.call('thing[1234] STDERR: errol'),
+            mock.call('thing[1234] STDOUT: blah '),
         ])
 
     @mock.patch("os.path.isfile")
     @mock.patch("os.access")
     @mock.patch("subprocess.Popen")
     def test_call(self, m_popen, m_access, m_isfile):
-        m_popen().communicate.return_value = ["blah ", "errol"]
-        m_popen().returncode = 0
+        fake_popen(m_popen, "blah ", "errol")
         m_isfile.return_value = m_access.return_value = True
         stdout = self.command("foo", baz="zorg")
         self.assertEquals(stdout, "blah")
@@ -89,11 +128,104 @@ class TestCommand(unittest2.TestCase):
             stdin=None,
             args=["/fake_bin1/thing", "bar", "zorg"],
             cwd=None,
-            stderr=-1, stdout=-1))
+            stderr=-1, stdout=-1, preexec_fn=os.setsid))
         stdout = self.command("foo", baz="zorg", cwd="/does_not_exist")
         self.assertEquals(stdout, "blah")
         self.assertEqual(m_popen.call_args, mock.call(
             stdin=None,
             args=["/fake_bin1/thing", "bar", "zorg"],
             cwd="/does_not_exist",
-            stderr=-1, stdout=-1))
+            stderr=-1, stdout=-1, preexec_fn=os.setsid))
+
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    @mock.patch("subprocess.Popen")
+    def test_submit(self, m_popen, m_access, m_isfile):
+        m_isfile.return_value = m_access.return_value = True
+        fake_popen(m_popen, "blah")
+        execution = self.command.submit("foo", baz="zorg")
+        self.assertEqual(execution.result(5), "blah")
+        fake_popen(m_popen, "", "oops", 1)
+        self.assertRaises(command.CommandException, self.command.submit("foo", baz="zorg").result, 5)
+
+    def test_result_timeout(self):
+        release = threading.Event()
+        execution = command.Execution(release.wait)
+        self.assertRaises(command.CommandTimeout, execution.result, 0.01)
+        release.set()
+        self.assertEqual(execution.result(5), True)
+
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    def test_concurrency(self, m_access, m_isfile):
+        m_isfile.return_value = m_access.return_value = True
+        self.command.concurrency = 2
+        self.addCleanup(command.semaphores.pop, "thing", None)
+        lock = threading.Lock()
+        self.running = self.most = 0
+
+        def execute(cmd, cwd, timeout=None, subcommand=None):
+            with lock:
+                self.running += 1
+                self.most = max(self.most, self.running)
+            time.sleep(0.02)
+            with lock:
+                self.running -= 1
+        self.command.execute = execute
+        executions = [self.command.submit("foo", baz=str(i)) for i in range(6)]
+        for e in executions:
+            e.result(5)
+        self.assertEqual(self.most, 2)
+
+    @mock.patch("time.sleep")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    @mock.patch("subprocess.Popen")
+    def test_retry_transient(self, m_popen, m_access, m_isfile, m_sleep):
+        m_isfile.return_value = m_access.return_value = True
+        self.command.transient_errors = [r"already locked"]
+        locked = "error: The machine 'foo' is already locked for a session\n"
+        m_popen.side_effect = [FakeProcess(stderr=locked, returncode=1), FakeProcess("blah")]
+        self.assertEqual(self.command("foo", baz="zorg"), "blah")
+        self.assertEqual(m_popen.call_count, 2)
+        # other errors, and persistent transient ones, are raised
+        m_popen.side_effect = lambda *args, **kwargs: FakeProcess(stderr=locked, returncode=1)
+        self.assertRaises(command.CommandException, self.command, "foo", baz="zorg")
+        self.assertEqual(m_popen.call_count, 2 + 1 + self.command.retries)
+        m_popen.side_effect = lambda *args, **kwargs: FakeProcess(stderr="no such machine", returncode=1)
+        self.assertRaises(command.CommandException, self.command, "foo", baz="zorg")
+
+    @mock.patch("time.sleep")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    @mock.patch("subprocess.Popen")
+    def test_retry_transient_subcommands(self, m_popen, m_access, m_isfile, m_sleep):
+        m_isfile.return_value = m_access.return_value = True
+        self.command.transient_errors = [r"already locked"]
+        self.command.transient_subcommands = set(["bar"])
+        fake_popen(m_popen, stderr="error: The machine 'foo' is already locked for a session\n", returncode=1)
+        self.assertRaises(command.CommandException, self.command, "foo", baz="zorg")
+        self.assertEqual(m_popen.call_count, 1)
+        self.assertFalse(m_sleep.called)
+
+
+class TestCommandTimeout(unittest2.TestCase):
+
+    def setUp(self):
+        command.registry.reset()
+        self.command = command.Command()
+        self.command.command_name = "sh"
+        self.command.subcommands = {"run": ["-c", "{script}"]}
+        self.command.kill_grace = 1
+
+    def test_timeout(self):
+        started = time.time()
+        # the background sleep holds the output open, so the whole process
+        # group has to be killed
+        self.assertRaises(command.CommandTimeout, self.command, "run", script="sleep 30 & sleep 30", command_timeout=0.2)
+        self.assertLess(time.time() - started, 5)
+
+    def test_subcommand_timeout(self):
+        self.command.timeouts = {"run": 0.2}
+        self.assertRaises(command.CommandTimeout, self.command, "run", script="sleep 30")
+        self.assertEqual(self.command("run", script="echo done"), "done")
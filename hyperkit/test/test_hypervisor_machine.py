@@ -2,8 +2,12 @@
 import unittest2
 import mock
 import datetime
+import tempfile
+import shutil
+import os
 
 from hyperkit.hypervisor import machine
+from hyperkit import trace
 
 fixed_date = datetime.datetime(2001, 1, 1)
 
@@ -72,13 +76,95 @@ class TestMachineInstance(unittest2.TestCase):
         self.assertEqual(self.t, 6)
 
 
+class TestWaitAll(unittest2.TestCase):
+
+    def instance(self, name, ready_at):
+        m = mock.MagicMock()
+        m.instance_id = name
+        m.timeout = 30
+        m.blocking_wait = False
+        m.get_ip.side_effect = lambda: name + "-ip" if self.t >= ready_at else None
+        return m
+
+    @mock.patch("time.time")
+    @mock.patch("time.sleep")
+    def test_wait_all(self, m_sleep, m_time):
+        self.t = 0
+        m_time.side_effect = lambda: self.t
+
+        def sleep(x):
+            self.t += 1
+        m_sleep.side_effect = sleep
+        a = self.instance("a", 3)
+        b = self.instance("b", 1)
+        c = self.instance("c", 100)
+        results = []
+        for instance, ip in machine.wait_all([a, b, c], 5):
+            results.append((instance.instance_id, ip, self.t))
+        # each instance is reported as soon as it is ready
+        self.assertEqual(results, [("b", "b-ip", 1), ("a", "a-ip", 3), ("c", None, 6)])
+        # ready instances are not polled again
+        self.assertEqual(b.get_ip.call_count, 2)
+        self.assertEqual(m_sleep.call_count, 6)
+
+    def test_wait_all_blocking(self):
+        self.t = 0
+        a = self.instance("a", 0)
+        a.get_ip.side_effect = [None, None, "a-ip"]
+        a.blocking_wait = True
+        a.block.return_value = True
+        results = list(machine.wait_all([a], 0))
+        self.assertEqual(results, [(a, "a-ip")])
+        # the watcher blocks between checks rather than polling
+        self.assertEqual(a.block.call_count, 2)
+
+    @mock.patch("time.time")
+    @mock.patch("time.sleep")
+    def test_wait_all_query(self, m_sleep, m_time):
+        self.t = 0
+        m_time.side_effect = lambda: self.t
+        m_sleep.side_effect = lambda x: setattr(self, "t", self.t + 1)
+        a = self.instance("a", 2)
+        b = self.instance("b", 1)
+        # blocking instances are polled too
+        b.blocking_wait = True
+        polled = []
+
+        def query(pending):
+            polled.append([i.instance_id for i in pending])
+            return dict((i, i.get_ip()) for i in pending)
+        results = [(i.instance_id, ip) for i, ip in machine.wait_all([a, b], 5, query)]
+        self.assertEqual(results, [("b", "b-ip"), ("a", "a-ip")])
+        # one query a round, for the instances still pending
+        self.assertEqual(polled, [["a", "b"], ["a", "b"], ["a"]])
+        self.assertFalse(b.block.called)
+
+    def test_backoff(self):
+        delays = machine.backoff(1, 2, 5)
+        self.assertEqual([next(delays) for i in range(5)], [1, 2, 4, 5, 5])
+
+
+class TestParallel(unittest2.TestCase):
+
+    def test_parallel(self):
+        def func(x):
+            if x == 2:
+                raise ValueError("two")
+            return x * 10
+        results = machine.parallel(func, [1, 2, 3], 2)
+        self.assertEqual([r for r, e in results], [10, None, 30])
+        self.assertEqual([str(e) for r, e in results if e], ["two"])
+
+
 class MockHypervisor(machine.Hypervisor):
 
     instance = mock.MagicMock()
     directory = "/fake_dir"
 
-    def create(self, spec, image_dir="~/.hyperkit"):
-        return mock.MagicMock()
+    def build(self, spec, instance_id, source, linked=False):
+        with trace.span("register", instance=instance_id):
+            if spec.name in getattr(self, "failing", ()):
+                raise RuntimeError("build failed")
 
     def __str__(self):
         return "Mock Hypervisor"
@@ -91,6 +177,18 @@ class TestHypervisor(unittest2.TestCase):
 
     def setUp(self):
         self.hypervisor = MockHypervisor()
+        self.hypervisor.image_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.hypervisor.image_dir)
+
+    def create_spec(self):
+        """ Return a spec for creating machines named foo, in a new instance
+        directory. """
+        self.hypervisor.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.hypervisor.directory)
+        spec = mock.MagicMock()
+        spec.name = "foo"
+        spec.image.fetch.return_value = "/var/images/foo.qcow2"
+        return spec
 
     @mock.patch("os.path.expanduser")
     def test_set_image_dir(self, m_expanduser):
@@ -124,11 +222,115 @@ class TestHypervisor(unittest2.TestCase):
         spec.name = "foo"
         self.assertEqual(self.hypervisor.get_instance_id(spec), "foo-2001-01-01-03")
 
+    @mock.patch("os.path.isdir")
     @mock.patch("os.listdir")
-    def test_instances(self, m_listdir):
-        m_listdir.return_value = ['foo', 'bar', 'baz']
-        self.assertEqual(list(self.hypervisor.instances()), [
-            self.hypervisor.instance("/fake_dir/foo"),
-            self.hypervisor.instance("/fake_dir/bar"),
-            self.hypervisor.instance("/fake_dir/baz"),
-        ])
+    def test_instances(self, m_listdir, m_isdir):
+        m_listdir.return_value = ['foo', 'bar', 'baz', 'notes.txt']
+        m_isdir.side_effect = lambda pathname: not pathname.endswith(".txt")
+        self.hypervisor.instance = lambda directory, name: mock.Mock(instance_id=name)
+        self.assertEqual([i.instance_id for i in self.hypervisor.instances()], ["bar", "baz", "foo"])
+
+    def test_lazy(self):
+        class Thing(object):
+            calls = 0
+
+            @machine.lazy
+            def value(self):
+                self.calls += 1
+                return self.calls
+        thing = Thing()
+        self.assertEqual(thing.calls, 0)
+        self.assertEqual(thing.value, 1)
+        self.assertEqual(thing.value, 1)
+        thing.value = 5
+        self.assertEqual(thing.value, 5)
+
+    def test_create_disk(self):
+        image_dir = self.hypervisor.image_dir
+        self.hypervisor.qemu_img = mock.MagicMock()
+        self.hypervisor.qemu_img.side_effect = lambda *a, **kw: open(kw["destination"], "w").write("converted")
+        self.hypervisor.disk_copied = mock.MagicMock()
+        source = os.path.join(image_dir, "ubuntu.qcow2")
+        open(source, "w").write("foo")
+        self.hypervisor.create_disk(source, os.path.join(image_dir, "disk1.vdi"), "vdi")
+        self.hypervisor.create_disk(source, os.path.join(image_dir, "disk2.vdi"), "vdi")
+        self.assertEqual(self.hypervisor.qemu_img.call_count, 1)
+        self.assertEqual(open(os.path.join(image_dir, "disk2.vdi")).read(), "converted")
+        self.assertEqual(self.hypervisor.disk_copied.call_args, mock.call(os.path.join(image_dir, "disk2.vdi")))
+
+    def test_create_disk_linked(self):
+        image_dir = self.hypervisor.image_dir
+        self.hypervisor.qemu_img = mock.MagicMock()
+        self.hypervisor.qemu_img.side_effect = lambda *a, **kw: open(kw["destination"], "w").write("converted")
+        self.hypervisor.link_disk = mock.MagicMock()
+        self.hypervisor.link_disk.return_value = "linked"
+        source = os.path.join(image_dir, "ubuntu.qcow2")
+        open(source, "w").write("foo")
+        disk = self.hypervisor.create_disk(source, os.path.join(image_dir, "disk1.vdi"), "vdi", linked=True)
+        self.assertEqual(disk, "linked")
+        base, destination = self.hypervisor.link_disk.call_args[0]
+        self.assertEqual(open(base).read(), "converted")
+        self.assertEqual(destination, os.path.join(image_dir, "disk1.vdi"))
+        self.assertFalse(os.path.exists(destination))
+
+    def test_create_disk_outside_store(self):
+        self.hypervisor.image_dir = "/does_not_exist"
+        self.hypervisor.qemu_img = mock.MagicMock()
+        self.hypervisor.create_disk("/var/images/foo.qcow2", "/fake_dir/foo/disk.vdi", "vdi")
+        self.assertEqual(self.hypervisor.qemu_img.call_args, mock.call(
+            "convert", source="/var/images/foo.qcow2", destination="/fake_dir/foo/disk.vdi", format="vdi"))
+
+    def test_create_many(self):
+        spec = self.create_spec()
+        self.hypervisor.failing = ["foo-2"]
+        self.hypervisor.qemu_img = mock.MagicMock()
+        results = self.hypervisor.create_many(spec, 3, workers=2)
+        self.assertEqual([r.instance_id for r in results], ["foo-1", "foo-2", "foo-3"])
+        self.assertEqual([r.ok for r in results], [True, False, True])
+        self.assertEqual(str(results[1].error), "build failed")
+        self.assertEqual(results[1].instance, None)
+        self.assertTrue(all(r.elapsed is not None for r in results))
+        self.assertEqual(sorted(os.listdir(self.hypervisor.directory)), ["foo-1", "foo-2", "foo-3"])
+        # the image is fetched once for the whole batch
+        self.assertEqual(spec.image.fetch.call_count, 1)
+        self.assertEqual([p.name for p in results[0].phases], ["fetch", "register"])
+
+    def test_create_many_fetch_failed(self):
+        spec = self.create_spec()
+        spec.image.fetch.side_effect = IOError("no route to host")
+        results = self.hypervisor.create_many(spec, 2)
+        self.assertEqual([str(r.error) for r in results], ["no route to host"] * 2)
+        self.assertEqual([r.ok for r in results], [False, False])
+        self.assertEqual(os.listdir(self.hypervisor.directory), [])
+
+    def test_inventory(self):
+        spec = self.create_spec()
+        self.hypervisor.instance = MockMachineInstance
+        spec.image.distro = "ubuntu"
+        instance = self.hypervisor.create(spec)
+        self.assertEqual([(e["name"], e["state"], e["distro"]) for e in self.hypervisor.list()], [("foo", "stopped", "ubuntu")])
+        instance.start()
+        self.assertEqual(self.hypervisor.list()[0]["state"], "starting")
+        instance.ip = "10.0.0.2"
+        list(machine.wait_all([instance], 1))
+        self.assertEqual((self.hypervisor.list()[0]["state"], self.hypervisor.list()[0]["ip"]), ("running", "10.0.0.2"))
+        instance.destroy()
+        self.assertEqual(self.hypervisor.inventory.entries, {})
+
+    def test_create_result(self):
+        spec = self.create_spec()
+        result = self.hypervisor.create_result(spec)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.instance_id, "foo")
+        self.assertEqual([p.name for p in result.phases], ["fetch", "register"])
+        self.assertEqual(result.as_dict()["phases"][1]["count"], 1)
+
+    @mock.patch("os.path.exists")
+    @mock.patch("os.listdir")
+    def test_find(self, m_listdir, m_exists):
+        m_exists.return_value = True
+        m_listdir.return_value = ["web-2", "db", "web-1"]
+        self.hypervisor.instance = lambda directory, name: mock.Mock(instance_id=name)
+        found = self.hypervisor.find(["db", "web-*", "web-1"])
+        self.assertEqual([i.instance_id for i in found], ["db", "web-1", "web-2"])
+        self.assertRaises(machine.MachineDoesNotExist, self.hypervisor.find, ["mail-*"])
@@ -1,8 +1,12 @@
 import unittest2
 import mock
+import os
+import tempfile
+import shutil
 
-from hyperkit.hypervisor.command import Command
+from hyperkit.hypervisor.command import Command, CommandException, registry
 from hyperkit.hypervisor import vbox
+from hyperkit.test.process import fake_popen
 
 
 class TestVBoxCommandIntegration(unittest2.TestCase):
@@ -11,6 +15,7 @@ class TestVBoxCommandIntegration(unittest2.TestCase):
     right subprocess calls using command.Command. """
 
     def setUp(self):
+        registry.reset()
         Command.known_locations = ["/fake_bin"]
         with mock.patch("os.path.exists") as m_exists:
             m_exists.return_value = True
@@ -21,7 +26,7 @@ class TestVBoxCommandIntegration(unittest2.TestCase):
 
     def assert_popen(self, m_popen, args):
         self.assertEqual(m_popen.call_args,
-                         mock.call(stdin=None, args=args, cwd=None, stderr=-1, stdout=-1))
+                         mock.call(stdin=None, args=args, cwd=None, stderr=-1, stdout=-1, preexec_fn=os.setsid))
 
     @mock.patch("os.path.isfile")
     @mock.patch("os.access")
@@ -29,8 +34,7 @@ class TestVBoxCommandIntegration(unittest2.TestCase):
     def test_start_gui(self, m_popen, m_access, m_isfile):
         m_isfile.return_value = True
         m_access.return_value = True
-        m_popen().communicate.return_value = ["", ""]
-        m_popen().returncode = 0
+        fake_popen(m_popen)
         self.m._start(True)
         self.assert_popen(m_popen, [
                 '/fake_bin/VBoxManage',
@@ -38,6 +42,21 @@ class TestVBoxCommandIntegration(unittest2.TestCase):
                 '--type', 'gui',
                 'foo'])
 
+    @mock.patch("time.sleep")
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    @mock.patch("subprocess.Popen")
+    def test_start_running_not_retried(self, m_popen, m_access, m_isfile, m_sleep):
+        m_isfile.return_value = True
+        m_access.return_value = True
+        fake_popen(m_popen, stderr="VBoxManage: error: The machine 'foo' is already locked by a session (or being locked or unlocked)\n", returncode=1)
+        self.assertRaises(CommandException, self.m._start)
+        self.assertEqual(m_popen.call_count, 1)
+        self.assertFalse(m_sleep.called)
+        # while changing its settings is
+        self.assertRaises(CommandException, self.m.vboxmanage, "modifyvm", name="foo")
+        self.assertEqual(m_popen.call_count, 2 + self.m.vboxmanage.retries)
+
 
 class TestVBoxMachineInstance(unittest2.TestCase):
 
@@ -70,6 +89,47 @@ class TestVBoxMachineInstance(unittest2.TestCase):
         ip = self.m.get_ip()
         self.assertEqual(ip, "192.168.0.1")
 
+    def test_block(self):
+        self.assertTrue(self.m.block(2.5))
+        self.assertEqual(self.m.vboxmanage.call_args, mock.call(
+            "guestproperty_wait", name="foo", property="/VirtualBox/GuestInfo/Net/1/V4/IP", timeout="2500",
+            command_timeout=32.5))
+
+    @mock.patch("hyperkit.hypervisor.vbox.connect")
+    def test_connect_lazily(self, m_connect):
+        with mock.patch("os.path.exists") as m_exists:
+            m_exists.return_value = True
+            m = vbox.VBoxMachineInstance("/does_not_exist", "foo")
+        self.assertFalse(m_connect.called)
+        m.get_ip()
+        m.get_ip()
+        self.assertEqual(m_connect.call_count, 1)
+
+    def test_block_timeout(self):
+        self.m.vboxmanage.side_effect = vbox.CommandException("timed out")
+        self.assertFalse(self.m.block(1))
+
+
+class TestParse(unittest2.TestCase):
+
+    def test_parse_runningvms(self):
+        output = '"web-1" {0c6ec8c4-7d5b-4d0e-a3f7-6a1b2c3d4e5f}\n"db" {1c6ec8c4-7d5b-4d0e-a3f7-6a1b2c3d4e5f}\n'
+        self.assertEqual(vbox.parse_runningvms(output), ["web-1", "db"])
+        self.assertEqual(vbox.parse_runningvms(""), [])
+
+    def test_parse_guestproperties(self):
+        output = "\n".join([
+            "Name: /VirtualBox/GuestInfo/Net/1/V4/IP, value: 192.168.56.101, timestamp: 1400000000, flags: ",
+            "Name: /VirtualBox/GuestInfo/OS/Product, value: Linux, timestamp: 1400000000, flags: ",
+        ])
+        properties = vbox.parse_guestproperties(output)
+        self.assertEqual(properties["/VirtualBox/GuestInfo/Net/1/V4/IP"], "192.168.56.101")
+        self.assertEqual(properties["/VirtualBox/GuestInfo/OS/Product"], "Linux")
+
+    def test_parse_guestproperties_7(self):
+        output = "/VirtualBox/GuestInfo/Net/1/V4/IP = '192.168.56.101' @ 2023-01-01T00:00:00.000000000Z\n"
+        self.assertEqual(vbox.parse_guestproperties(output), {"/VirtualBox/GuestInfo/Net/1/V4/IP": "192.168.56.101"})
+
 
 class TestVirtualBox(unittest2.TestCase):
 
@@ -84,3 +144,91 @@ class TestVirtualBox(unittest2.TestCase):
     def test_present(self):
         self.vbox.vboxmanage.pathname = "foo"
         self.assertTrue(self.vbox.present)
+
+    def test_link_disk(self):
+        self.assertEqual(self.vbox.link_disk("/images/base.vdi", "/vms/foo/foo_disk1.vdi"), "/images/base.vdi")
+
+    def test_disk_copied(self):
+        self.vbox.disk_copied("/vms/foo/foo_disk1.vdi")
+        self.assertEqual(self.vbox.vboxmanage.call_args, mock.call("sethduuid", disk="/vms/foo/foo_disk1.vdi"))
+
+    def test_query_ips(self):
+        self.assertFalse(self.vbox.query_ips)
+        self.vbox.vboxmanage = mock.MagicMock(spec=vbox.VBoxSession)
+        self.assertTrue(self.vbox.query_ips)
+
+    def test_query(self):
+        self.vbox.vboxmanage.return_value = '"web-1" {0c6ec8c4-7d5b-4d0e-a3f7-6a1b2c3d4e5f}\n'
+        self.vbox.vboxmanage.submit.return_value.result.return_value = \
+            "Name: /VirtualBox/GuestInfo/Net/1/V4/IP, value: 192.168.56.101, timestamp: 1, flags: "
+        self.assertEqual(self.vbox.query(["web-1", "web-2"]), {
+            "web-1": {"state": "running", "ip": "192.168.56.101"},
+            "web-2": {"state": "stopped", "ip": None},
+        })
+        self.assertEqual(self.vbox.vboxmanage.call_args_list, [mock.call("list_runningvms")])
+        # only running machines have their properties read
+        self.assertEqual(self.vbox.vboxmanage.submit.call_args_list, [mock.call("guestproperty_enumerate", name="web-1")])
+
+    def test_guess_network_new(self):
+        with mock.patch.object(vbox.HostOnlyNetwork, "find_networks") as m_find:
+            m_find.return_value = iter([])
+            network = self.vbox.guess_network()
+            self.assertTrue(isinstance(network, vbox.NewHostOnlyNetwork))
+            # the same network is used for every machine
+            self.assertIs(self.vbox.guess_network(), network)
+            self.assertEqual(m_find.call_count, 1)
+
+    @mock.patch("hyperkit.hypervisor.vbox.connect")
+    def test_new_network_created_once(self, m_vboxmanage):
+        v = m_vboxmanage.return_value
+        v.return_value = "Interface 'vboxnet1' was successfully created"
+        network = vbox.NewHostOnlyNetwork()
+        network.configurevm(mock.MagicMock())
+        modify = mock.MagicMock()
+        network.configurevm(modify)
+        self.assertEqual(v.call_args_list.count(mock.call("create_hostonly")), 1)
+        self.assertEqual(modify.call_args, mock.call("configure_hostonly", adapter="vboxnet1"))
+
+    @mock.patch("os.path.isfile")
+    @mock.patch("os.access")
+    @mock.patch("subprocess.Popen")
+    @mock.patch("hyperkit.hypervisor.vbox.Seed")
+    def test_create_subprocess_count(self, m_seed, m_popen, m_access, m_isfile):
+        registry.reset()
+        self.addCleanup(registry.reset)
+        m_isfile.return_value = m_access.return_value = True
+        fake_popen(m_popen, "\n".join([
+            "Name: vboxnet0",
+            "GUID: 786f6276-656e-4074-8000-0a0027000000",
+            "DHCP: Disabled",
+            "IPAddress: 192.168.56.1",
+            "NetworkMask: 255.255.255.0",
+            "HardwareAddress: 0a:00:27:00:00:00",
+            "Status: Up",
+        ]))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        hypervisor = vbox.VirtualBox(directory)
+        hypervisor.image_dir = os.path.join(directory, "images")
+        hypervisor.fetch_image = mock.MagicMock(return_value="/images/ubuntu.qcow2")
+        hypervisor.create_disk = mock.MagicMock(return_value="/vms/foo/foo_disk1.vdi")
+        spec = mock.MagicMock()
+        spec.name = "foo"
+        spec.image.distro = "ubuntu"
+        spec.hardware.memory = "256"
+        hypervisor.create(spec)
+        commands = [c[1]["args"][1:3] for c in m_popen.call_args_list]
+        self.assertEqual(commands, [
+            ["createvm", "--name"],
+            ["list", "hostonlyifs"],
+            ["modifyvm", "foo"],
+            ["storagectl", "foo"],
+            ["storageattach", "foo"],
+            ["storagectl", "foo"],
+            ["storageattach", "foo"],
+            ["storageattach", "foo"],
+            ["sharedfolder", "add"],
+        ])
+        modifyvm = m_popen.call_args_list[2][1]["args"]
+        for flag in ["--memory", "--nic2", "--hostonlyadapter2"]:
+            self.assertIn(flag, modifyvm)
@@ -0,0 +1,154 @@
+import unittest2
+import mock
+import threading
+
+from hyperkit.hypervisor import vboxsession
+from hyperkit.hypervisor.vboxsession import VBoxSession
+from hyperkit.hypervisor.vboxmanage import VBoxManage
+from hyperkit.hypervisor.command import CommandException, CommandTimeout
+
+
+class TestVBoxSession(unittest2.TestCase):
+
+    def setUp(self):
+        self.manager = mock.MagicMock()
+        self.vbox = self.manager.getVirtualBox()
+        self.const = self.manager.constants
+        self.session = VBoxSession(self.manager)
+        self.session.cli = mock.MagicMock()
+        self.machine = self.vbox.findMachine()
+        self.mutable = self.manager.getSessionObject().machine
+
+    def test_controller_names(self):
+        # the same names VBoxManage gives them
+        self.assertEqual(self.session.sata_controller, '"SATA Controller"')
+        self.assertEqual(self.session.ide_controller, '"IDE Controller"')
+
+    def test_configurevm(self):
+        self.session("configurevm", name="foo", memsize="256")
+        self.assertEqual(self.vbox.findMachine.call_args, mock.call("foo"))
+        self.assertEqual(self.machine.lockMachine.call_args, mock.call(self.manager.getSessionObject(), self.const.LockType_Write))
+        self.assertEqual(self.mutable.memorySize, 256)
+        self.assertTrue(self.mutable.saveSettings.called)
+        self.assertTrue(self.manager.getSessionObject().unlockMachine.called)
+        self.assertFalse(self.session.cli.called)
+
+    def test_modifyvm(self):
+        self.session.modifyvm("foo", [("configure_nic", {}), ("configure_hostonly", {"adapter": "vboxnet0"})])
+        adapter = self.mutable.getNetworkAdapter(1)
+        self.assertEqual(adapter.hostOnlyInterface, "vboxnet0")
+        self.assertEqual(adapter.attachmentType, self.const.NetworkAttachmentType_HostOnly)
+        self.assertFalse(self.session.cli.called)
+
+    def test_attach_disk_multiattach(self):
+        medium = self.vbox.openMedium.return_value
+        self.session("attach_disk", name="foo", disk="/images/base.vdi", mtype="multiattach")
+        self.assertEqual(medium.type, self.const.MediumType_MultiAttach)
+        self.assertEqual(self.mutable.attachDevice.call_args, mock.call(
+            '"SATA Controller"', 0, 0, self.const.DeviceType_HardDisk, medium))
+
+    def test_guestproperty(self):
+        self.machine.getGuestPropertyValue.return_value = "192.168.56.101"
+        self.assertEqual(self.session("guestproperty", name="foo", property="/ip"), "Value: 192.168.56.101")
+        self.machine.getGuestPropertyValue.return_value = ""
+        self.assertEqual(self.session("guestproperty", name="foo", property="/ip"), "No value set!")
+
+    def test_guestproperty_enumerate(self):
+        self.machine.enumerateGuestProperties.return_value = (["/a", "/b"], ["1", "2"], [10, 20], ["", "TRANSIENT"])
+        self.assertEqual(self.session("guestproperty_enumerate", name="foo"), "\n".join([
+            "Name: /a, value: 1, timestamp: 10, flags: ",
+            "Name: /b, value: 2, timestamp: 20, flags: TRANSIENT",
+        ]))
+
+    def test_list_runningvms(self):
+        running = mock.MagicMock(state=self.const.MachineState_Running, id="1234")
+        running.name = "foo"
+        stopped = mock.MagicMock(state=self.const.MachineState_PoweredOff)
+        self.vbox.machines = [running, stopped]
+        self.assertEqual(self.session("list_runningvms"), '"foo" {1234}')
+
+    def test_startvm_failed(self):
+        progress = self.machine.launchVMProcess.return_value
+        progress.resultCode = 1
+        progress.errorInfo.text = "no such vm"
+        self.assertRaises(CommandException, self.session, "startvm", type="headless", name="foo")
+        self.assertTrue(self.manager.getSessionObject().unlockMachine.called)
+
+    def test_startvm_timeout(self):
+        progress = self.machine.launchVMProcess.return_value
+        progress.completed = False
+        progress.cancelable = True
+        self.session.poll_interval = 10
+        self.assertRaises(CommandTimeout, self.session, "startvm", type="headless", name="foo", command_timeout=0.05)
+        self.assertTrue(progress.waitForCompletion.called)
+        self.assertTrue(progress.cancel.called)
+        self.assertTrue(self.manager.getSessionObject().unlockMachine.called)
+
+    def test_wait_unlocked(self):
+        progress = self.machine.launchVMProcess.return_value
+        progress.completed = False
+        progress.resultCode = 0
+        results = []
+
+        def other_call(ms):
+            # other calls can be made while the progress is waited for
+            call = threading.Thread(target=lambda: results.append(self.session("list_runningvms")))
+            call.daemon = True
+            call.start()
+            call.join(5)
+            progress.completed = True
+        progress.waitForCompletion.side_effect = other_call
+        self.vbox.machines = []
+        self.session("startvm", type="headless", name="foo")
+        self.assertEqual(results, [""])
+
+    def test_api_error(self):
+        self.vbox.findMachine.side_effect = ValueError("not found")
+        self.manager.errIsOurXcptKind.return_value = True
+        self.manager.xcptGetMessage.return_value = "not found"
+        self.assertRaises(CommandException, self.session, "guestproperty", name="foo", property="/ip")
+
+    def test_list_hostonlyifs(self):
+        interface = mock.MagicMock()
+        interface.name = "vboxnet0"
+        interface.DHCPEnabled = False
+        interface.status = self.const.HostNetworkInterfaceStatus_Up
+        self.vbox.host.findHostNetworkInterfacesOfType.return_value = [interface]
+        lines = self.session("list_hostonlyifs").splitlines()
+        self.assertEqual(lines[0], "Name:            vboxnet0")
+        self.assertEqual(lines[2], "DHCP:            Disabled")
+        self.assertEqual(lines[6], "Status:          Up")
+
+    def test_fallback(self):
+        self.session("sethduuid", disk="/vms/foo/foo_disk1.vdi")
+        self.assertEqual(self.session.cli.call_args, mock.call("sethduuid", disk="/vms/foo/foo_disk1.vdi"))
+
+
+class TestConnect(unittest2.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(VBoxSession, enabled=True, shared=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(vboxsession, "vboxapi")
+    def test_connect(self, m_vboxapi):
+        session = vboxsession.connect()
+        self.assertTrue(isinstance(session, VBoxSession))
+        # the session is shared
+        self.assertIs(vboxsession.connect(), session)
+        self.assertEqual(m_vboxapi.VirtualBoxManager.call_count, 1)
+
+    @mock.patch.object(vboxsession, "vboxapi", None)
+    def test_not_installed(self):
+        self.assertTrue(isinstance(vboxsession.connect(), VBoxManage))
+
+    def test_disabled(self):
+        VBoxSession.enabled = False
+        self.assertTrue(isinstance(vboxsession.connect(), VBoxManage))
+
+    @mock.patch.object(vboxsession, "vboxapi")
+    def test_cannot_connect(self, m_vboxapi):
+        m_vboxapi.VirtualBoxManager.side_effect = RuntimeError("VBoxSVC is not running")
+        self.assertTrue(isinstance(vboxsession.connect(), VBoxManage))
+        self.assertFalse(VBoxSession.enabled)
@@ -1,8 +1,14 @@
 
 import unittest2
 import mock
+import tempfile
+import shutil
+import os
 
 from hyperkit.hypervisor import vmware
+from hyperkit.hypervisor.vmrun import VMRun
+from hyperkit.hypervisor.command import registry
+from hyperkit.test.process import fake_popen
 
 
 class TestVMX(unittest2.TestCase):
@@ -43,6 +49,67 @@ class TestVMX(unittest2.TestCase):
         self.assertEqual(self.vmx.fmt(False), '"FALSE"')
         self.assertEqual(self.vmx.fmt(10), '"10"')
         self.assertEqual(self.vmx.fmt("foo"), '"foo"')
+        self.assertEqual(self.vmx.fmt('a "b" #c'), '"a |22b|22 |23c"')
+
+    def test_unquote(self):
+        self.assertEqual(self.vmx.unquote('"a |22b|22 |23c"'), 'a "b" #c')
+        self.assertEqual(self.vmx.unquote("UTF8"), "UTF8")
+
+    def test_round_trip(self):
+        text = "".join([
+            '.encoding = "UTF-8"\n',
+            "# managed by hand\n",
+            'displayName = "web"\n',
+            "\n",
+            'sched.mem.pshare.enable = "false"\n',
+            'ethernet0.present = "true"\n',
+            'memsize = "0512"\n',
+        ])
+        self.vmx.parse(text.splitlines(True))
+        self.assertEqual(self.vmx.serialise(), text)
+        self.assertEqual(self.vmx["sched.mem.pshare.enable"], False)
+        self.assertEqual(self.vmx["sched"]["mem.pshare.enable"], False)
+        self.assertEqual(self.vmx["ethernet0"]["present"], True)
+
+    def test_change(self):
+        self.vmx.parse(['# keep me\n', 'memsize = "256"\n', 'ide0:0.present = "TRUE"\n',
+                        'ide0:0.fileName = "old.iso"\n', 'numvcpus = "1"\n'])
+        self.vmx["memsize"] = 1024
+        self.vmx["ide0:0"] = {"present": True, "deviceType": "cdrom-image"}
+        self.vmx["guestos"] = "ubuntu"
+        self.assertEqual(self.vmx.serialise(), "".join([
+            "# keep me\n",
+            'memsize = "1024"\n',
+            'ide0:0.present = "TRUE"\n',
+            'numvcpus = "1"\n',
+            'ide0:0.deviceType = "cdrom-image"\n',
+            'guestos = "ubuntu"\n',
+        ]))
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        vmx = vmware.VMX(directory, "foo")
+        vmx.connect_iso("/seed.iso")
+        vmx.write()
+        self.assertEqual(os.listdir(directory), ["foo.vmx"])
+        again = vmware.VMX(directory, "foo")
+        self.assertEqual(again["ide0:0"]["fileName"], "/seed.iso")
+        self.assertEqual(again.serialise(), vmx.serialise())
+
+
+class TestVMWareMachineInstance(unittest2.TestCase):
+
+    @mock.patch("os.path.exists")
+    @mock.patch("hyperkit.hypervisor.vmware.VMX")
+    def test_vmx_lazy(self, m_vmx, m_exists):
+        m_exists.return_value = True
+        m = vmware.VMWareMachineInstance("/does_not_exist", "foo")
+        m.vmrun = mock.MagicMock()
+        m.start()
+        self.assertFalse(m_vmx.called)
+        self.assertEqual(m.vmrun.call_args, mock.call("start", name="/does_not_exist/foo/foo.vmx", type="nogui"))
+        self.assertIs(m.vmx, m_vmx.return_value)
 
 
 class TestVMWare(unittest2.TestCase):
@@ -58,3 +125,68 @@ class TestVMWare(unittest2.TestCase):
     def test_present(self):
         self.vmware.vmrun.pathname = "foo"
         self.assertTrue(self.vmware.present)
+
+    def test_query(self):
+        self.vmware.directory = "/vms"
+        self.vmware.vmrun.return_value = "Total running VMs: 1\n/vms/web/web.vmx\n"
+        self.assertEqual(self.vmware.query(["db", "web"]), {"db": {"state": "stopped"}, "web": {"state": "running"}})
+        self.assertEqual(self.vmware.vmrun.call_count, 1)
+
+    def test_link_disk(self):
+        disk = self.vmware.link_disk("/images/base.vmdk", "/vms/foo/foo_disk1.vmdk")
+        self.assertEqual(disk, "/vms/foo/foo_disk1.vmdk")
+        self.assertEqual(self.vmware.qemu_img.call_args, mock.call(
+            "create_backed", format="vmdk", backing="/images/base.vmdk", destination="/vms/foo/foo_disk1.vmdk"))
+
+
+class TestVMRunHostType(unittest2.TestCase):
+
+    def setUp(self):
+        registry.reset()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.binary = os.path.join(self.directory, "vmrun")
+        open(self.binary, "w").close()
+        os.chmod(self.binary, 0755)
+        registry.pin("vmrun", self.binary)
+        self.addCleanup(registry.reset)
+        patcher = mock.patch.multiple(VMRun, detected={}, override=None,
+                                      cache_pathname=os.path.join(self.directory, "cache", "vmrun.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.mkdir(os.path.join(self.directory, "foo"))
+        open(os.path.join(self.directory, "foo", "foo.vmx"), "w").close()
+        self.m = vmware.VMWareMachineInstance(self.directory, "foo")
+
+    def start(self, m_popen, m_call):
+        m_call.reset_mock()
+        m_popen.reset_mock()
+        self.m.start()
+        return m_call.call_count + m_popen.call_count
+
+    @mock.patch("subprocess.call")
+    @mock.patch("subprocess.Popen")
+    def test_spawns_per_start(self, m_popen, m_call):
+        fake_popen(m_popen)
+        # only player works, so detection tries all three host types
+        m_call.side_effect = lambda args, **kwargs: 0 if args[2] == "player" else 1
+        self.assertEqual(self.start(m_popen, m_call), 4)
+        self.assertEqual(m_popen.call_args[1]["args"][1:3], ["-T", "player"])
+        # after that only vmrun itself is run
+        self.assertEqual(self.start(m_popen, m_call), 1)
+        self.assertEqual(self.start(m_popen, m_call), 1)
+        # a new process uses the cache on disk
+        VMRun.detected = {}
+        self.assertEqual(self.start(m_popen, m_call), 1)
+        # unless vmrun has changed
+        VMRun.detected = {}
+        os.utime(self.binary, (0, 0))
+        self.assertEqual(self.start(m_popen, m_call), 4)
+
+    @mock.patch("subprocess.call")
+    @mock.patch("subprocess.Popen")
+    def test_override(self, m_popen, m_call):
+        fake_popen(m_popen)
+        VMRun.override = "fusion"
+        self.assertEqual(self.start(m_popen, m_call), 1)
+        self.assertEqual(m_popen.call_args[1]["args"][1:3], ["-T", "fusion"])
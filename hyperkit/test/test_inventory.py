@@ -0,0 +1,112 @@
+import unittest2
+import mock
+import tempfile
+import shutil
+import os
+
+from hyperkit.inventory import Inventory, disk_size
+
+
+class TestInventory(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.image_dir = os.path.join(self.directory, "images")
+        self.vm_dir = os.path.join(self.directory, "vms")
+        os.mkdir(self.vm_dir)
+        self.inventory = Inventory(self.image_dir)
+
+    def make_instance(self, name, size=10):
+        instance_dir = os.path.join(self.vm_dir, name)
+        os.mkdir(instance_dir)
+        open(os.path.join(instance_dir, "disk.vdi"), "w").write("x" * size)
+        return instance_dir
+
+    def spec(self):
+        spec = mock.MagicMock()
+        spec.image.distro = "ubuntu"
+        spec.image.release = "14.04"
+        spec.image.arch = "amd64"
+        return spec
+
+    def test_created(self):
+        instance_dir = self.make_instance("foo")
+        self.inventory.created(instance_dir, "vbox", self.spec())
+        entry = Inventory(self.image_dir).entries[instance_dir]
+        self.assertEqual(entry["name"], "foo")
+        self.assertEqual(entry["hypervisor"], "vbox")
+        self.assertEqual((entry["distro"], entry["release"], entry["arch"]), ("ubuntu", "14.04", "amd64"))
+        self.assertEqual(entry["disk_size"], 10)
+        self.assertEqual(entry["state"], "stopped")
+
+    def test_update(self):
+        instance_dir = self.make_instance("foo")
+        self.inventory.created(instance_dir, "vbox", self.spec())
+        self.inventory.update(instance_dir, state="running", ip="192.168.56.101")
+        entry = Inventory(self.image_dir).entries[instance_dir]
+        self.assertEqual((entry["state"], entry["ip"]), ("running", "192.168.56.101"))
+        # machines not in the inventory are ignored
+        self.inventory.update(os.path.join(self.vm_dir, "bar"), state="running")
+        self.assertEqual(list(Inventory(self.image_dir).entries), [instance_dir])
+
+    def test_remove(self):
+        instance_dir = self.make_instance("foo")
+        self.inventory.created(instance_dir, "vbox", self.spec())
+        self.inventory.remove(instance_dir)
+        self.assertEqual(Inventory(self.image_dir).entries, {})
+
+    def test_reconcile(self):
+        self.inventory.created(self.make_instance("foo"), "vbox", self.spec())
+        self.inventory.created(self.make_instance("gone"), "vbox", self.spec())
+        shutil.rmtree(os.path.join(self.vm_dir, "gone"))
+        self.make_instance("bar", 5)
+        open(os.path.join(self.vm_dir, "notes.txt"), "w").close()
+        entries = self.inventory.reconcile(self.vm_dir, "vbox", {"foo": {"state": "running"}})
+        self.assertEqual([e["name"] for e in entries], ["bar", "foo"])
+        self.assertEqual([e["state"] for e in entries], ["unknown", "running"])
+        self.assertEqual(entries[0]["disk_size"], 5)
+        self.assertEqual(len(Inventory(self.image_dir).entries), 2)
+
+    def test_reconcile_normalised(self):
+        self.inventory.created(self.make_instance("gone"), "vbox", self.spec())
+        shutil.rmtree(os.path.join(self.vm_dir, "gone"))
+        self.assertEqual(self.inventory.reconcile(self.vm_dir + "/", "vbox"), [])
+        self.assertEqual(Inventory(self.image_dir).entries, {})
+        self.inventory.created(self.make_instance("gone"), "vbox", self.spec())
+        shutil.rmtree(os.path.join(self.vm_dir, "gone"))
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            self.assertEqual(self.inventory.reconcile("vms", "vbox"), [])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(Inventory(self.image_dir).entries, {})
+
+    def test_reconcile_unchanged(self):
+        self.inventory.created(self.make_instance("foo"), "vbox", self.spec())
+        self.inventory.reconcile(self.vm_dir, "vbox", {"foo": {"state": "running"}})
+        with mock.patch.object(self.inventory, "save") as m_save:
+            self.inventory.reconcile(self.vm_dir, "vbox", {"foo": {"state": "running"}})
+            self.assertFalse(m_save.called)
+            self.make_instance("bar")
+            self.inventory.reconcile(self.vm_dir, "vbox")
+            self.assertTrue(m_save.called)
+
+    @mock.patch("hyperkit.inventory.disk_size")
+    def test_reconcile_measures_changed(self, m_disk_size):
+        m_disk_size.return_value = 10
+        instance_dir = self.make_instance("foo")
+        self.inventory.reconcile(self.vm_dir, "vbox")
+        self.inventory.reconcile(self.vm_dir, "vbox")
+        self.assertEqual(m_disk_size.call_count, 1)
+        measured = self.inventory.entries[instance_dir]["measured"]
+        os.utime(instance_dir, (measured + 1, measured + 1))
+        m_disk_size.return_value = 20
+        self.assertEqual(self.inventory.reconcile(self.vm_dir, "vbox")[0]["disk_size"], 20)
+        self.assertEqual(m_disk_size.call_count, 2)
+
+    def test_disk_size(self):
+        instance_dir = self.make_instance("foo", 100)
+        open(os.path.join(instance_dir, "seed.iso"), "w").write("x" * 20)
+        self.assertEqual(disk_size(instance_dir), 120)
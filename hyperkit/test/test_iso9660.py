@@ -0,0 +1,83 @@
+import unittest2
+import struct
+
+from hyperkit.iso9660 import ISO9660, SECTOR, iso_name
+
+
+def read_directory(image, descriptor):
+    """ Return the names, and contents, of the files in the root directory
+    of the volume described in sector descriptor, and the system use area
+    of each record. """
+    vd = image[descriptor * SECTOR:(descriptor + 1) * SECTOR]
+    root = vd[156:190]
+    extent, = struct.unpack("<I", root[2:6])
+    size, = struct.unpack("<I", root[10:14])
+    data = image[extent * SECTOR:extent * SECTOR + size]
+    entries = []
+    offset = 0
+    while offset < len(data):
+        length = ord(data[offset])
+        if length == 0:
+            offset = (offset // SECTOR + 1) * SECTOR
+            continue
+        record = data[offset:offset + length]
+        file_extent, = struct.unpack("<I", record[2:6])
+        file_size, = struct.unpack("<I", record[10:14])
+        name_length = ord(record[32])
+        name = record[33:33 + name_length]
+        system_use = record[33 + name_length + (0 if name_length % 2 else 1):]
+        contents = image[file_extent * SECTOR:file_extent * SECTOR + file_size]
+        entries.append((name, contents, system_use))
+        offset += length
+    return entries
+
+
+class TestISO9660(unittest2.TestCase):
+
+    def setUp(self):
+        self.iso = ISO9660("cidata")
+        self.iso.add("user-data", "#cloud-config\n" * 200)
+        self.iso.add("meta-data", "instance-id: foo\n")
+        self.image = self.iso.getvalue()
+
+    def test_size(self):
+        self.assertEqual(len(self.image) % SECTOR, 0)
+        size, = struct.unpack("<I", self.image[16 * SECTOR + 80:16 * SECTOR + 84])
+        self.assertEqual(size * SECTOR, len(self.image))
+
+    def test_volume_descriptors(self):
+        self.assertEqual(self.image[16 * SECTOR:16 * SECTOR + 6], "\x01CD001")
+        self.assertEqual(self.image[17 * SECTOR:17 * SECTOR + 6], "\x02CD001")
+        self.assertEqual(self.image[18 * SECTOR:18 * SECTOR + 6], "\xffCD001")
+        self.assertEqual(self.image[16 * SECTOR + 40:16 * SECTOR + 72].rstrip(), "cidata")
+        self.assertEqual(self.image[17 * SECTOR + 88:17 * SECTOR + 91], "%/E")
+
+    def test_primary(self):
+        entries = read_directory(self.image, 16)
+        self.assertEqual([e[0] for e in entries], ["\x00", "\x01", "META_DAT.;1", "USER_DAT.;1"])
+        self.assertEqual(entries[3][1], "#cloud-config\n" * 200)
+        # the Rock Ridge entries
+        self.assertTrue(entries[0][2].startswith("SP\x07\x01\xbe\xef"))
+        self.assertIn("NM\x0e\x01\x00user-data", entries[3][2])
+
+    def test_joliet(self):
+        entries = read_directory(self.image, 17)
+        names = [e[0].decode("utf-16-be") for e in entries[2:]]
+        self.assertEqual(names, ["meta-data;1", "user-data;1"])
+        self.assertEqual(entries[2][1], "instance-id: foo\n")
+
+    def test_deterministic(self):
+        other = ISO9660("cidata")
+        other.add("user-data", "#cloud-config\n" * 200)
+        other.add("meta-data", "instance-id: foo\n")
+        self.assertEqual(other.getvalue(), self.image)
+
+    def test_iso_name(self):
+        self.assertEqual(iso_name("user-data"), "USER_DAT.;1")
+        self.assertEqual(iso_name("network-config.yaml"), "NETWORK_.YAM;1")
+
+    def test_unique_names(self):
+        iso = ISO9660()
+        iso.add("user-data-1", "")
+        iso.add("user-data-2", "")
+        self.assertEqual(iso.names(), ["USER_DAT.;1", "USER_DA1.;1"])
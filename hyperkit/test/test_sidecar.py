@@ -0,0 +1,49 @@
+import unittest2
+import tempfile
+import shutil
+import os
+
+from hyperkit.sidecar import Sidecar
+
+
+class TestSidecar(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pathname = os.path.join(self.directory, "image.qcow2")
+        open(self.pathname, "w").write("foo")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sidecar_pathname(self):
+        self.assertEqual(Sidecar(self.pathname).sidecar_pathname, self.pathname + ".meta")
+
+    def test_round_trip(self):
+        s = Sidecar(self.pathname)
+        self.assertEqual(s, {})
+        s["digests"] = {"md5": "foo"}
+        s.save()
+        self.assertEqual(Sidecar(self.pathname), {"digests": {"md5": "foo"}})
+
+    def test_invalidated_by_change(self):
+        s = Sidecar(self.pathname)
+        s["digests"] = {"md5": "foo"}
+        s.save()
+        open(self.pathname, "a").write("bar")
+        self.assertEqual(Sidecar(self.pathname), {})
+
+    def test_missing_file(self):
+        os.unlink(self.pathname)
+        s = Sidecar(self.pathname)
+        s["foo"] = "bar"
+        s.save()
+        self.assertFalse(os.path.exists(s.sidecar_pathname))
+
+    def test_discard(self):
+        s = Sidecar(self.pathname)
+        s["foo"] = "bar"
+        s.save()
+        s.discard()
+        self.assertEqual(s, {})
+        self.assertFalse(os.path.exists(s.sidecar_pathname))
@@ -1,7 +1,6 @@
 
 import mock
 import unittest2
-import urllib2
 
 from hyperkit.spec import spec, auth, hardware, image
 from hyperkit import error
@@ -21,26 +20,56 @@ class TestSpec(unittest2.TestCase):
 class TestLiteralImage(unittest2.TestCase):
 
     def setUp(self):
-        self.i = image.LiteralImage("distro", "release", "arch", "url")
+        self.i = image.LiteralImage("distro", "release", "arch", "http://example.com/image.qcow2")
 
     def test_str(self):
-        self.assertEqual(str(self.i), 'distro-release-arch at url')
+        self.assertEqual(str(self.i), 'distro-release-arch at http://example.com/image.qcow2')
+
+    def test_local_pathname(self):
+        self.assertEqual(self.i.local_pathname(), None)
+        self.i.url = "file:///var/images/foo%20bar.qcow2"
+        self.assertEqual(self.i.local_pathname(), "/var/images/foo bar.qcow2")
+        self.i.url = "/var/images/foo.qcow2"
+        self.assertEqual(self.i.local_pathname(), "/var/images/foo.qcow2")
 
     @mock.patch("os.path.exists")
-    @mock.patch("urllib2.urlopen")
-    @mock.patch("__builtin__.open")
+    @mock.patch("hyperkit.spec.image.Download")
+    def test_fetch_local(self, m_download, m_exists):
+        m_exists.return_value = True
+        self.i.url = "file:///var/images/foo.qcow2"
+        self.assertEqual(self.i.fetch("/does_not_exist"), "/var/images/foo.qcow2")
+        self.assertFalse(m_download.called)
+        m_exists.return_value = False
+        self.assertRaises(error.FetchFailedException, self.i.fetch, "/does_not_exist")
+
+    @mock.patch("os.path.exists")
+    @mock.patch("hyperkit.spec.image.Download")
     @mock.patch("os.mkdir")
-    def test_fetch(self, m_mkdir, m_open, m_urlopen, m_exists):
+    def test_fetch(self, m_mkdir, m_download, m_exists):
         m_exists.return_value = True
-        m_urlopen().read.side_effect = ["foo", "bar", ""]
         pathname = self.i.fetch("/does_not_exist")
-        self.assertEqual(pathname, "/does_not_exist/user-distro-release-arch.28e5ebabd9d8f6e237df63da2b503785093f0229241bc7021198f63c43b93269.qcow2")
-        self.assertEqual(m_open().write.call_args_list, [mock.call("foo"), mock.call("bar")])
+        self.assertEqual(pathname, "/does_not_exist/user-distro-release-arch.b39840462a28980a31c1128e8c4775a4486f344b225f296287a770978cc18c96.qcow2")
+        self.assertEqual(m_download.call_args, mock.call("http://example.com/image.qcow2", pathname))
+        self.assertEqual(m_download().fetch.call_args, mock.call())
         m_exists.return_value = False
-        m_urlopen.side_effect = urllib2.HTTPError(*[None] * 5)
+        m_download().fetch.side_effect = error.FetchFailedException("Unable to fetch url")
         self.assertRaises(error.FetchFailedException, self.i.fetch, "/does_not_exist")
         self.assertEqual(m_mkdir.call_args_list, [mock.call("/does_not_exist")])
 
+    @mock.patch("time.time")
+    @mock.patch("hyperkit.spec.image.Sidecar")
+    @mock.patch("hyperkit.spec.image.Download")
+    def test_fetch_cached(self, m_download, m_sidecar, m_time):
+        m_sidecar.return_value = {"checked": 1000}
+        m_time.return_value = 1000 + self.i.max_age - 1
+        self.i.fetch("/tmp")
+        self.assertFalse(m_download.called)
+        m_time.return_value = 1000 + self.i.max_age + 1
+        self.i.fetch("/tmp", force_cache=True)
+        self.assertFalse(m_download.called)
+        self.i.fetch("/tmp")
+        self.assertTrue(m_download().fetch.called)
+
 
 class TestCanonicalImage(unittest2.TestCase):
 
@@ -0,0 +1,195 @@
+import unittest2
+import mock
+import tempfile
+import hashlib
+import shutil
+import os
+import threading
+
+from hyperkit import store
+from hyperkit.sidecar import Sidecar
+from hyperkit.error import ImageConversionError
+
+
+class TestImageStore(unittest2.TestCase):
+
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+        self.store = store.ImageStore(self.image_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def image(self, name, data):
+        pathname = os.path.join(self.image_dir, name)
+        open(pathname, "w").write(data)
+        return pathname
+
+    def test_contains_path(self):
+        self.assertTrue(self.store.contains_path(os.path.join(self.image_dir, "foo.qcow2")))
+        self.assertFalse(self.store.contains_path("/var/images/foo.qcow2"))
+
+    def test_add(self):
+        pathname = self.image("ubuntu.qcow2", "foo")
+        digest = self.store.add(pathname)
+        self.assertEqual(digest, hashlib.sha256("foo").hexdigest())
+        self.assertTrue(os.path.samefile(pathname, self.store.pathname(digest)))
+        entry = store.ImageStore(self.image_dir).entries[digest]
+        self.assertEqual(entry["names"], [pathname])
+        self.assertEqual(entry["size"], 3)
+        self.assertEqual(entry["pinned"], False)
+
+    def test_add_uses_sidecar(self):
+        pathname = self.image("ubuntu.qcow2", "foo")
+        sidecar = Sidecar(pathname)
+        sidecar["digests"] = {"sha256": "cafe"}
+        sidecar.save()
+        self.assertEqual(self.store.add(pathname), "cafe")
+
+    def test_add_identical(self):
+        first = self.image("first.qcow2", "foo")
+        second = self.image("second.qcow2", "foo")
+        digest = self.store.add(first)
+        self.assertEqual(self.store.add(second), digest)
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(self.store.entries[digest]["names"], [first, second])
+        self.assertEqual(Sidecar(second)["digests"], {"sha256": digest})
+        self.assertEqual(self.store.total_size(), 3)
+
+    def test_add_replaced(self):
+        pathname = self.image("ubuntu.qcow2", "foo")
+        old = self.store.add(pathname)
+        os.unlink(pathname)
+        self.image("ubuntu.qcow2", "bar")
+        new = self.store.add(pathname)
+        self.assertEqual(self.store.entries[old]["names"], [])
+        self.assertEqual(self.store.entries[new]["names"], [pathname])
+
+    def test_add_references(self):
+        instance_dir = tempfile.mkdtemp(dir=self.image_dir)
+        digest = self.store.add(self.image("first.qcow2", "foo"), [instance_dir])
+        self.assertEqual(self.store.references(digest), [instance_dir])
+        # referenced as it is added, it is never evictable
+        self.assertEqual(self.store.prune(max_size=0), [])
+
+    def test_references(self):
+        digest = self.store.add(self.image("ubuntu.qcow2", "foo"))
+        instance_dir = tempfile.mkdtemp(dir=self.image_dir)
+        self.store.reference(digest, instance_dir)
+        self.store.reference(digest, "/does_not_exist")
+        self.assertEqual(self.store.references(digest), [instance_dir])
+        self.assertEqual(self.store.evictable(), [])
+
+    def test_find(self):
+        digest = self.store.add(self.image("ubuntu.qcow2", "foo"))
+        self.store.add(self.image("fedora.qcow2", "bar"))
+        self.assertEqual(self.store.find(digest[:8]), digest)
+        self.assertEqual(self.store.find("ubuntu.qcow2"), digest)
+        self.assertRaises(KeyError, self.store.find, "")
+        self.assertRaises(KeyError, self.store.find, "missing")
+
+    def test_pin(self):
+        digest = self.store.add(self.image("ubuntu.qcow2", "foo"))
+        self.store.pin("ubuntu.qcow2")
+        self.assertEqual(self.store.evictable(), [])
+        self.assertEqual(self.store.prune(max_size=0), [])
+        self.store.pin(digest, False)
+        self.assertEqual(self.store.prune(max_size=0), [digest])
+
+    @mock.patch("time.time")
+    def test_prune_size(self, m_time):
+        m_time.return_value = 1
+        first = self.image("first.qcow2", "foo")
+        a = self.store.add(first)
+        m_time.return_value = 2
+        b = self.store.add(self.image("second.qcow2", "barbaz"))
+        m_time.return_value = 3
+        c = self.store.add(self.image("third.qcow2", "quux"))
+        self.store.reference(a, tempfile.mkdtemp(dir=self.image_dir))
+        self.assertEqual(self.store.prune(max_size=8), [b])
+        self.assertEqual(sorted(self.store.entries.keys()), sorted([a, c]))
+        self.assertFalse(os.path.exists(os.path.join(self.image_dir, "second.qcow2")))
+        self.assertFalse(os.path.exists(self.store.pathname(b)))
+        self.assertTrue(os.path.exists(first))
+        self.assertEqual(self.store.prune(max_size=0), [c])
+
+    @mock.patch("time.time")
+    def test_prune_policy(self, m_time):
+        m_time.return_value = 1
+        a = self.store.add(self.image("first.qcow2", "foo"))
+        m_time.return_value = 2
+        b = self.store.add(self.image("second.qcow2", "bar"))
+        m_time.return_value = 3
+        self.store.reference(a, "/does_not_exist")
+        m_time.return_value = 4
+        self.assertEqual(self.store.prune(max_age=1.5), [b])
+        self.assertEqual(self.store.prune(max_age=1.5, policy="age"), [a])
+
+    def test_prune_max_size(self):
+        self.store.add(self.image("first.qcow2", "foo"))
+        with self.store.transaction():
+            self.store.max_size = 100
+        self.assertEqual(self.store.prune(), [])
+        with self.store.transaction():
+            self.store.max_size = 0
+        self.assertEqual(len(self.store.prune()), 1)
+
+    def test_transaction_reloads(self):
+        other = store.ImageStore(self.image_dir)
+        digest = self.store.add(self.image("first.qcow2", "foo"))
+        # changes made through another store are not lost
+        other.pin(digest)
+        self.store.reference(digest, "/does_not_exist")
+        self.assertEqual(store.ImageStore(self.image_dir).entries[digest]["pinned"], True)
+
+    def test_converted(self):
+        digest = self.store.add(self.image("ubuntu.qcow2", "foo"))
+        convert = mock.MagicMock()
+        convert.side_effect = lambda pathname: open(pathname, "w").write("converted")
+        pathname = self.store.converted(digest, "vdi", convert)
+        self.assertEqual(pathname, os.path.join(self.image_dir, "store", digest + ".vdi"))
+        self.assertEqual(convert.call_args, mock.call(pathname + ".tmp"))
+        self.assertEqual(open(pathname).read(), "converted")
+        self.assertEqual(self.store.converted(digest, "vdi", convert), pathname)
+        self.assertEqual(convert.call_count, 1)
+        self.assertEqual(self.store.total_size(), 12)
+        self.store.evict(digest)
+        self.assertFalse(os.path.exists(pathname))
+
+    def test_converted_unlocked(self):
+        digest = self.store.add(self.image("ubuntu.qcow2", "foo"))
+
+        def convert(pathname):
+            # the rest of the store can be changed during conversion
+            pin = threading.Thread(target=store.ImageStore(self.image_dir).pin, args=(digest,))
+            pin.daemon = True
+            pin.start()
+            pin.join(5)
+            self.assertFalse(pin.is_alive())
+            open(pathname, "w").write("converted")
+        self.store.converted(digest, "vdi", convert)
+        self.assertEqual(store.ImageStore(self.image_dir).entries[digest]["pinned"], True)
+        self.assertEqual(self.store.entries[digest]["converted"], {"vdi": 9})
+
+    def test_converted_evicted(self):
+        digest = self.store.add(self.image("ubuntu.qcow2", "foo"))
+
+        def convert(pathname):
+            store.ImageStore(self.image_dir).prune(max_size=0)
+            open(pathname, "w").write("converted")
+        self.assertRaises(ImageConversionError, self.store.converted, digest, "vdi", convert)
+        self.assertFalse(os.path.exists(self.store.converted_pathname(digest, "vdi")))
+
+
+class TestSizes(unittest2.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(store.parse_size("100"), 100)
+        self.assertEqual(store.parse_size("20G"), 20 * 1024 ** 3)
+        self.assertEqual(store.parse_size("500mb"), 500 * 1024 ** 2)
+        self.assertRaises(ValueError, store.parse_size, "lots")
+
+    def test_format_size(self):
+        self.assertEqual(store.format_size(100), "100B")
+        self.assertEqual(store.format_size(1536), "1.5K")
+        self.assertEqual(store.format_size(20 * 1024 ** 3), "20.0G")
@@ -0,0 +1,108 @@
+import unittest2
+import tempfile
+import shutil
+import json
+import os
+
+from hyperkit import trace
+
+
+class ListSink(list):
+
+    def record(self, span):
+        self.append(span)
+
+
+class TestSpan(unittest2.TestCase):
+
+    def setUp(self):
+        self.sink = ListSink()
+        trace.add_sink(self.sink)
+        self.addCleanup(trace.remove_sink, self.sink)
+
+    def test_span(self):
+        with trace.span("convert", format="vdi") as info:
+            info["bytes"] = 10
+        self.assertEqual(len(self.sink), 1)
+        span = self.sink[0]
+        self.assertEqual(span["name"], "convert")
+        self.assertEqual(span["category"], "phase")
+        self.assertEqual(span["args"], {"format": "vdi", "bytes": 10})
+        self.assertTrue(span["elapsed"] >= 0)
+
+    def test_span_error(self):
+        def fail():
+            with trace.span("fetch"):
+                raise IOError("no route to host")
+        self.assertRaises(IOError, fail)
+        self.assertEqual(self.sink[0]["args"], {"error": "no route to host"})
+
+    def test_phases(self):
+        with trace.span("fetch") as info:
+            info["bytes"] = 100
+            with trace.span("hash", bytes=100):
+                pass
+        with trace.span("VBoxManage createvm", "command"):
+            pass
+        for i in range(2):
+            with trace.span("attach"):
+                pass
+        phases = trace.phases(self.sink)
+        self.assertEqual([p.name for p in phases], ["fetch", "hash", "attach"])
+        self.assertEqual(phases[0].bytes, 100)
+        self.assertEqual(phases[2].count, 2)
+        self.assertEqual(phases[2].bytes, None)
+
+    def test_collect(self):
+        with trace.collect() as collector:
+            with trace.span("seed"):
+                pass
+        with trace.span("seed"):
+            pass
+        self.assertEqual(len(collector.spans), 1)
+
+    def test_no_sinks(self):
+        trace.remove_sink(self.sink)
+        self.addCleanup(trace.add_sink, self.sink)
+        with trace.span("fetch"):
+            pass
+        self.assertEqual(self.sink, [])
+
+
+class TestTraceFile(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pathname = os.path.join(self.directory, "trace")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def trace(self, format):
+        sink = trace.TraceFile(self.pathname, format)
+        trace.add_sink(sink)
+        try:
+            with trace.span("VBoxManage createvm", "command", argv=["VBoxManage", "createvm"]) as info:
+                info["exit_code"] = 0
+            with trace.span("seed"):
+                pass
+        finally:
+            trace.remove_sink(sink)
+            sink.close()
+
+    def test_jsonl(self):
+        self.trace("jsonl")
+        spans = [json.loads(line) for line in open(self.pathname)]
+        self.assertEqual([s["name"] for s in spans], ["VBoxManage createvm", "seed"])
+        self.assertEqual(spans[0]["args"], {"argv": ["VBoxManage", "createvm"], "exit_code": 0})
+
+    def test_chrome(self):
+        self.trace("chrome")
+        events = json.load(open(self.pathname))
+        self.assertEqual([e["name"] for e in events], ["VBoxManage createvm", "seed"])
+        self.assertEqual(events[0]["ph"], "X")
+        self.assertEqual(events[0]["cat"], "command")
+        self.assertEqual(events[0]["pid"], os.getpid())
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, trace.TraceFile, self.pathname, "xml")
@@ -0,0 +1,179 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import threading
+import contextlib
+import collections
+
+# the sinks spans are recorded to
+sinks = []
+sinks_lock = threading.Lock()
+
+
+class TraceFile(object):
+
+    """ Writes spans to a file, either as JSON lines, one object per span,
+    or in the Chrome trace event format, which can be loaded by
+    chrome://tracing and other trace viewers. """
+
+    formats = ["jsonl", "chrome"]
+
+    def __init__(self, pathname, format="jsonl"):
+        if format not in self.formats:
+            raise ValueError("Unknown trace format {0!r}".format(format))
+        self.format = format
+        self.f = open(pathname, "w")
+        self.lock = threading.Lock()
+        self.events = 0
+        if format == "chrome":
+            self.f.write("[\n")
+
+    def record(self, span):
+        if self.format == "chrome":
+            data = {
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": int(span["start"] * 1000000),
+                "dur": int(span["elapsed"] * 1000000),
+                "pid": os.getpid(),
+                "tid": span["thread"],
+                "args": span["args"],
+            }
+        else:
+            data = span
+        with self.lock:
+            if self.format == "chrome" and self.events:
+                self.f.write(",\n")
+            json.dump(data, self.f, sort_keys=True)
+            if self.format != "chrome":
+                self.f.write("\n")
+            self.f.flush()
+            self.events += 1
+
+    def close(self):
+        with self.lock:
+            if self.format == "chrome":
+                self.f.write("\n]\n")
+            self.f.close()
+
+
+class Collector(object):
+
+    """ A sink that keeps the spans recorded by a single thread, by default
+    the one that created it. """
+
+    def __init__(self, thread=None):
+        self.thread = thread or threading.current_thread().ident
+        self.spans = []
+
+    def record(self, span):
+        if span["thread"] == self.thread:
+            self.spans.append(span)
+
+
+class Phase(object):
+
+    """ The total time taken by, and bytes processed in, the spans of one
+    name. """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.elapsed = 0.0
+        self.bytes = None
+
+    def add(self, span):
+        self.count += 1
+        self.elapsed += span["elapsed"]
+        size = span["args"].get("bytes")
+        if size is not None:
+            self.bytes = (self.bytes or 0) + size
+
+    def as_dict(self):
+        return {"name": self.name, "count": self.count, "elapsed": self.elapsed, "bytes": self.bytes}
+
+    def __str__(self):
+        if self.bytes is None:
+            return "{0}: {1:.2f}s".format(self.name, self.elapsed)
+        return "{0}: {1:.2f}s, {2} bytes".format(self.name, self.elapsed, self.bytes)
+
+
+def phases(spans, category="phase"):
+    """ Summarise the spans of category by name, in the order the first of
+    each name started. """
+    summary = collections.OrderedDict()
+    for span in sorted(spans, key=lambda s: s["start"]):
+        if span["category"] == category:
+            summary.setdefault(span["name"], Phase(span["name"])).add(span)
+    return summary.values()
+
+
+@contextlib.contextmanager
+def collect():
+    """ Collect the spans recorded by this thread during the block. """
+    collector = Collector()
+    add_sink(collector)
+    try:
+        yield collector
+    finally:
+        remove_sink(collector)
+
+
+def add_sink(sink):
+    with sinks_lock:
+        sinks.append(sink)
+
+
+def remove_sink(sink):
+    with sinks_lock:
+        sinks.remove(sink)
+
+
+def record(span):
+    with sinks_lock:
+        current = list(sinks)
+    for sink in current:
+        sink.record(span)
+
+
+@contextlib.contextmanager
+def span(name, category="phase", **args):
+    """ Time the block, recording it as a span with the arguments given.
+    The block is given the arguments, and may add to them, for example the
+    number of bytes processed. The span is recorded even if the block
+    raises, with the error. Costs next to nothing if nothing is tracing. """
+    started = time.time()
+    try:
+        yield args
+    except BaseException as e:
+        args.setdefault("error", str(e) or e.__class__.__name__)
+        raise
+    finally:
+        if sinks:
+            record({
+                "name": name,
+                "category": category,
+                "start": started,
+                "elapsed": time.time() - started,
+                "thread": threading.current_thread().ident,
+                "thread_name": threading.current_thread().name,
+                "args": args,
+            })
+
+__all__ = [TraceFile, Collector, Phase, phases, collect, add_sink, remove_sink, record, span]